@@ -6,6 +6,7 @@ from sqlalchemy.engine import Connection
 from sqlalchemy.ext.asyncio import async_engine_from_config
 
 from alembic import context
+from askgpt.infra.schema import TableBase
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -16,11 +17,13 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
-# add your model's MetaData object here
-# for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-target_metadata = None
+target_metadata = TableBase.metadata
+
+if config.get_main_option("sqlalchemy.url", "").startswith("driver://"):
+    # no url in alembic.ini, migrate the database of the detected settings
+    from askgpt.domain.config import detect_settings
+
+    config.set_main_option("sqlalchemy.url", detect_settings().db.DB_URL)
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
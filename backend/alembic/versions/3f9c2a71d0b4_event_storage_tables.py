@@ -0,0 +1,85 @@
+"""event body codecs, archives and content blobs
+
+Columns and tables used by askgpt.infra.bodycodec, askgpt.infra.archive and askgpt.infra.blobstore,
+databases created by create_tables already have them, so each step checks first.
+
+Revision ID: 3f9c2a71d0b4
+Revises:
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3f9c2a71d0b4"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _gmt_columns() -> list[sa.Column]:
+    return [
+        sa.Column("gmt_modified", sa.DateTime, server_default=sa.func.now()),
+        sa.Column("gmt_created", sa.DateTime, server_default=sa.func.now()),
+    ]
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+
+    if "event_body_codecs" not in tables:
+        op.create_table(
+            "event_body_codecs",
+            sa.Column("id", sa.String, primary_key=True, comment="codec_id"),
+            sa.Column("dictionary", sa.LargeBinary, nullable=False),
+            sa.Column("sample_size", sa.Integer, nullable=False),
+            sa.Column("is_active", sa.Boolean),
+            *_gmt_columns(),
+        )
+    if "event_archives" not in tables:
+        op.create_table(
+            "event_archives",
+            sa.Column("entity_id", sa.String, primary_key=True),
+            sa.Column("events", sa.LargeBinary, nullable=True),
+            sa.Column("event_count", sa.Integer, nullable=False),
+            sa.Column("archived_at", sa.DateTime, nullable=True),
+            sa.Column("restored_at", sa.DateTime, nullable=True),
+            *_gmt_columns(),
+        )
+    if "content_blobs" not in tables:
+        op.create_table(
+            "content_blobs",
+            sa.Column("hash", sa.String(64), primary_key=True),
+            sa.Column("content", sa.Text, nullable=False),
+            sa.Column("size", sa.Integer, nullable=False),
+            sa.Column("refcount", sa.Integer, nullable=False),
+            *_gmt_columns(),
+        )
+
+    existing = {column["name"] for column in inspector.get_columns("domain_events")}
+    new_columns = [
+        sa.Column("body_codec", sa.String, nullable=True),
+        sa.Column("event_blob", sa.LargeBinary, nullable=True),
+        sa.Column("blob_refs", sa.JSON(none_as_null=True), nullable=True),
+    ]
+    with op.batch_alter_table("domain_events") as batch:
+        for column in new_columns:
+            if column.name not in existing:
+                batch.add_column(column)
+        # compressed rows keep their body in event_blob
+        batch.alter_column("event_body", existing_type=sa.JSON(), nullable=True)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("domain_events") as batch:
+        batch.drop_column("blob_refs")
+        batch.drop_column("event_blob")
+        batch.drop_column("body_codec")
+    op.drop_table("content_blobs")
+    op.drop_table("event_archives")
+    op.drop_table("event_body_codecs")
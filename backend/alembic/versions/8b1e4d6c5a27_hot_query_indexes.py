@@ -0,0 +1,68 @@
+"""composite indexes for event reads, index sessions.user_id
+
+reads of an entity's events filter on entity_id and order by (gmt_created, id),
+the composite indexes replace the single column ones on entity_id and version.
+on postgres indexes are built concurrently so writes to domain_events are not blocked.
+
+Revision ID: 8b1e4d6c5a27
+Revises: 3f9c2a71d0b4
+Create Date: 2026-10-19 09:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8b1e4d6c5a27"
+down_revision: Union[str, None] = "3f9c2a71d0b4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+NEW_INDEXES: list[tuple[str, str, list[str]]] = [
+    ("ix_domain_events_entity_created", "domain_events", ["entity_id", "gmt_created", "id"]),
+    (
+        "ix_domain_events_entity_type_created",
+        "domain_events",
+        ["entity_id", "event_type", "gmt_created", "id"],
+    ),
+    ("ix_sessions_user_id", "sessions", ["user_id"]),
+]
+REPLACED_INDEXES: list[tuple[str, str, list[str]]] = [
+    ("ix_domain_events_entity_id", "domain_events", ["entity_id"]),
+    ("ix_domain_events_version", "domain_events", ["version"]),
+]
+
+
+def _existing(table: str) -> set[str]:
+    return {index["name"] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def _create(indexes: list[tuple[str, str, list[str]]]) -> None:
+    concurrently = op.get_bind().dialect.name == "postgresql"
+    for name, table, columns in indexes:
+        if name in _existing(table):
+            continue
+        if concurrently:
+            with op.get_context().autocommit_block():
+                op.create_index(name, table, columns, postgresql_concurrently=True)
+        else:
+            op.create_index(name, table, columns)
+
+
+def _drop(indexes: list[tuple[str, str, list[str]]]) -> None:
+    for name, table, _ in indexes:
+        if name in _existing(table):
+            op.drop_index(name, table_name=table)
+
+
+def upgrade() -> None:
+    _create(NEW_INDEXES)
+    _drop(REPLACED_INDEXES)
+
+
+def downgrade() -> None:
+    _create(REPLACED_INDEXES)
+    _drop(NEW_INDEXES)
@@ -0,0 +1,40 @@
+"""sessions.message_seq, allocates message seqs and marks projected sessions
+
+sessions that already have rows in session_messages are marked with their latest seq,
+the others stay NULL and are projected from domain_events on first access.
+
+Revision ID: a5e81f3c7b92
+Revises: e7a13b5c9d40
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a5e81f3c7b92"
+down_revision: Union[str, None] = "e7a13b5c9d40"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL = """
+UPDATE sessions SET message_seq = (
+    SELECT MAX(seq) FROM session_messages WHERE session_id = sessions.id
+)
+WHERE message_seq IS NULL
+"""
+
+
+def upgrade() -> None:
+    columns = {c["name"] for c in sa.inspect(op.get_bind()).get_columns("sessions")}
+    if "message_seq" not in columns:
+        op.add_column("sessions", sa.Column("message_seq", sa.Integer, nullable=True))
+    op.execute(BACKFILL)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("sessions") as batch:
+        batch.drop_column("message_seq")
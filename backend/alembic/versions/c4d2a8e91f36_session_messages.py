@@ -0,0 +1,42 @@
+"""session_messages read table
+
+messages of existing sessions are projected from domain_events
+the first time their history is read, see SessionService.
+
+Revision ID: c4d2a8e91f36
+Revises: 8b1e4d6c5a27
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c4d2a8e91f36"
+down_revision: Union[str, None] = "8b1e4d6c5a27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if "session_messages" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        "session_messages",
+        sa.Column("session_id", sa.String, primary_key=True),
+        sa.Column("seq", sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column("event_id", sa.String, nullable=False, unique=True),
+        sa.Column("role", sa.String, nullable=False),
+        sa.Column("content", sa.Text, nullable=False),
+        sa.Column("gpt_type", sa.String, nullable=False),
+        sa.Column("sent_at", sa.DateTime, nullable=False),
+        sa.Column("gmt_modified", sa.DateTime, server_default=sa.func.now()),
+        sa.Column("gmt_created", sa.DateTime, server_default=sa.func.now()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("session_messages")
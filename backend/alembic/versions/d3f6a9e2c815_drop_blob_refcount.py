@@ -0,0 +1,34 @@
+"""drop content_blobs.refcount, blobs are never deleted so the count was never read
+
+Revision ID: d3f6a9e2c815
+Revises: a5e81f3c7b92
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d3f6a9e2c815"
+down_revision: Union[str, None] = "a5e81f3c7b92"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    columns = {
+        c["name"] for c in sa.inspect(op.get_bind()).get_columns("content_blobs")
+    }
+    if "refcount" in columns:
+        with op.batch_alter_table("content_blobs") as batch:
+            batch.drop_column("refcount")
+
+
+def downgrade() -> None:
+    op.add_column(
+        "content_blobs",
+        sa.Column("refcount", sa.Integer, nullable=False, server_default="0"),
+    )
@@ -0,0 +1,67 @@
+"""sessions.last_active_at for keyset pagination of the session list
+
+existing sessions are backfilled with their latest message, or their creation time,
+ix_sessions_user_active replaces ix_sessions_user_id.
+
+Revision ID: e7a13b5c9d40
+Revises: c4d2a8e91f36
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e7a13b5c9d40"
+down_revision: Union[str, None] = "c4d2a8e91f36"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL = """
+UPDATE sessions SET last_active_at = COALESCE(
+    (SELECT MAX(sent_at) FROM session_messages WHERE session_id = sessions.id),
+    gmt_created,
+    CURRENT_TIMESTAMP
+)
+WHERE last_active_at IS NULL
+"""
+
+
+def _indexes() -> set[str]:
+    return {index["name"] for index in sa.inspect(op.get_bind()).get_indexes("sessions")}
+
+
+def upgrade() -> None:
+    columns = {c["name"] for c in sa.inspect(op.get_bind()).get_columns("sessions")}
+    if "last_active_at" not in columns:
+        # sqlite can't add a column with a non constant default, set it after the backfill
+        op.add_column("sessions", sa.Column("last_active_at", sa.DateTime, nullable=True))
+        op.execute(BACKFILL)
+        with op.batch_alter_table("sessions") as batch:
+            batch.alter_column(
+                "last_active_at",
+                existing_type=sa.DateTime,
+                nullable=False,
+                server_default=sa.func.now(),
+            )
+
+    indexes = _indexes()
+    if "ix_sessions_user_active" not in indexes:
+        op.create_index(
+            "ix_sessions_user_active", "sessions", ["user_id", "last_active_at", "id"]
+        )
+    if "ix_sessions_user_id" in indexes:
+        op.drop_index("ix_sessions_user_id", table_name="sessions")
+
+
+def downgrade() -> None:
+    indexes = _indexes()
+    if "ix_sessions_user_id" not in indexes:
+        op.create_index("ix_sessions_user_id", "sessions", ["user_id"])
+    if "ix_sessions_user_active" in indexes:
+        op.drop_index("ix_sessions_user_active", table_name="sessions")
+    with op.batch_alter_table("sessions") as batch:
+        batch.drop_column("last_active_at")
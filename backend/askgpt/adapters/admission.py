@@ -0,0 +1,120 @@
+import typing as ty
+from contextlib import asynccontextmanager
+
+from askgpt.adapters.cache import LuaScript
+from askgpt.adapters.tokenbucket import Clock
+from askgpt.helpers._log import logger
+from askgpt.helpers.string import KeySpace
+
+# the violation of a revoked access token
+TOKEN_REVOKED = "token_revoked"
+
+
+class Limit(ty.NamedTuple):
+    "a gcra bucket per subject, e.g. per user or per model, under `keyspace`"
+
+    name: str
+    keyspace: KeySpace
+    max_tokens: int
+    refill_rate_s: float
+
+
+class Violation(ty.NamedTuple):
+    limit: str
+    wait_time: float
+
+
+class AdmissionController:
+    """
+    Checks a request against every limit and, optionally, its access token,
+    in a single call of askgpt/script/admission.lua, so more limits cost no more round trips.
+
+    a request is admitted by all limits or charged to none of them.
+    charges known only afterwards, e.g. tokens used by a completion, are settled by `adjust`,
+    with askgpt/script/gcraadjust.lua.
+    """
+
+    def __init__(
+        self,
+        script: LuaScript,
+        adjust_script: LuaScript,
+        limits: ty.Sequence[Limit],
+        *,
+        clock: Clock | None = None,
+    ):
+        self._script = script
+        self._adjust_script = adjust_script
+        self._limits = tuple(limits)
+        self._clock = clock
+
+    @property
+    def limits(self) -> tuple[Limit, ...]:
+        return self._limits
+
+    async def admit(
+        self,
+        subjects: ty.Sequence[str],
+        costs: ty.Sequence[int],
+        *,
+        token_key: str = "",
+        token: str = "",
+        max_wait: float = 0,
+    ) -> tuple[Violation | None, float]:
+        """
+        subjects and costs are given in the order of `limits`, a cost of 0 skips the limit,
+        `token` must be an unexpired member of the sorted set at `token_key` when given,
+        see TokenRegistry.
+        returns the first limit violated, or None and the seconds the admitted request waits
+        for its tokens, no more than `max_wait`.
+        """
+        keys = [token_key or "_"]
+        args: list[str | float | int] = [
+            token,
+            self._clock() if self._clock else "",
+            max_wait,
+        ]
+        for limit, subject, cost in zip(self._limits, subjects, costs, strict=True):
+            keys.append(limit.keyspace(subject).key)
+            args.extend((1 / limit.refill_rate_s, limit.max_tokens, cost))
+
+        index, wait_time = await self._script(keys=keys, args=args)
+        index = int(index)
+        if index == 0:
+            return None, float(wait_time)
+        if index < 0:
+            return Violation(TOKEN_REVOKED, 0), 0
+        violation = Violation(self._limits[index - 1].name, float(wait_time))
+        return violation, violation.wait_time
+
+    async def adjust(
+        self,
+        subjects: ty.Sequence[str],
+        tokens: ty.Sequence[int],
+        *,
+        from_now: bool = False,
+    ) -> None:
+        """
+        charge, or give back when negative, tokens regardless of the limits,
+        in the order of `limits`, 0 skips the limit.
+        from_now: the bucket owes at least `tokens` from now on, instead of adding them to its debt
+        """
+        keys: list[str] = []
+        args: list[str | float | int] = [
+            self._clock() if self._clock else "",
+            int(from_now),
+        ]
+        for limit, subject, amount in zip(self._limits, subjects, tokens, strict=True):
+            if amount:
+                keys.append(limit.keyspace(subject).key)
+                args.extend((1 / limit.refill_rate_s, amount))
+        if keys:
+            await self._adjust_script(keys=keys, args=args)
+
+    @asynccontextmanager
+    async def lifespan(self):
+        try:
+            await self._script.load()
+            await self._adjust_script.load()
+        except Exception:
+            logger.exception("Failed to preload the admission scripts")
+        yield self
@@ -1,6 +1,7 @@
 import abc
 import datetime
 import functools
+import hashlib
 import pathlib
 import typing as ty
 from collections import defaultdict
@@ -8,6 +9,7 @@ from contextlib import asynccontextmanager
 from typing import Any
 
 from redis import asyncio as aioredis
+from redis.exceptions import NoScriptError
 
 from askgpt.helpers.string import KeySpace
 
@@ -22,6 +24,39 @@ class ScriptFunc[
     def __call__(self, keys: KeysT, args: ArgsT) -> ty.Awaitable[ResultT]: ...
 
 
+@functools.cache
+def read_script(path: pathlib.Path) -> str:
+    "scripts are read once per process"
+    return path.read_text()
+
+
+class LuaScript:
+    """
+    A lua script called by its sha1 with EVALSHA, so the source is only sent by `load`.
+    When redis no longer has it, e.g. after a restart, a failover or SCRIPT FLUSH,
+    the script is loaded again and the call retried once.
+    """
+
+    def __init__(self, redis: aioredis.Redis, source: str):
+        self._redis = redis
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    async def load(self) -> None:
+        await self._redis.script_load(self.source)  # type: ignore
+
+    async def __call__(
+        self,
+        keys: ty.Sequence[bytes | str | memoryview] = (),
+        args: ty.Iterable[str | int | float | bytes | memoryview] = (),
+    ) -> ty.Any:
+        try:
+            return await self._redis.evalsha(self.sha, len(keys), *keys, *args)  # type: ignore
+        except NoScriptError:
+            await self.load()
+            return await self._redis.evalsha(self.sha, len(keys), *keys, *args)  # type: ignore
+
+
 class CacheList[TKey: ty.Hashable, TValue]:
     def __init__(self, base: "Cache[TKey, TValue]"):
         self._base = base
@@ -82,6 +117,22 @@ class Cache[TKey: ty.Hashable, TValue: ty.Any](abc.ABC):
     async def sadd(self, key: TKey, *values: ty.Any) -> bool:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def zadd(self, key: TKey, mapping: ty.Mapping[ty.Any, float]) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def zscore(self, key: TKey, member: ty.Any) -> float | None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def zremrangebyscore(self, key: TKey, min: float, max: float) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def expire(self, key: TKey, seconds: int) -> bool:
+        raise NotImplementedError
+
     @property
     @abc.abstractmethod
     def keyspace(self) -> KeySpace: ...
@@ -95,6 +146,7 @@ class MemoryCache[TKey: str, TVal: ty.Any](Cache[TKey, TVal]):
     def __init__(self):
         self._cache: dict[TKey, TVal] = {}
         self._set: set[TVal] = set()
+        self._zsets: dict[TKey, dict[ty.Any, float]] = defaultdict(dict)
 
     @functools.cached_property
     def list(self) -> CacheList[TKey, TVal]:
@@ -112,6 +164,7 @@ class MemoryCache[TKey: str, TVal: ty.Any](Cache[TKey, TVal]):
 
     async def remove(self, key: TKey) -> None:
         self._cache.pop(key, None)
+        self._zsets.pop(key, None)
 
     async def rpush(self, key: TKey, *values: TVal) -> bool:
         await self.list.rpush(key, *values)
@@ -130,8 +183,29 @@ class MemoryCache[TKey: str, TVal: ty.Any](Cache[TKey, TVal]):
         self._set.add(*values)
         return True
 
+    async def zadd(self, key: TKey, mapping: ty.Mapping[Any, float]) -> int:
+        zset = self._zsets[key]
+        added = len(mapping.keys() - zset.keys())
+        zset.update(mapping)
+        return added
+
+    async def zscore(self, key: TKey, member: Any) -> float | None:
+        return self._zsets.get(key, {}).get(member)
+
+    async def zremrangebyscore(self, key: TKey, min: float, max: float) -> int:
+        zset = self._zsets.get(key, {})
+        removed = [member for member, score in zset.items() if min <= score <= max]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    async def expire(self, key: TKey, seconds: int) -> bool:
+        "keys do not expire in memory"
+        return key in self._cache or key in self._zsets
+
     async def close(self):
         self._cache.clear()
+        self._zsets.clear()
 
     @classmethod
     @functools.lru_cache(maxsize=1)
@@ -173,13 +247,12 @@ class RedisCache[TKey: str | memoryview | bytes](Cache[TKey, ty.Any]):
     async def remove(self, key: TKey) -> None:
         await self._redis.delete(key)  # type: ignore
 
-    def load_script(
-        self, script: str | pathlib.Path
-    ) -> ScriptFunc[ty.Any, ty.Any, ty.Any]:
+    def load_script(self, script: str | pathlib.Path) -> LuaScript:
+        "scripts are not sent to redis until called, or preloaded with `LuaScript.load`"
         if isinstance(script, pathlib.Path):
-            script = script.read_text()
+            script = read_script(script)
 
-        return self._redis.register_script(script)
+        return LuaScript(self._redis, script)
 
     async def sadd(self, key: TKey, *values: ty.Any) -> bool:
         res: RedisBool = await self._redis.sadd(key, *values)  # type: ignore
@@ -189,6 +262,18 @@ class RedisCache[TKey: str | memoryview | bytes](Cache[TKey, ty.Any]):
         res: RedisBool = await self._redis.sismember(key, member)  # type: ignore
         return res == 1  # type: ignore
 
+    async def zadd(self, key: TKey, mapping: ty.Mapping[ty.Any, float]) -> int:
+        return await self._redis.zadd(key, dict(mapping))  # type: ignore
+
+    async def zscore(self, key: TKey, member: ty.Any) -> float | None:
+        return await self._redis.zscore(key, member)  # type: ignore
+
+    async def zremrangebyscore(self, key: TKey, min: float, max: float) -> int:
+        return await self._redis.zremrangebyscore(key, min, max)  # type: ignore
+
+    async def expire(self, key: TKey, seconds: int) -> bool:
+        return await self._redis.expire(key, seconds)  # type: ignore
+
     async def lpop(self, key: TKey) -> ty.Any | None:
         return await self._redis.lpop(key)  # type: ignore
 
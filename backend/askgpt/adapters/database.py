@@ -1,19 +1,94 @@
+import asyncio
+import random
+import time
 import types
 import typing as ty
+import weakref
 from contextlib import asynccontextmanager
 
+import sqlalchemy as sa
 from sqlalchemy.engine.cursor import CursorResult
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
 from sqlalchemy.sql import Executable, text
 
+from askgpt.adapters.cache import Cache
 from askgpt.helpers._log import logger
+from askgpt.helpers.metrics import MetricsRegistry, metrics
 from askgpt.helpers.sql import ExecutionOptions, StrMap
 from askgpt.helpers.time import timeit
 
 
+class PoolMetrics:
+    """
+    Checkouts, checkout wait, timeouts and connection lifetime of an engine's pool,
+    reported as `db.<name>.pool.*`. use `for_engine`, so each pool is instrumented once.
+    """
+
+    _instances: ty.ClassVar[weakref.WeakKeyDictionary[sa.Pool, "PoolMetrics"]] = (
+        weakref.WeakKeyDictionary()
+    )
+
+    def __init__(self, pool: sa.Pool, name: str, registry: MetricsRegistry = metrics):
+        prefix = f"db.{name}.pool"
+        self.checkouts = registry.counter(f"{prefix}.checkouts")
+        self.timeouts = registry.counter(f"{prefix}.timeouts")
+        self.invalidated = registry.counter(f"{prefix}.invalidated")
+        self.checkout_wait = registry.histogram(f"{prefix}.checkout_wait_seconds")
+        self.connection_lifetime = registry.histogram(
+            f"{prefix}.connection_lifetime_seconds",
+            buckets=(60, 300, 900, 1800, 3600, 4 * 3600, 24 * 3600),
+        )
+        registry.register_collector(prefix, lambda: self._pool_state(pool))
+
+        sa.event.listen(pool, "connect", self._on_connect)
+        sa.event.listen(pool, "checkout", self._on_checkout)
+        sa.event.listen(pool, "close", self._on_close)
+        sa.event.listen(pool, "invalidate", self._on_invalidate)
+
+    @classmethod
+    def for_engine(
+        cls, engine: AsyncEngine, name: str, registry: MetricsRegistry = metrics
+    ) -> "PoolMetrics":
+        pool = engine.sync_engine.pool
+        if (instance := cls._instances.get(pool)) is None:
+            instance = cls._instances[pool] = cls(pool, name, registry)
+        return instance
+
+    @staticmethod
+    def _pool_state(pool: sa.Pool) -> dict[str, float]:
+        "QueuePool reports its state, other pools e.g. StaticPool don't"
+        if not isinstance(pool, sa.QueuePool):
+            return {}
+        return dict(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+        )
+
+    def _on_connect(self, dbapi_conn: ty.Any, record: ty.Any) -> None:
+        record.info["connected_at"] = time.monotonic()
+
+    def _on_checkout(self, dbapi_conn: ty.Any, record: ty.Any, proxy: ty.Any) -> None:
+        self.checkouts.inc()
+
+    def _on_close(self, dbapi_conn: ty.Any, record: ty.Any) -> None:
+        if (connected_at := record.info.pop("connected_at", None)) is not None:
+            self.connection_lifetime.observe(time.monotonic() - connected_at)
+
+    def _on_invalidate(self, dbapi_conn: ty.Any, record: ty.Any, exc: ty.Any) -> None:
+        self.invalidated.inc()
+
+
 class AsyncDatabase:
-    def __init__(self, aioengine: AsyncEngine):
+    def __init__(self, aioengine: AsyncEngine, *, name: str | None = None):
+        """
+        name: report pool metrics of the engine under `db.<name>.pool`
+        """
         self._aioengine = aioengine
+        self._pool_metrics = (
+            PoolMetrics.for_engine(aioengine, name) if name is not None else None
+        )
 
     @property
     def url(self):
@@ -46,6 +121,20 @@ class AsyncDatabase:
     def connect(self) -> AsyncConnection:
         return self._aioengine.connect()
 
+    async def acquire(self) -> AsyncConnection:
+        "a started connection, time spent waiting for the pool is recorded in pool metrics"
+        connection = self._aioengine.connect()
+        if self._pool_metrics is None:
+            return await connection.start()
+        pre = time.perf_counter()
+        try:
+            return await connection.start()
+        except sa.exc.TimeoutError:
+            self._pool_metrics.timeouts.inc()
+            raise
+        finally:
+            self._pool_metrics.checkout_wait.observe(time.perf_counter() - pre)
+
     async def close(self) -> None:
         await self._aioengine.dispose()
 
@@ -59,3 +148,256 @@ class AsyncDatabase:
         exc_tb: types.TracebackType | None,
     ):
         await self.close()
+
+
+# seconds the replica is behind the primary, 0 when it has replayed everything it received
+PG_REPLICATION_LAG = """
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+class Replica:
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+        self.healthy = False
+        self.lag = 0.0
+        # unix time up to which the replica had replayed writes at the last probe
+        self.replayed_until = 0.0
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}({self.db.url!r}, healthy={self.healthy}, lag={self.lag})"
+        )
+
+
+class ReplicaSet:
+    """
+    Read replicas of the primary database, probed every `probe_interval` seconds for health and lag.
+    replicas are unhealthy until the first probe succeeds.
+    """
+
+    def __init__(
+        self,
+        replicas: ty.Sequence[AsyncDatabase],
+        *,
+        max_lag: float = 1.0,
+        probe_interval: float = 1.0,
+    ):
+        self._replicas = [Replica(db) for db in replicas]
+        self._max_lag = max_lag
+        self._probe_interval = probe_interval
+        self.__main_task: asyncio.Task[ty.Any] | None = None
+
+    @property
+    def replicas(self) -> list[Replica]:
+        return self._replicas
+
+    def pick(self, fresh_after: float | None = None) -> AsyncDatabase | None:
+        candidates = [
+            replica
+            for replica in self._replicas
+            if replica.healthy
+            and replica.lag <= self._max_lag
+            and (fresh_after is None or replica.replayed_until >= fresh_after)
+        ]
+        if not candidates:
+            return None
+        return random.choice(candidates).db
+
+    async def _lag(self, db: AsyncDatabase) -> float:
+        if db.url.get_backend_name() == "postgresql":
+            return float((await db.execute(PG_REPLICATION_LAG)).scalar_one())
+        await db.execute("SELECT 1")
+        return 0.0
+
+    async def probe(self) -> None:
+        for replica in self._replicas:
+            probed_at = time.time()
+            try:
+                lag = await self._lag(replica.db)
+            except Exception as e:
+                if replica.healthy:
+                    logger.warning(f"replica {replica.db.url!r} is unavailable: {e}")
+                replica.healthy = False
+                continue
+            replica.healthy = True
+            replica.lag = lag
+            replica.replayed_until = probed_at - lag
+
+    async def _run_forever(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self._probe_interval)
+
+    async def start(self):
+        if self.__main_task is None or self.__main_task.done():
+            await self.probe()
+            self.__main_task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self.__main_task is not None:
+            self.__main_task.cancel()
+            try:
+                await self.__main_task
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.__main_task = None
+
+    async def close(self) -> None:
+        await self.stop()
+        for replica in self._replicas:
+            await replica.db.close()
+
+    @asynccontextmanager
+    async def lifespan(self):
+        try:
+            await self.start()
+            yield self
+        finally:
+            await self.close()
+
+
+class CacheWriteFence:
+    """
+    Last write time of each key kept in the cache for `ttl` seconds,
+    which should outlast the max lag of replicas.
+    """
+
+    def __init__(self, cache: Cache[str, str], *, ttl: int):
+        self._cache = cache
+        self._ttl = ttl
+
+    def _key(self, key: str) -> str:
+        return (self._cache.keyspace / "last_write")(key).key
+
+    async def last_write(self, key: str) -> float | None:
+        try:
+            value = await self._cache.get(self._key(key))
+        except Exception:
+            logger.exception("Failed to read last write, reading from the primary")
+            return time.time()
+        return float(value) if value is not None else None
+
+    async def record(self, key: str, at: float) -> None:
+        try:
+            await self._cache.set(self._key(key), str(at), ex=self._ttl)  # type: ignore
+        except Exception:
+            # the write is committed, worst case the next read is stale for max lag
+            logger.exception("Failed to record last write")
+
+
+class SqliteWriter:
+    """
+    Serializes the write transactions of the process onto one connection,
+    so they queue here instead of failing with `database is locked`.
+
+    With group_commit, transactions queued behind each other share a single commit,
+    each runs in its own savepoint and returns once the shared commit is done.
+    the connection is returned to the pool when no writer is waiting.
+    """
+
+    def __init__(
+        self, db: AsyncDatabase, *, group_commit: bool = False, max_batch: int = 64
+    ):
+        self._db = db
+        self._group_commit = group_commit
+        self._max_batch = max_batch
+        self._lock = asyncio.Lock()
+        self._waiting = 0
+        self._connection: AsyncConnection | None = None
+        self._batch: list[asyncio.Future[None]] = []
+        self._drainer: asyncio.Task[None] | None = None
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    async def _checkout(self) -> AsyncConnection:
+        if self._connection is None:
+            self._connection = await self._db.acquire()
+        return self._connection
+
+    async def _drain(self) -> None:
+        async with self._lock:
+            if not self._waiting:
+                await self._flush()
+
+    async def _flush(self) -> None:
+        "commit the pending batch and return the connection to the pool"
+        connection, self._connection = self._connection, None
+        batch, self._batch = self._batch, []
+        if connection is None:
+            return
+        try:
+            if batch:
+                await connection.commit()
+        except Exception as e:
+            for committed in batch:
+                if not committed.done():
+                    committed.set_exception(e)
+            batch = []
+        finally:
+            await connection.close()
+        for committed in batch:
+            if not committed.done():
+                committed.set_result(None)
+
+    @asynccontextmanager
+    async def transaction(self) -> ty.AsyncGenerator[AsyncConnection, None]:
+        self._waiting += 1
+        try:
+            await self._lock.acquire()
+        except BaseException:
+            self._waiting -= 1
+            if not self._waiting and self._connection is not None:
+                # the writer before us left the batch open for us, commit it on our behalf
+                self._drainer = asyncio.create_task(self._drain())
+            raise
+        self._waiting -= 1
+
+        committed: asyncio.Future[None] | None = None
+        try:
+            connection = await self._checkout()
+            if not self._group_commit:
+                async with connection.begin():
+                    yield connection
+            else:
+                if not connection.in_transaction():
+                    await connection.begin()
+                savepoint = await connection.begin_nested()
+                try:
+                    yield connection
+                except BaseException:
+                    await savepoint.rollback()
+                    raise
+                await savepoint.commit()
+                committed = asyncio.get_running_loop().create_future()
+                self._batch.append(committed)
+        finally:
+            try:
+                if not self._waiting or len(self._batch) >= self._max_batch:
+                    await self._flush()
+            finally:
+                self._lock.release()
+        if committed is not None:
+            await committed
+
+
+class SqliteReadPool:
+    """
+    Read connections of a WAL database, as replicas of the writer.
+    a reader sees every commit made before its transaction started, so it is never stale.
+    """
+
+    def __init__(self, db: AsyncDatabase):
+        self._db = db
+
+    def pick(self, fresh_after: float | None = None) -> AsyncDatabase:
+        return self._db
+
+    async def close(self) -> None:
+        await self._db.close()
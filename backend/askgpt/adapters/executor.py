@@ -0,0 +1,110 @@
+import asyncio
+import functools
+import time
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from askgpt.domain.errors import ServerBusyError
+from askgpt.helpers.metrics import MetricsRegistry, metrics
+
+
+class CPUExecutor:
+    """
+    Runs cpu bound calls, e.g. bcrypt and fernet, on a bounded thread pool
+    instead of the event loop, so they no longer stall every other request of the worker.
+    bcrypt and the openssl backed fernet release the GIL while they work.
+
+    at most `max_queue` calls wait for one of the `max_workers` threads,
+    further calls are rejected with ServerBusyError instead of queueing without bound.
+
+    reported as `executor.<name>.*`: calls, rejected, queue_wait_seconds and run_seconds,
+    with the running and queued calls collected on each snapshot.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_queue: int,
+        *,
+        name: str = "cpu",
+        registry: MetricsRegistry = metrics,
+    ):
+        self._max_workers = max_workers
+        self._max_queue = max_queue
+        self._name = name
+        self._pool: ThreadPoolExecutor | None = None
+        # submitted calls not done yet, running ones included
+        self._pending = 0
+
+        prefix = f"executor.{name}"
+        self._calls = registry.counter(f"{prefix}.calls")
+        self._rejected = registry.counter(f"{prefix}.rejected")
+        self._queue_wait = registry.histogram(f"{prefix}.queue_wait_seconds")
+        self._run_time = registry.histogram(f"{prefix}.run_seconds")
+        registry.register_collector(prefix, self._state)
+
+    def _state(self) -> dict[str, float]:
+        running = min(self._pending, self._max_workers)
+        return dict(running=running, queued=self._pending - running)
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        "created on first use, threads are started as calls come in"
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self._max_workers, thread_name_prefix=self._name
+            )
+        return self._pool
+
+    @staticmethod
+    def _timed[R](func: ty.Callable[[], R]) -> tuple[R, float, float]:
+        "in a worker thread, metrics are recorded on the event loop"
+        started_at = time.perf_counter()
+        result = func()
+        return result, started_at, time.perf_counter()
+
+    async def run[**P, R](
+        self, func: ty.Callable[P, R], *args: P.args, **kwargs: P.kwargs
+    ) -> R:
+        if self._pending >= self._max_workers + self._max_queue:
+            self._rejected.inc()
+            raise ServerBusyError("Server is busy, try again later")
+
+        self._calls.inc()
+        self._pending += 1
+        submitted_at = time.perf_counter()
+        call = functools.partial(func, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        future = self.pool.submit(self._timed, call)
+        # a cancelled caller leaves its call running, it is pending until the thread is done
+        future.add_done_callback(lambda _: self._finished(loop))
+        timed = await asyncio.wrap_future(future, loop=loop)
+        result, started_at, finished_at = timed
+        self._queue_wait.observe(started_at - submitted_at)
+        self._run_time.observe(finished_at - started_at)
+        return result
+
+    def _finished(self, loop: asyncio.AbstractEventLoop) -> None:
+        "in the worker thread, or on the loop for a call cancelled before it started"
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # the loop is closed, nothing reads the count anymore
+            pass
+
+    def _release(self) -> None:
+        self._pending -= 1
+
+    async def shutdown(self) -> None:
+        "waits for running calls in a thread, so the loop keeps serving meanwhile"
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+    @asynccontextmanager
+    async def lifespan(self):
+        try:
+            yield self
+        finally:
+            await self.shutdown()
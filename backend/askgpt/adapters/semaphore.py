@@ -0,0 +1,130 @@
+import asyncio
+import typing as ty
+import uuid
+from contextlib import asynccontextmanager
+
+from askgpt.adapters.cache import KeySpace, LuaScript, RedisCache
+from askgpt.adapters.tokenbucket import Clock
+from askgpt.helpers._log import logger
+
+
+class DistributedSemaphore:
+    """
+    Caps the leases of a key held at once by every worker, e.g. the streams of a user,
+    with a sorted set per key in redis of lease ids scored by their expiry,
+    see askgpt/script/semaphore.lua.
+
+    leases held by this worker are renewed every `renew_interval`, in one call for all of them.
+    leases of a crashed worker are no longer renewed, they are reclaimed by the next acquire
+    of their key after at most `lease_ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        redis: RedisCache[str],
+        acquire_script: LuaScript,
+        renew_script: LuaScript,
+        *,
+        keyspace: KeySpace,
+        lease_ttl: float = 30,
+        renew_interval: float = 10,
+        clock: Clock | None = None,
+    ):
+        self._redis = redis
+        self._acquire_script = acquire_script
+        self._renew_script = renew_script
+        self._keyspace = keyspace
+        self._lease_ttl = lease_ttl
+        self._renew_interval = renew_interval
+        self._clock = clock
+        # lease ids held by this worker, per key
+        self._held: dict[str, set[str]] = {}
+        self.__main_task: asyncio.Task[ty.Any] | None = None
+
+    @property
+    def held(self) -> int:
+        return sum(len(leases) for leases in self._held.values())
+
+    def _key(self, key: str) -> str:
+        return self._keyspace(key).key
+
+    async def acquire(self, key: str, limit: int) -> str | None:
+        "returns the id of the new lease, None when `limit` leases of `key` are held"
+        lease_id = uuid.uuid4().hex
+        args: list[str | float | int] = [
+            lease_id,
+            limit,
+            self._lease_ttl,
+            self._clock() if self._clock else "",
+        ]
+        if not int(await self._acquire_script(keys=[self._key(key)], args=args)):
+            return None
+        self._held.setdefault(key, set()).add(lease_id)
+        return lease_id
+
+    async def release(self, key: str, lease_id: str) -> None:
+        "releasing a lease twice is a no-op, one that fails to be released expires"
+        leases = self._held.get(key)
+        if leases is None or lease_id not in leases:
+            return
+        leases.remove(lease_id)
+        if not leases:
+            del self._held[key]
+        await self._redis.client.zrem(self._key(key), lease_id)
+
+    async def renew(self) -> int:
+        "extend every lease held by this worker, returns the number renewed"
+        if not self._held:
+            return 0
+        keys: list[str] = []
+        args: list[str | float | int] = [
+            self._lease_ttl,
+            self._clock() if self._clock else "",
+        ]
+        for key, leases in self._held.items():
+            keys.append(self._key(key))
+            args.append(len(leases))
+            args.extend(leases)
+        return int(await self._renew_script(keys=keys, args=args))
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self._renew_interval)
+            try:
+                await self.renew()
+            except Exception:
+                logger.exception("Failed to renew semaphore leases")
+
+    async def start(self):
+        try:
+            await self._acquire_script.load()
+            await self._renew_script.load()
+        except Exception:
+            logger.exception("Failed to preload the semaphore scripts")
+        if self.__main_task is None or self.__main_task.done():
+            self.__main_task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self.__main_task is not None:
+            self.__main_task.cancel()
+            try:
+                await self.__main_task
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.__main_task = None
+        # leases of this worker would otherwise block their keys until they expire
+        for key, leases in list(self._held.items()):
+            for lease_id in list(leases):
+                try:
+                    await self.release(key, lease_id)
+                except Exception:
+                    logger.exception("Failed to release semaphore leases")
+
+    @asynccontextmanager
+    async def lifespan(self):
+        try:
+            await self.start()
+            yield self
+        finally:
+            await self.stop()
@@ -2,18 +2,46 @@
 TODO: replace this with premier.throttler
 """
 
+import asyncio
+import time
 import typing as ty
+from contextlib import asynccontextmanager
 from functools import cached_property
 
-from askgpt.adapters.cache import KeySpace, RedisBool, RedisCache, ScriptFunc
+from askgpt.adapters.cache import (
+    KeySpace,
+    LuaScript,
+    RedisBool,
+    RedisCache,
+    ScriptFunc,
+)
+from askgpt.helpers._log import logger
 
-type TokenBucketScript = ScriptFunc[list[str], list[float | int], RedisBool]
+# wait time in seconds as a string, see askgpt/script/tokenbucket.lua
+type TokenBucketScript = ScriptFunc[list[str], list[str | float | int], str]
+# wall clock in seconds, passed to the scripts in place of redis TIME, for tests
+type Clock = ty.Callable[[], float]
 
 
 class Throttler(ty.Protocol):
     async def acquire(self, cost: int = 1) -> bool: ...
 
 
+class KeyedLimiter(ty.Protocol):
+    """
+    a limit applied to each key on its own, e.g. per user,
+    `acquire` returns the seconds until the tokens are available,
+    they are taken when that is no more than `max_wait`, and usable after the wait.
+    """
+
+    @property
+    def max_tokens(self) -> int: ...
+
+    async def acquire(self, key: str, cost: int = 1, max_wait: float = 0) -> float: ...
+
+    def lifespan(self) -> ty.AsyncContextManager[ty.Any]: ...
+
+
 class TokenBucket:
     "Refill tokens with refill rate evertime it gets called"
 
@@ -25,9 +53,11 @@ class TokenBucket:
         bucket_key: KeySpace,
         max_tokens: int,
         refill_rate_s: float,
+        clock: Clock | None = None,
     ):
         self._redis = redis
         self._bucketscript = bucket_script
+        self._clock = clock
 
         # These three are instance attributes
         self._bucket_key = bucket_key
@@ -66,13 +96,28 @@ class TokenBucket:
         )
         return res == 1
 
-    async def acquire(self, cost: int = 1) -> ty.Literal[0] | float:
-        args = [self._max_tokens, self._refill_rate_s, cost]
+    async def _take(self, cost: int, max_wait: float) -> float:
+        args: list[str | float | int] = [
+            self._max_tokens,
+            self._refill_rate_s,
+            cost,
+            self._clock() if self._clock else "",
+            max_wait,
+        ]
         wait_time = await self._bucketscript(keys=[self._bucket_key.key], args=args)
-        return wait_time
+        return float(wait_time)
 
-    async def reserve_token(self, token_cost: int = 1) -> None:
-        raise NotImplementedError
+    async def acquire(self, cost: int = 1) -> float:
+        "returns 0 when the tokens are taken, otherwise the seconds to wait"
+        return await self._take(cost, 0)
+
+    async def reserve_token(self, token_cost: int = 1, *, max_wait: float) -> float:
+        """
+        take tokens that are refilled within `max_wait` seconds, leaving the bucket in debt,
+        returns the seconds until they are refilled,
+        the tokens are taken, and usable after the wait, when that is no more than `max_wait`.
+        """
+        return await self._take(token_cost, max_wait)
 
 
 class TokenBucketFactory:
@@ -81,10 +126,12 @@ class TokenBucketFactory:
         redis: RedisCache[str],
         script: TokenBucketScript,
         keyspace: KeySpace | None = None,
+        clock: Clock | None = None,
     ):
         self.cache = redis
         self.script = script
         self.keyspace = keyspace
+        self.clock = clock
 
     def create_bucket(
         self, bucket_key: str, max_tokens: int, refill_rate_s: float
@@ -96,4 +143,303 @@ class TokenBucketFactory:
             bucket_key=key_,
             max_tokens=max_tokens,
             refill_rate_s=refill_rate_s,
+            clock=self.clock,
+        )
+
+
+class GCRALimiter:
+    """
+    Generic cell rate algorithm, the same limit as a token bucket of `max_tokens`
+    refilled at `refill_rate_s`, see askgpt/script/gcra.lua.
+
+    each key is a single string holding the time the bucket would be full again,
+    read and written by one script call, the wait time returned is exact.
+    every acquire goes to redis, there are no leases.
+    """
+
+    def __init__(
+        self,
+        redis: RedisCache[str],
+        script: LuaScript,
+        *,
+        max_tokens: int,
+        refill_rate_s: float,
+        keyspace: KeySpace | None = None,
+        clock: Clock | None = None,
+    ):
+        self._redis = redis
+        self._script = script
+        self._max_tokens = max_tokens
+        self._emission_interval = 1 / refill_rate_s
+        self._keyspace = keyspace
+        self._clock = clock
+
+    @property
+    def max_tokens(self) -> int:
+        return self._max_tokens
+
+    def _key(self, key: str) -> str:
+        return self._keyspace(key).key if self._keyspace else key
+
+    async def acquire(self, key: str, cost: int = 1, max_wait: float = 0) -> float:
+        "returns the seconds to wait, the request is admitted when that is no more than `max_wait`"
+        args: list[str | float | int] = [
+            self._emission_interval,
+            self._max_tokens,
+            cost,
+            self._clock() if self._clock else "",
+            max_wait,
+        ]
+        wait_time = await self._script(keys=[self._key(key)], args=args)
+        return float(wait_time)
+
+    @asynccontextmanager
+    async def lifespan(self):
+        try:
+            await self._script.load()
+        except Exception:
+            logger.exception("Failed to preload the gcra script")
+        yield self
+
+
+class ITokenLeaser(ty.Protocol):
+    async def preload(self) -> None: ...
+
+    async def lease(
+        self,
+        key: str,
+        *,
+        max_tokens: int,
+        refill_rate_s: float,
+        want: int,
+        least: int,
+        max_wait: float = 0,
+    ) -> tuple[int, float]: ...
+
+    async def give_back(self, key: str, *, max_tokens: int, tokens: int) -> None: ...
+
+
+class TokenLeaser:
+    """
+    Takes batches of tokens out of token buckets in redis, in a single script call each.
+    """
+
+    def __init__(
+        self,
+        redis: RedisCache[str],
+        lease_script: LuaScript,
+        give_back_script: LuaScript,
+        keyspace: KeySpace | None = None,
+        clock: Clock | None = None,
+    ):
+        self._redis = redis
+        self._lease_script = lease_script
+        self._give_back_script = give_back_script
+        self._keyspace = keyspace
+        self._clock = clock
+
+    def _key(self, key: str) -> str:
+        return self._keyspace(key).key if self._keyspace else key
+
+    async def preload(self) -> None:
+        "load the scripts ahead of the first request, calls fall back to loading them anyway"
+        await self._lease_script.load()
+        await self._give_back_script.load()
+
+    async def lease(
+        self,
+        key: str,
+        *,
+        max_tokens: int,
+        refill_rate_s: float,
+        want: int,
+        least: int,
+        max_wait: float = 0,
+    ) -> tuple[int, float]:
+        """
+        take up to `want` tokens, if at least `least` are available,
+        returns the number of tokens granted and the seconds to wait,
+        when `least` tokens are refilled within `max_wait` they are granted in advance,
+        usable after the wait, otherwise none are.
+        """
+        args: list[str | float | int] = [
+            max_tokens,
+            refill_rate_s,
+            want,
+            least,
+            self._clock() if self._clock else "",
+            max_wait,
+        ]
+        granted, wait_time = await self._lease_script(keys=[self._key(key)], args=args)
+        return int(granted), float(wait_time)
+
+    async def give_back(self, key: str, *, max_tokens: int, tokens: int) -> None:
+        await self._give_back_script(keys=[self._key(key)], args=[max_tokens, tokens])
+
+
+class _Lease:
+    __slots__ = ("tokens", "expires_at")
+
+    def __init__(self, tokens: int, expires_at: float):
+        self.tokens = tokens
+        self.expires_at = expires_at
+
+
+class HybridTokenBucket:
+    """
+    Per key token buckets kept in redis, where each worker holds a local lease
+    of up to `lease_size` tokens per key.
+
+    While a lease lasts admissions are decided in memory,
+    redis is only called when it runs out, so with a lease size of n
+    roughly one request in n pays the round trip.
+
+    Accuracy:
+    - tokens are removed from redis before they are leased, so the limit is never exceeded.
+    - tokens sitting in leases can't be used by other workers,
+      at most `workers * lease_size` per key, and for at most `lease_ttl` seconds.
+      unused tokens of expired leases are given back by `sync`, which runs every `sync_interval`.
+
+    with `strict`, or for limits below `strict_below` tokens,
+    every acquire goes to redis and nothing is held locally.
+    """
+
+    def __init__(
+        self,
+        leaser: ITokenLeaser,
+        *,
+        max_tokens: int,
+        refill_rate_s: float,
+        lease_size: int = 10,
+        lease_ttl: float = 1.0,
+        sync_interval: float = 0.5,
+        strict_below: int = 100,
+        strict: bool = False,
+        clock: ty.Callable[[], float] = time.monotonic,
+    ):
+        self._leaser = leaser
+        self._max_tokens = max_tokens
+        self._refill_rate_s = refill_rate_s
+        self._lease_size = lease_size
+        self._lease_ttl = lease_ttl
+        self._sync_interval = sync_interval
+        self._strict = strict or max_tokens < strict_below or lease_size <= 1
+        self._clock = clock
+        self._leases: dict[str, _Lease] = {}
+        # tokens of expired leases, given back on the next sync
+        self._returns: dict[str, int] = {}
+        self.__main_task: asyncio.Task[ty.Any] | None = None
+
+    @property
+    def max_tokens(self) -> int:
+        return self._max_tokens
+
+    @property
+    def strict(self) -> bool:
+        return self._strict
+
+    def _retire(self, key: str, lease: _Lease) -> None:
+        del self._leases[key]
+        if lease.tokens:
+            self._returns[key] = self._returns.get(key, 0) + lease.tokens
+
+    async def acquire(self, key: str, cost: int = 1, max_wait: float = 0) -> float:
+        """
+        returns the seconds to wait, the request is admitted when that is no more than `max_wait`,
+        tokens of a local lease are available at once, only tokens reserved in redis are waited for.
+        """
+        if self._strict:
+            _, wait_time = await self._leaser.lease(
+                key,
+                max_tokens=self._max_tokens,
+                refill_rate_s=self._refill_rate_s,
+                want=cost,
+                least=cost,
+                max_wait=max_wait,
+            )
+            return wait_time
+
+        now = self._clock()
+        lease = self._leases.get(key)
+        if lease is not None and lease.expires_at <= now:
+            self._retire(key, lease)
+            lease = None
+        if lease is not None and lease.tokens >= cost:
+            lease.tokens -= cost
+            return 0
+
+        held = lease.tokens if lease else 0
+        granted, wait_time = await self._leaser.lease(
+            key,
+            max_tokens=self._max_tokens,
+            refill_rate_s=self._refill_rate_s,
+            want=max(self._lease_size, cost) - held,
+            least=cost - held,
+            max_wait=max_wait,
         )
+        if not granted:
+            return wait_time
+
+        # another acquire of the key might have replaced the lease meanwhile
+        expires_at = self._clock() + self._lease_ttl
+        lease = self._leases.get(key)
+        if lease is None:
+            lease = self._leases[key] = _Lease(0, expires_at)
+        lease.tokens += granted - cost
+        lease.expires_at = expires_at
+        return wait_time
+
+    async def sync(self) -> int:
+        "give unused tokens of expired leases back to redis, returns tokens given back"
+        now = self._clock()
+        for key, lease in list(self._leases.items()):
+            if lease.expires_at <= now:
+                self._retire(key, lease)
+
+        returns, self._returns = self._returns, {}
+        for key, tokens in returns.items():
+            await self._leaser.give_back(key, max_tokens=self._max_tokens, tokens=tokens)
+        return sum(returns.values())
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self._sync_interval)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Failed to give back leased tokens")
+
+    async def start(self):
+        try:
+            await self._leaser.preload()
+        except Exception:
+            logger.exception("Failed to preload token scripts")
+        if self._strict:
+            return
+        if self.__main_task is None or self.__main_task.done():
+            self.__main_task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self.__main_task is not None:
+            self.__main_task.cancel()
+            try:
+                await self.__main_task
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.__main_task = None
+        # leases of this worker would otherwise be lost until the bucket refills
+        for key, lease in list(self._leases.items()):
+            self._retire(key, lease)
+        try:
+            await self.sync()
+        except Exception:
+            logger.exception("Failed to give back leased tokens")
+
+    @asynccontextmanager
+    async def lifespan(self):
+        try:
+            await self.start()
+            yield self
+        finally:
+            await self.stop()
@@ -1,5 +1,5 @@
 import typing as ty
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 
 from fastapi import APIRouter, FastAPI
 from starlette.types import Lifespan
@@ -7,17 +7,39 @@ from starlette.types import Lifespan
 from askgpt.api.bootstrap import bootstrap
 from askgpt.api.error_handlers import handler_registry
 from askgpt.api.middleware import middlewares
+from askgpt.adapters.database import ReplicaSet, SqliteReadPool
+from askgpt.adapters.executor import CPUExecutor
 from askgpt.api.router import feature_router, route_id_factory
+from askgpt.api.throttler import AuthAttemptLimiter, ChatAdmission, StreamLimiter
 from askgpt.domain.config import SETTINGS_CONTEXT, Settings, detect_settings, dg
 from askgpt.helpers._log import logger
 from askgpt.helpers.error_registry import error_route_factory
+from askgpt.infra.archive import EventArchiver
+from askgpt.infra.eventstore import EventStore
+from askgpt.infra.segmentstore import SegmentEventStore
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI | None = None):
     settings = SETTINGS_CONTEXT.get()
     await bootstrap(settings)
-    async with dg:
+    async with dg, AsyncExitStack() as stack:
+        if settings.db.REPLICA_URLS:
+            replicas = dg.resolve(ReplicaSet)
+            await stack.enter_async_context(replicas.lifespan())
+        if settings.db.SQLITE_SINGLE_WRITER:
+            stack.push_async_callback(dg.resolve(SqliteReadPool).close)
+        if settings.event_record.BACKEND == "segments":
+            segments = ty.cast(SegmentEventStore, dg.resolve(EventStore))
+            stack.push_async_callback(segments.close)
+        elif settings.event_record.ARCHIVE_IDLE_DAYS:
+            archiver = dg.resolve(EventArchiver)
+            await stack.enter_async_context(archiver.lifespan())
+        admission = dg.resolve(ChatAdmission)
+        await stack.enter_async_context(admission.lifespan())
+        await stack.enter_async_context(dg.resolve(StreamLimiter).lifespan())
+        await stack.enter_async_context(dg.resolve(AuthAttemptLimiter).lifespan())
+        await stack.enter_async_context(dg.resolve(CPUExecutor).lifespan())
         yield
 
 
@@ -1,3 +1,4 @@
+import math
 import typing as ty
 
 from fastapi import Request
@@ -5,10 +6,11 @@ from fastapi.responses import JSONResponse
 from starlette import status
 from starlette.responses import Response
 
-from askgpt.api.errors import QuotaExceededError
+from askgpt.api.errors import QuotaExceededError, ThrottlingError
 from askgpt.api.xheaders import XHeaders
 from askgpt.app.auth._errors import (
     AuthenticationError,
+    PermissionDeniedError,
     UserAlreadyExistError,
     UserNotFoundError,
 )
@@ -19,7 +21,7 @@ from askgpt.app.gpt._errors import (
     OpenAIRequestError,
     OrphanSessionError,
 )
-from askgpt.domain.errors import EntityNotFoundError, GeneralWebError
+from askgpt.domain.errors import EntityNotFoundError, GeneralWebError, ServerBusyError
 from askgpt.helpers.error_registry import ErrorDetail, HandlerRegistry
 
 handler_registry: ty.Final[HandlerRegistry] = HandlerRegistry()
@@ -95,6 +97,15 @@ def _(request: Request, exc: AuthenticationError) -> ErrorResponse:
     )
 
 
+@handler_registry.register
+def _(request: Request, exc: PermissionDeniedError) -> ErrorResponse:
+    return make_err_response(
+        request=request,
+        error_detail=exc.error_detail,
+        code=status.HTTP_403_FORBIDDEN,
+    )
+
+
 @handler_registry.register
 def _(request: Request, exc: UserNotFoundError) -> ErrorResponse:
     return make_err_response(
@@ -161,12 +172,33 @@ def _(request: Request, exc: APIKeyNotAvailableError) -> ErrorResponse:
     )
 
 
+@handler_registry.register
+def _(request: Request, exc: ServerBusyError) -> ErrorResponse:
+    return make_err_response(
+        request=request,
+        code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        error_detail=exc.error_detail,
+        headers={"Retry-After": "1"},
+    )
+
+
+@handler_registry.register
+def _(request: Request, exc: ThrottlingError) -> ErrorResponse:
+    return make_err_response(
+        request=request,
+        code=status.HTTP_429_TOO_MANY_REQUESTS,
+        error_detail=exc.error_detail,
+    )
+
+
 @handler_registry.register
 def _(request: Request, exc: QuotaExceededError) -> ErrorResponse:
     return make_err_response(
         request=request,
         code=status.HTTP_429_TOO_MANY_REQUESTS,
         error_detail=exc.error_detail,
+        # whole seconds, rounded up so a retry is not rejected again
+        headers={"Retry-After": str(math.ceil(exc.wait_time))},
     )
 
 
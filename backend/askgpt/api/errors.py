@@ -14,3 +14,13 @@ class QuotaExceededError(ThrottlingError):
         super().__init__(
             f"Quota exceeded, next request available in {wait_time} seconds"
         )
+
+
+class ConcurrentStreamsExceededError(ThrottlingError):
+    "Too many concurrent streams"
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        super().__init__(
+            f"Too many concurrent streams, at most {limit} can be open at once"
+        )
@@ -1,8 +1,14 @@
+import json
 import typing as ty
 from time import perf_counter
+from urllib.parse import parse_qs
 
+from askgpt.adapters.admission import Violation
+from askgpt.api.error_handlers import handler_registry
+from askgpt.api.errors import QuotaExceededError
+from askgpt.api.throttler import AuthAttemptLimiter
 from askgpt.api.xheaders import XHeaders
-from askgpt.domain.config import TIME_EPSILON_S, Settings
+from askgpt.domain.config import TIME_EPSILON_S, Settings, dg
 from askgpt.domain.model.base import request_id_factory
 from askgpt.helpers._log import log_request, logger
 from fastapi import Request
@@ -15,7 +21,7 @@ from starlette.middleware.base import (
     _StreamingResponse as StreamingResponse,  # type: ignore
 )
 from starlette.middleware.cors import CORSMiddleware as CORSMiddleware
-from starlette.types import ASGIApp, Receive, Scope, Send
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 
 class TraceMiddleware:
@@ -38,6 +44,120 @@ class TraceMiddleware:
         await self.app(scope, receive, send)
 
 
+def _body_email(scope: Scope, body: bytes) -> str:
+    "the email of a login form or a signup body, empty when there is none"
+    content_type = dict(scope["headers"]).get(b"content-type", b"")
+    try:
+        if content_type.startswith(b"application/x-www-form-urlencoded"):
+            email = parse_qs(body.decode()).get("username", [""])[0]
+        else:
+            email = json.loads(body).get("email", "")
+    except (ValueError, AttributeError):
+        return ""
+    return email.strip().lower() if isinstance(email, str) else ""
+
+
+class PreAuthMiddleware:
+    """
+    Throttles the endpoints that hash passwords before they parse their body:
+    by client ip before the body is read, then by the email it carries,
+    failed logins lock the ip and the email out, see AuthAttemptLimiter.
+
+    the client ip is the peer of the connection,
+    behind a proxy run uvicorn with --forwarded-allow-ips so it is the real client.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        login_path: str,
+        signup_path: str,
+        max_body_size: int,
+        limiter: AuthAttemptLimiter | None = None,
+    ):
+        self.app = app
+        self._login_path = login_path
+        self._paths = {login_path, signup_path}
+        self._max_body_size = max_body_size
+        # resolved by dg when not given
+        self._limiter = limiter
+
+    async def _reject(
+        self,
+        limiter: AuthAttemptLimiter,
+        violation: Violation,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+    ):
+        exc = QuotaExceededError(limiter.quota(violation.limit), violation.wait_time)
+        handler = handler_registry.handlers[QuotaExceededError]
+        response = ty.cast(Response, handler(Request(scope), exc))
+        await response(scope, receive, send)
+
+    async def _read_body(self, receive: Receive) -> tuple[list[Message], bytes | None]:
+        "messages read, and the body unless it is larger than max_body_size"
+        messages: list[Message] = []
+        size = 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                return messages, None
+            size += len(message.get("body", b""))
+            if size > self._max_body_size:
+                return messages, None
+            if not message.get("more_body", False):
+                return messages, b"".join(m.get("body", b"") for m in messages)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] not in self._paths
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self._limiter or dg.resolve(AuthAttemptLimiter)
+        ip = scope["client"][0] if scope.get("client") else ""
+        if violation := await limiter.check_ip(ip):
+            await self._reject(limiter, violation, scope, receive, send)
+            return
+
+        messages, body = await self._read_body(receive)
+        email = _body_email(scope, body) if body is not None else ""
+        if email and (violation := await limiter.check_email(email)):
+            await self._reject(limiter, violation, scope, receive, send)
+            return
+
+        async def replay() -> Message:
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        status_code = 0
+
+        async def send_status(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        await self.app(scope, replay, send_status)
+
+        if scope["path"] != self._login_path:
+            return
+        try:
+            if status_code in (401, 404):
+                await limiter.failed(ip, email)
+            elif status_code == 200 and email:
+                await limiter.succeeded(email)
+        except Exception:
+            logger.exception("Failed to record a login attempt")
+
+
 class LoggingMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next: RequestResponseEndpoint):
         request_id = request.headers[XHeaders.REQUEST_ID.value]
@@ -116,9 +236,21 @@ def middlewares(*, settings: Settings) -> list[Middleware]:
             allow_credentials=True,
             allow_methods=["*"],
             allow_headers=["*"],
+            expose_headers=[
+                XHeaders.NEXT_CURSOR.value,
+                XHeaders.TOTAL_COUNT.value,
+                "Retry-After",
+            ],
         ),
         Middleware(ErrorResponseMiddleWare),
         Middleware(TraceMiddleware),
+        # ahead of LoggingMiddleware, which reads the body of every request
+        Middleware(
+            PreAuthMiddleware,
+            login_path=f"{settings.api.API_VERSION_STR}/auth/login",
+            signup_path=f"{settings.api.API_VERSION_STR}/auth/signup",
+            max_body_size=settings.throttling.pre_auth.MAX_BODY_SIZE,
+        ),
         Middleware(LoggingMiddleware),
     ]
     return middlewares
@@ -1,8 +1,14 @@
+import typing as ty
+
 from askgpt.api.model import EmptyResponse
-from askgpt.app.auth.api import auth_router
+from askgpt.app.auth.api import auth_router, require_admin
+from askgpt.app.auth_factory import dg
 from askgpt.app.gpt.api import gpt_router, sessions
 from askgpt.app.user.api import user_router
-from fastapi import APIRouter
+from askgpt.helpers._log import logger
+from askgpt.helpers.metrics import metrics
+from askgpt.helpers.sql import UnitOfWork
+from fastapi import APIRouter, Depends
 from fastapi.routing import APIRoute
 
 
@@ -11,18 +17,42 @@ def route_id_factory(route: APIRoute):
     return f"{route_tag}-{route.name}"
 
 
+async def request_uow() -> ty.AsyncGenerator[UnitOfWork, None]:
+    """
+    Every uow.trans() of a request shares one connection.
+    exits before a streaming response is sent, so streams don't hold a pooled connection.
+    """
+    uow = dg.resolve(UnitOfWork)
+    async with uow.scope() as stats:
+        yield uow
+    if stats.checkouts:
+        logger.debug(f"db usage: {stats}")
+
+
 def health_check():
     return EmptyResponse.OK
 
 
+def metrics_snapshot() -> dict[str, ty.Any]:
+    return metrics.snapshot()
+
+
 health_router = APIRouter(prefix="/health")
 health_router.get("/")(health_check)
+# pool and executor internals, admins only
+health_router.get("/metrics", dependencies=[Depends(require_admin)])(metrics_snapshot)
 
 # include sub routers
 gpt_router.include_router(sessions, tags=["sessions"])
 
 feature_router = APIRouter()
 feature_router.include_router(health_router, tags=["health"])
-feature_router.include_router(auth_router, tags=["auth"])
-feature_router.include_router(user_router, tags=["user"])
-feature_router.include_router(gpt_router, tags=["gpt"])
+feature_router.include_router(
+    auth_router, tags=["auth"], dependencies=[Depends(request_uow)]
+)
+feature_router.include_router(
+    user_router, tags=["user"], dependencies=[Depends(request_uow)]
+)
+feature_router.include_router(
+    gpt_router, tags=["gpt"], dependencies=[Depends(request_uow)]
+)
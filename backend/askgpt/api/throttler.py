@@ -1,28 +1,351 @@
-from askgpt.adapters.tokenbucket import TokenBucketFactory
+import asyncio
+import ipaddress
+import math
+import typing as ty
+from contextlib import AsyncExitStack, asynccontextmanager
+
+from askgpt.adapters.admission import AdmissionController, Violation
+from askgpt.adapters.cache import KeySpace, RedisCache
+from askgpt.adapters.semaphore import DistributedSemaphore
+from askgpt.adapters.tokenbucket import KeyedLimiter
+from askgpt.api.errors import ConcurrentStreamsExceededError, QuotaExceededError
+from askgpt.helpers._log import logger
 
 # NOTE: we probably need a throttler manager class
 
+# the violation of USER_MAX_REQUEST_PER_MINUTE
+USER_REQUESTS = "user_requests"
+
+type LimitScope = ty.Literal["user", "model"]
+type LimitUnit = ty.Literal["request", "token"]
+
 
 # TODO: make this easier to access
 class UserRequestThrottler:
+    """
+    limits chat requests per user, one bucket per user shared by every worker,
+    a HybridTokenBucket or a GCRALimiter, see Settings.Throttling.ALGORITHM.
+    """
+
+    def __init__(self, bucket: KeyedLimiter):
+        self._bucket = bucket
+
+    @property
+    def max_tokens(self) -> int:
+        return self._bucket.max_tokens
+
+    @property
+    def bucket(self) -> KeyedLimiter:
+        return self._bucket
+
+    async def validate(self, user_id: str, max_wait: float = 0) -> float:
+        "the request is admitted when the returned wait is no more than `max_wait`"
+        return await self._bucket.acquire(user_id, 1, max_wait)
+
+
+class ChatAdmission:
+    """
+    admission of chat requests.
+
+    the requests per user, every request limit of Settings.Throttling.LIMITS and,
+    with `token_key`, the access token are checked in a single redis call,
+    see AdmissionController. limits are given as (scope, unit) in the order of the controller's,
+    the first one being the requests per user.
+
+    with no limit but the requests per user and no token check,
+    requests are only checked by `throttler`, which can admit them from local leases.
+
+    token limits are charged once the prompt is known, see `reserve`,
+    and settled with the tokens the completion actually used, see `settle`.
+
+    waits up to `max_wait` are absorbed instead of rejected: the tokens are reserved
+    and the request sleeps until they are refilled. reservations are served in the order
+    they are made, and a user can't have more than `max_waiting` requests of a worker
+    waiting at once, further ones are only admitted without a wait.
+    """
+
     def __init__(
         self,
-        bucket_factory: TokenBucketFactory,
-        max_requests: int,
-        refill_duration_s: int,
+        throttler: UserRequestThrottler,
+        controller: AdmissionController,
+        limits: ty.Sequence[tuple[LimitScope, LimitUnit]],
+        *,
+        token_key: ty.Callable[[str], str] | None = None,
+        max_wait: float = 0,
+        max_waiting: int = 0,
     ):
-        self._bucket_factory = bucket_factory
-        self._max_tokens = max_requests
-        self._refill_rate = max_requests / refill_duration_s
+        self._throttler = throttler
+        self._controller = controller
+        self._limits = tuple(limits)
+        self._token_key = token_key
+        self._max_wait = max_wait
+        self._max_waiting = max_waiting
+        self._quotas = {limit.name: limit.max_tokens for limit in controller.limits}
+        # requests of each user waiting for their reservation
+        self._waiting: dict[str, int] = {}
 
     @property
-    def max_tokens(self) -> int:
-        return self._max_tokens
+    def combined(self) -> bool:
+        return len(self._limits) > 1 or self._token_key is not None
+
+    @property
+    def meters_tokens(self) -> bool:
+        return any(unit == "token" for _, unit in self._limits)
+
+    def quota(self, limit: str) -> int:
+        return self._quotas.get(limit, self._throttler.max_tokens)
+
+    def _subjects(self, user_id: str, model: str) -> list[str]:
+        return [user_id if scope == "user" else model for scope, _ in self._limits]
+
+    def _costs(self, unit: LimitUnit, cost: int) -> list[int]:
+        return [cost if unit_ == unit else 0 for _, unit_ in self._limits]
+
+    @asynccontextmanager
+    async def _queue(self, user_id: str):
+        "yields how long the request may wait, a place in the queue is held meanwhile"
+        waiting = self._waiting.get(user_id, 0)
+        if waiting >= self._max_waiting:
+            yield 0
+            return
+        self._waiting[user_id] = waiting + 1
+        try:
+            yield self._max_wait
+        finally:
+            if (waiting := self._waiting.pop(user_id) - 1) > 0:
+                self._waiting[user_id] = waiting
 
-    async def validate(self, user_id: str) -> float:
-        bucket = self._bucket_factory.create_bucket(
-            bucket_key=user_id,
-            max_tokens=self._max_tokens,
-            refill_rate_s=self._refill_rate,
+    async def _admit(
+        self, user_id: str, model: str, access_token: str, max_wait: float
+    ) -> tuple[Violation | None, float]:
+        if not self.combined:
+            wait_time = await self._throttler.validate(user_id, max_wait)
+            if wait_time > max_wait:
+                return Violation(USER_REQUESTS, wait_time), wait_time
+            return None, wait_time
+
+        subjects, costs = self._subjects(user_id, model), self._costs("request", 1)
+        if self._token_key is None:
+            return await self._controller.admit(subjects, costs, max_wait=max_wait)
+        return await self._controller.admit(
+            subjects,
+            costs,
+            token_key=self._token_key(user_id),
+            token=access_token,
+            max_wait=max_wait,
         )
-        return await bucket.acquire(1)
+
+    async def validate(
+        self, user_id: str, *, model: str, access_token: str
+    ) -> Violation | None:
+        "returns the first limit violated, None once admitted, after a wait if any"
+        async with self._queue(user_id) as max_wait:
+            violation, wait_time = await self._admit(
+                user_id, model, access_token, max_wait
+            )
+            if violation is None and wait_time:
+                await asyncio.sleep(wait_time)
+        return violation
+
+    async def reserve(self, user_id: str, model: str, tokens: int) -> None:
+        "charge the estimated tokens of a completion to the token limits"
+        if not self.meters_tokens:
+            return
+        async with self._queue(user_id) as max_wait:
+            violation, wait_time = await self._controller.admit(
+                self._subjects(user_id, model),
+                self._costs("token", tokens),
+                max_wait=max_wait,
+            )
+            if violation:
+                raise QuotaExceededError(
+                    self.quota(violation.limit), violation.wait_time
+                )
+            if wait_time:
+                await asyncio.sleep(wait_time)
+
+    async def settle(self, user_id: str, model: str, reserved: int, used: int) -> None:
+        "charge the tokens used beyond the reservation, or give back the unused ones"
+        if not self.meters_tokens or used == reserved:
+            return
+        await self._controller.adjust(
+            self._subjects(user_id, model), self._costs("token", used - reserved)
+        )
+
+    @asynccontextmanager
+    async def lifespan(self):
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(self._throttler.bucket.lifespan())
+            if self.combined:
+                await stack.enter_async_context(self._controller.lifespan())
+            yield self
+
+
+class StreamLimiter:
+    """
+    caps the streams a user has open at once, by the role of the user,
+    see Settings.Throttling.MAX_STREAMS_PER_ROLE, roles without a limit are not capped.
+
+    a slot is a lease of a DistributedSemaphore shared by every worker,
+    released once the stream ends or its client disconnects, or when it expires
+    after its worker crashed.
+    """
+
+    def __init__(self, semaphore: DistributedSemaphore, limits: ty.Mapping[str, int]):
+        self._semaphore = semaphore
+        self._limits = dict(limits)
+
+    def limit(self, role: str) -> int | None:
+        return self._limits.get(role)
+
+    async def acquire(
+        self, user_id: str, role: str
+    ) -> ty.Callable[[], ty.Awaitable[None]]:
+        "returns the release of the slot taken, raises when the user has no slot left"
+        limit = self.limit(role)
+        if limit is None:
+            return _nothing_to_release
+        lease_id = await self._semaphore.acquire(user_id, limit)
+        if lease_id is None:
+            raise ConcurrentStreamsExceededError(limit)
+
+        async def release() -> None:
+            try:
+                await self._semaphore.release(user_id, lease_id)
+            except Exception:
+                # the lease is no longer renewed, it expires instead
+                logger.exception("Failed to release a stream slot")
+
+        return release
+
+    @asynccontextmanager
+    async def lifespan(self):
+        if not self._limits:
+            yield self
+            return
+        async with self._semaphore.lifespan():
+            yield self
+
+
+async def _nothing_to_release() -> None: ...
+
+
+class AuthAttemptLimiter:
+    """
+    limits attempts at the unauthenticated endpoints that hash passwords,
+    by client ip and by email, see PreAuthMiddleware.
+
+    attempts are checked by a gcra bucket per ip and one per email, with AdmissionController,
+    whose limits are the ones of the ip then the email.
+
+    failed logins are counted per ip and per email until `failure_window` seconds pass
+    without one. from `lockout_threshold` failures on, the subject is locked out for
+    `lockout_base` seconds, doubled by every further failure up to `lockout_max`.
+    a lockout sets the bucket of the subject to owe a full bucket plus the lockout from now,
+    so it is enforced by the same check and answered with its Retry-After,
+    earlier lockouts are not added to it.
+
+    ips in `allow_networks` and emails in `allow_emails` are never limited.
+    """
+
+    def __init__(
+        self,
+        redis: RedisCache[str],
+        controller: AdmissionController,
+        failures: KeySpace,
+        *,
+        lockout_threshold: int = 5,
+        lockout_base: float = 30,
+        lockout_max: float = 3600,
+        failure_window: float = 3600,
+        allow_networks: ty.Sequence[str] = (),
+        allow_emails: ty.Sequence[str] = (),
+    ):
+        self._redis = redis
+        self._controller = controller
+        self._failures = failures
+        self._lockout_threshold = lockout_threshold
+        self._lockout_base = lockout_base
+        self._lockout_max = lockout_max
+        self._failure_window = failure_window
+        self._allow_networks = [ipaddress.ip_network(n) for n in allow_networks]
+        self._allow_emails = {email.lower() for email in allow_emails}
+        self._quotas = {limit.name: limit.max_tokens for limit in controller.limits}
+
+    def quota(self, limit: str) -> int:
+        return self._quotas[limit]
+
+    def allows_ip(self, ip: str) -> bool:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return any(address in network for network in self._allow_networks)
+
+    def allows_email(self, email: str) -> bool:
+        return email in self._allow_emails
+
+    def lockout(self, failures: int) -> float:
+        "seconds a subject with `failures` failed logins is locked out for"
+        if failures < self._lockout_threshold:
+            return 0
+        # capped so the power can't overflow a float
+        doublings = min(failures - self._lockout_threshold, 64)
+        return min(self._lockout_base * 2.0**doublings, self._lockout_max)
+
+    async def check_ip(self, ip: str) -> Violation | None:
+        if self.allows_ip(ip):
+            return None
+        violation, _ = await self._controller.admit([ip, ""], [1, 0])
+        return violation
+
+    async def check_email(self, email: str) -> Violation | None:
+        if self.allows_email(email):
+            return None
+        violation, _ = await self._controller.admit(["", email], [0, 1])
+        return violation
+
+    def _failure_key(self, kind: str, subject: str) -> str:
+        return (self._failures / kind)(subject).key
+
+    async def failed(self, ip: str, email: str) -> None:
+        "count a failed login, locks out the ip or the email past the threshold"
+        subjects = [
+            "" if self.allows_ip(ip) else ip,
+            "" if not email or self.allows_email(email) else email,
+        ]
+        counted = [
+            (kind, subject)
+            for kind, subject in zip(("ip", "email"), subjects)
+            if subject
+        ]
+        if not counted:
+            return
+        window_ms = math.ceil(self._failure_window * 1000)
+        async with self._redis.pipeline() as pipe:
+            for kind, subject in counted:
+                key = self._failure_key(kind, subject)
+                pipe.incr(key)
+                pipe.pexpire(key, window_ms)
+            results = await pipe.execute()
+
+        failures = dict(zip((kind for kind, _ in counted), results[::2]))
+        locks: list[int] = []
+        for kind, limit in zip(("ip", "email"), self._controller.limits):
+            lockout = self.lockout(failures.get(kind, 0))
+            # a full bucket plus the lockout, its wait is then the lockout
+            locks.append(
+                limit.max_tokens + math.ceil(lockout * limit.refill_rate_s)
+                if lockout
+                else 0
+            )
+        await self._controller.adjust(subjects, locks, from_now=True)
+
+    async def succeeded(self, email: str) -> None:
+        "failures of the ip are kept, a valid account of its own does not clear them"
+        await self._redis.client.delete(self._failure_key("email", email))
+
+    @asynccontextmanager
+    async def lifespan(self):
+        async with self._controller.lifespan():
+            yield self
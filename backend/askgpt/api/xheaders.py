@@ -5,6 +5,8 @@ class XHeaders(StrEnum):
     REQUEST_ID = "X-Request-ID"
     ERROR = "X-Error"
     PROCESS_TIME = "X-Process-Time"
+    NEXT_CURSOR = "X-Next-Cursor"
+    TOTAL_COUNT = "X-Total-Count"
 
     @property
     def encoded(self) -> bytes:
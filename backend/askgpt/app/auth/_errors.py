@@ -88,3 +88,13 @@ class DuplicatedAPIKeyError(AuthenticationError):
     def __init__(self, *, api_type: str):
         msg = f"same api key already exist for {api_type}"
         super().__init__(msg)
+
+
+class PermissionDeniedError(AuthenticationError):
+    """
+    User is not allowed to access the resource
+    """
+
+    def __init__(self, *, user_id: str, resource: str):
+        msg = f"user {user_id} is not allowed to access {resource}"
+        super().__init__(msg)
@@ -3,13 +3,15 @@ import typing as ty
 from askgpt.api.model import EmptyResponse, RequestBody, ResponseData
 from askgpt.app.auth_factory import AuthService, dg
 from askgpt.domain.types import SupportedGPTs
+from askgpt.helpers.sql import UnitOfWork
 from askgpt.helpers.string import EMPTY_STR
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 from fastapi.responses import RedirectResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import EmailStr
 
-from ._model import AccessToken, UserAuth
+from ._errors import PermissionDeniedError
+from ._model import AccessToken, UserAuth, UserRoles
 
 auth_router = APIRouter(prefix="/auth")
 
@@ -19,13 +21,24 @@ LoginForm = ty.Annotated[OAuth2PasswordRequestForm, Depends()]
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
 
-def parse_access_token(
+async def parse_access_token(
     service: Service, token: str = Depends(oauth2_scheme)
 ) -> AccessToken:
-    return service.decrypt_access_token(token)
+    access_token = await service.verify_access_token(token)
+    # replica reads of the request see the user's own recent writes
+    dg.resolve(UnitOfWork).track(access_token.sub)
+    return access_token
 
 
 ParsedToken = ty.Annotated[AccessToken, Depends(parse_access_token)]
+# the encoded access token, as registered in TokenRegistry
+BearerToken = ty.Annotated[str, Depends(oauth2_scheme)]
+
+
+def require_admin(request: Request, token: ParsedToken) -> AccessToken:
+    if token.role != UserRoles.admin:
+        raise PermissionDeniedError(user_id=token.sub, resource=request.url.path)
+    return token
 
 
 class TokenResponse(ResponseData):
@@ -54,6 +67,13 @@ async def login(service: Service, login_form: LoginForm) -> TokenResponse:
     return TokenResponse(access_token=token)
 
 
+@auth_router.post("/logout", status_code=200)
+async def logout(service: Service, token: ParsedToken):
+    "revoke every access token of the user, other devices have to login again"
+    await service.logout(token.sub)
+    return EmptyResponse.OK
+
+
 class SignUp(RequestBody):
     user_name: str = EMPTY_STR
     email: EmailStr
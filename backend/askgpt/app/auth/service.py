@@ -1,9 +1,15 @@
+import hashlib
+import math
+import time
+import typing as ty
+from collections import OrderedDict
 from datetime import timedelta
 
 from jose.exceptions import JWTError
 from pydantic import ValidationError
 
 from askgpt.adapters.cache import Cache, KeySpace
+from askgpt.adapters.executor import CPUExecutor
 from askgpt.domain.config import Settings
 from askgpt.domain.model.base import utc_now, uuid_factory
 from askgpt.infra import security
@@ -19,6 +25,7 @@ from ._errors import (
 )
 from ._model import (
     AccessToken,
+    UserAPIKey,
     UserAPIKeyAdded,
     UserAuth,
     UserCredential,
@@ -33,26 +40,131 @@ def partial_secret(key: str, secret_len: int = 3) -> str:
     return key[:secret_len] + ("*" * (len(key) - secret_len))
 
 
+class VerifiedTokenCache:
+    """
+    LRU of access tokens whose signature and claims were verified,
+    keyed by the sha256 of the encoded token, so the same token is decoded once
+    rather than on every request.
+
+    a token is kept until it expires, and for no more than `max_age` seconds,
+    tokens of a user are dropped at once when TokenRegistry revokes them in this process,
+    other processes keep them cached but reject them, see AuthService.verify_access_token.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10_000,
+        max_age: float = 60,
+        clock: ty.Callable[[], float] = time.time,
+    ):
+        self._max_size = max_size
+        self._max_age = max_age
+        self._clock = clock
+        # token hash: (access token, expiry in seconds since epoch)
+        self._data: OrderedDict[bytes, tuple[AccessToken, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> AccessToken | None:
+        key = self._key(token)
+        if (cached := self._data.get(key)) is None:
+            return None
+        access_token, expires_at = cached
+        if expires_at <= self._clock():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return access_token
+
+    def set(self, token: str, access_token: AccessToken) -> None:
+        if self._max_size <= 0:
+            return
+        key = self._key(token)
+        expires_at = min(access_token.exp.timestamp(), self._clock() + self._max_age)
+        self._data[key] = (access_token, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def invalidate_user(self, user_id: str) -> None:
+        "revocations are rare, the scan is cheaper than an index kept on every request"
+        revoked = [
+            key for key, (token, _) in self._data.items() if token.sub == user_id
+        ]
+        for key in revoked:
+            del self._data[key]
+
+
 class TokenRegistry:
     """
     a registry for access-token, validated by redis
+
+    tokens of a user are kept in a sorted set scored by their expiry,
+    expired ones are pruned whenever a token is added, and the set expires with the last of them.
+    tokens are only registered when `checked`, see Settings.Throttling.CHECK_TOKEN
+
+    revoking the tokens of a user also records when, as a revocation epoch shared by every process,
+    tokens issued before it are rejected until they would have expired anyway.
     """
 
-    def __init__(self, token_cache: Cache[str, str], keyspace: KeySpace):
+    def __init__(
+        self,
+        token_cache: Cache[str, str],
+        keyspace: KeySpace,
+        verified: VerifiedTokenCache | None = None,
+        *,
+        token_ttl: float = 30 * 60,
+        checked: bool = True,
+        clock: ty.Callable[[], float] = time.time,
+    ):
         self._cache = token_cache
         self._keyspace = keyspace
+        self._verified = verified
+        self._token_ttl = token_ttl
+        self._checked = checked
+        self._clock = clock
+
+    @property
+    def verified(self) -> VerifiedTokenCache | None:
+        "tokens verified by this process, see AuthService.decrypt_access_token"
+        return self._verified
 
     def token_key_by(self, user_id: str) -> str:
         return self._keyspace(user_id).key
 
+    def revocation_key_by(self, user_id: str) -> str:
+        return (self._keyspace / "revoked")(user_id).key
+
     async def is_token_valid(self, user_id: str, token: str) -> bool:
-        return await self._cache.sismember(self.token_key_by(user_id), token)
+        expires_at = await self._cache.zscore(self.token_key_by(user_id), token)
+        return expires_at is not None and expires_at > self._clock()
 
     async def register_token(self, user_id: str, token: str) -> None:
-        await self._cache.sadd(self.token_key_by(user_id), token)
-
-    async def revoke_tokens(self, user_id: str, token: str) -> None:
-        await self._cache.remove(user_id)
+        if not self._checked:
+            return
+        key = self.token_key_by(user_id)
+        now = self._clock()
+        await self._cache.zremrangebyscore(key, float("-inf"), now)
+        await self._cache.zadd(key, {token: now + self._token_ttl})
+        await self._cache.expire(key, math.ceil(self._token_ttl))
+
+    async def is_revoked(self, token: AccessToken) -> bool:
+        "iat only has seconds, tokens issued within the second of a revocation are revoked too"
+        epoch = await self._cache.get(self.revocation_key_by(token.sub))
+        return epoch is not None and token.iat.timestamp() <= float(epoch)
+
+    async def revoke_tokens(self, user_id: str) -> None:
+        key = self.revocation_key_by(user_id)
+        await self._cache.set(key, str(self._clock()))
+        await self._cache.expire(key, math.ceil(self._token_ttl))
+        await self._cache.remove(self.token_key_by(user_id))
+        if self._verified is not None:
+            self._verified.invalidate_user(user_id)
 
 
 class AuthService:
@@ -63,6 +175,7 @@ class AuthService:
         encryptor: security.Encryptor,
         eventstore: EventStore,
         security_settings: Settings.Security,
+        executor: CPUExecutor | None = None,
     ):
         self._uow = auth_repo.uow
         self._auth_repo = auth_repo
@@ -70,6 +183,15 @@ class AuthService:
         self._encryptor = encryptor
         self._eventstore = eventstore
         self._security_settings = security_settings
+        self._executor = executor
+
+    async def _offload[**P, R](
+        self, func: ty.Callable[P, R], *args: P.args, **kwargs: P.kwargs
+    ) -> R:
+        "run cpu bound work, e.g. bcrypt, on the executor, inline without one"
+        if self._executor is None:
+            return func(*args, **kwargs)
+        return await self._executor.run(func, *args, **kwargs)
 
     def _create_access_token(self, user_id: str, user_role: UserRoles) -> str:
         # TODO: create a separate infra <TokenEncrypt> for this
@@ -88,13 +210,26 @@ class AuthService:
         return self._encryptor.encrypt_jwt(token)
 
     def decrypt_access_token(self, token: str) -> AccessToken:
+        verified = self._token_registry.verified
+        if verified is not None and (access_token := verified.get(token)):
+            return access_token
         try:
             token_dict = self._encryptor.decrypt_jwt(token)
-            return AccessToken.model_validate(token_dict)
+            access_token = AccessToken.model_validate(token_dict)
         except (JWTError, ValidationError) as e:
             raise InvalidCredentialError(
                 "Your access token is invalid, check for expiry"
             ) from e
+        if verified is not None:
+            verified.set(token, access_token)
+        return access_token
+
+    async def verify_access_token(self, token: str) -> AccessToken:
+        "decrypt the token and reject it when its user's tokens were revoked since"
+        access_token = self.decrypt_access_token(token)
+        if await self._token_registry.is_revoked(access_token):
+            raise InvalidCredentialError("Your access token is revoked, login again")
+        return access_token
 
     async def signup_user(self, user_name: str, email: str, password: str) -> None:
         async with self._uow.trans():
@@ -102,7 +237,7 @@ class AuthService:
             if user is not None:
                 raise UserAlreadyExistError(email=email)
 
-        hash_password = security.hash_password(password.encode())
+        hash_password = await self._offload(security.hash_password, password.encode())
         user_info = UserCredential(
             user_name=user_name, user_email=email, hash_password=hash_password
         )
@@ -126,7 +261,7 @@ class AuthService:
         if user is None:
             raise UserNotFoundError(user_id=email)
 
-        if not user.credential.verify_password(password):
+        if not await self._offload(user.credential.verify_password, password):
             raise InvalidPasswordError("Invalid password")
 
         if not user.is_active:
@@ -137,11 +272,16 @@ class AuthService:
             await self._auth_repo.update_last_login(user.entity_id, user.last_login)
 
         access_token = self._create_access_token(user.entity_id, user.role)
+        await self._token_registry.register_token(user.entity_id, access_token)
         return access_token
 
+    async def logout(self, user_id: str) -> None:
+        "revoke every access token of the user, in every process"
+        await self._token_registry.revoke_tokens(user_id)
+
     async def get_current_user(self, token: AccessToken) -> UserAuth:
         user_id = token.sub
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             user = await self._auth_repo.get(user_id)
         if not user:
             raise UserNotFoundError(user_id=user_id)
@@ -156,11 +296,12 @@ class AuthService:
             user.apply(e)
             await self._auth_repo.remove(user.entity_id)
             await self._eventstore.add(e)
+        await self._token_registry.revoke_tokens(user_id)
 
     async def add_api_key(
         self, user_id: str, api_key: str, api_type: str, key_name: str
     ) -> None:
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             user = await self._auth_repo.get(user_id)
             if user is None:
                 raise UserNotFoundError(user_id=user_id)
@@ -188,20 +329,26 @@ class AuthService:
     async def list_api_keys(
         self, user_id: str, api_type: str | None, as_secret: bool
     ) -> tuple[tuple[str, str, str], ...]:
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             encrypted_keys = await self._auth_repo.get_api_keys_for_user(
                 user_id=user_id, api_type=api_type
             )
-        public_api_keys = tuple(
-            (name, type, self._encryptor.decrypt_string(key.encode()))
-            for name, type, key in encrypted_keys
-        )
+        # one call for all keys, each decrypt is too short to be worth a thread hop
+        public_api_keys = await self._offload(self._decrypt_keys, encrypted_keys)
         if as_secret:
             return tuple(
                 (name, type, partial_secret(key)) for name, type, key in public_api_keys
             )
         return public_api_keys
 
+    def _decrypt_keys(
+        self, encrypted_keys: ty.Iterable[UserAPIKey]
+    ) -> tuple[tuple[str, str, str], ...]:
+        return tuple(
+            (name, type, self._encryptor.decrypt_string(key.encode()))
+            for name, type, key in encrypted_keys
+        )
+
     async def remove_api_key(self, user_id: str, key_name: str) -> int:
         async with self._uow.trans():
             return await self._auth_repo.remove_api_key_for_user(user_id, key_name)
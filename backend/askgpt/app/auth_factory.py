@@ -1,31 +1,61 @@
+import math
+import typing as ty
+
+from askgpt.adapters.admission import AdmissionController, Limit
 from askgpt.adapters.cache import Cache, RedisCache
-from askgpt.adapters.database import AsyncDatabase
+from askgpt.adapters.executor import CPUExecutor
+from askgpt.adapters.database import (
+    AsyncDatabase,
+    CacheWriteFence,
+    ReplicaSet,
+    SqliteReadPool,
+    SqliteWriter,
+)
+from askgpt.api.throttler import AuthAttemptLimiter
 from askgpt.app.auth._repository import AuthRepository
-from askgpt.app.auth.service import AuthService, TokenRegistry
+from askgpt.app.auth.service import AuthService, TokenRegistry, VerifiedTokenCache
 from askgpt.domain.config import Settings, dg
 from askgpt.helpers.functions import simplecache
 from askgpt.helpers.sql import IEngine, UnitOfWork, async_engine, engine_factory
-from askgpt.infra.eventstore import EventStore
+from askgpt.infra.archive import EventArchiver
+from askgpt.infra.blobstore import BlobStore
+from askgpt.infra.bodycodec import BodyCodecs
+from askgpt.infra.eventstore import EventCodec, EventStore
+from askgpt.infra.factory import apply_sqlite_profile, sqlite_pool_options
 from askgpt.infra.security import Encryptor
+from askgpt.infra.segmentstore import SegmentEventStore
 
 
-def make_engine(settings: Settings):
+def make_engine(
+    settings: Settings, db_url: str | None = None, *, sqlite_readers: bool = False
+):
     connect_args = (
-        settings.db.connect_args.model_dump() if settings.db.connect_args else None
+        settings.db.connect_args.model_dump(exclude_none=True)
+        if settings.db.connect_args
+        else None
     )
     execution_options = (
         settings.db.execution_options.model_dump()
         if settings.db.execution_options
         else None
     )
+    pool_options = settings.db.POOL_OPTIONS
+    if settings.db.SQLITE_SINGLE_WRITER:
+        pool_options = sqlite_pool_options(
+            settings.db.sqlite_profile, readers=sqlite_readers  # type: ignore
+        )
     engine = engine_factory(
-        db_url=settings.db.DB_URL,
+        db_url=db_url or settings.db.DB_URL,
         echo=settings.db.ENGINE_ECHO,
         isolation_level=settings.db.ISOLATION_LEVEL,
-        pool_pre_ping=True,
+        pool_pre_ping=settings.db.POOL_PRE_PING,
+        pool_recycle=settings.db.POOL_RECYCLE,
         connect_args=connect_args,
         execution_options=execution_options,
+        **pool_options,
     )
+    if settings.db.DIALECT == "sqlite" and settings.db.sqlite_profile:
+        apply_sqlite_profile(engine, settings.db.sqlite_profile)
     return engine
 
 
@@ -37,7 +67,7 @@ def make_async_engine(settings: Settings):
 
 @dg.node
 def database_factory(settings: Settings) -> IEngine:
-    return AsyncDatabase(make_async_engine(settings))
+    return AsyncDatabase(make_async_engine(settings), name="primary")
 
 
 @dg.node
@@ -53,10 +83,105 @@ def cache_facotry(settings: Settings) -> Cache[str, str]:
     )
 
 
-@simplecache
 @dg.node
-def uow_factory(settings: Settings) -> UnitOfWork:
-    return UnitOfWork(database_factory(settings))
+def replica_set_factory(settings: Settings) -> ReplicaSet:
+    config = settings.db
+    return ReplicaSet(
+        [
+            AsyncDatabase(async_engine(make_engine(settings, url)), name=f"replica{i}")
+            for i, url in enumerate(config.REPLICA_URLS)
+        ],
+        max_lag=config.REPLICA_MAX_LAG,
+        probe_interval=config.REPLICA_PROBE_INTERVAL,
+    )
+
+
+@dg.node
+def sqlite_read_pool_factory(settings: Settings) -> SqliteReadPool:
+    engine = async_engine(make_engine(settings, sqlite_readers=True))
+    return SqliteReadPool(AsyncDatabase(engine, name="sqlite_readers"))
+
+
+@dg.node
+def uow_factory(settings: Settings, database: IEngine) -> UnitOfWork:
+    if settings.db.SQLITE_SINGLE_WRITER:
+        profile = settings.db.sqlite_profile
+        assert profile
+        writer = SqliteWriter(
+            ty.cast(AsyncDatabase, database),
+            group_commit=profile.GROUP_COMMIT,
+            max_batch=profile.GROUP_COMMIT_MAX_BATCH,
+        )
+        return UnitOfWork(
+            database,
+            replicas=dg.resolve(SqliteReadPool),
+            writer=writer,
+        )
+    if not settings.db.REPLICA_URLS:
+        return UnitOfWork(database)
+    # a user's reads skip replicas until they replayed the user's last write
+    fence_ttl = math.ceil(settings.db.REPLICA_MAX_LAG + settings.db.REPLICA_PROBE_INTERVAL)
+    return UnitOfWork(
+        database,
+        # the instance of dg, whose lifespan the app enters
+        replicas=dg.resolve(ReplicaSet),
+        fence=CacheWriteFence(dg.resolve(Cache), ttl=fence_ttl),
+    )
+
+
+@dg.node
+def body_codecs_factory(settings: Settings) -> BodyCodecs:
+    "shared so dictionaries are loaded once per process"
+    return BodyCodecs(
+        compress=settings.event_record.COMPRESS_BODY,
+        level=settings.event_record.COMPRESSION_LEVEL,
+        refresh_interval=settings.event_record.CODEC_REFRESH_INTERVAL,
+    )
+
+
+@dg.node
+def blobstore_factory(settings: Settings) -> BlobStore:
+    "shared so hot blobs are cached once per process"
+    return BlobStore(
+        threshold=settings.event_record.BLOB_THRESHOLD,
+        cache_size=settings.event_record.BLOB_CACHE_SIZE,
+    )
+
+
+@dg.node
+def eventstore_factory(
+    settings: Settings, uow: UnitOfWork, bodies: BodyCodecs, blobs: BlobStore
+) -> EventStore:
+    config = settings.event_record
+    codec = EventCodec(validate=config.VALIDATE_ON_LOAD, bodies=bodies)
+    if config.BACKEND == "segments":
+        segments = SegmentEventStore(
+            config.SEGMENT_DIR,
+            codec=codec,
+            segment_size=config.SEGMENT_SIZE,
+            fsync=config.SEGMENT_FSYNC,
+        )
+        # services only use what both stores share, see SegmentEventStore.restore
+        return ty.cast(EventStore, segments)
+    return EventStore(
+        uow,
+        codec=codec,
+        blobs=blobs,
+        copy_threshold=config.COPY_THRESHOLD,
+        order_by_id=config.ORDER_BY_ID,
+        read_archive=config.ARCHIVE_IDLE_DAYS is not None or config.READ_ARCHIVE,
+    )
+
+
+@dg.node
+def archiver_factory(settings: Settings, eventstore: EventStore) -> EventArchiver:
+    config = settings.event_record
+    return EventArchiver(
+        eventstore.archive,
+        idle_days=config.ARCHIVE_IDLE_DAYS or 0,
+        interval=config.ARCHIVE_INTERVAL,
+        batch_size=config.ARCHIVE_BATCH_SIZE,
+    )
 
 
 @dg.node
@@ -68,6 +193,74 @@ def encrypt_facotry(settings: Settings) -> Encryptor:
     return encrypt
 
 
+@dg.node
+def verified_token_cache_factory(settings: Settings) -> VerifiedTokenCache:
+    config = settings.security
+    return VerifiedTokenCache(
+        max_size=config.TOKEN_CACHE_SIZE, max_age=config.TOKEN_CACHE_MAX_AGE
+    )
+
+
+@dg.node
+def token_registry_factory(
+    settings: Settings, cache: Cache[str, str], verified: VerifiedTokenCache
+) -> TokenRegistry:
+    keyspace = settings.redis.keyspaces.APP.cls_keyspace(TokenRegistry)
+    return TokenRegistry(
+        token_cache=cache,
+        keyspace=keyspace,
+        verified=verified,
+        token_ttl=settings.security.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        checked=settings.throttling.CHECK_TOKEN,
+    )
+
+
+@dg.node
+def auth_attempt_limiter_factory(
+    settings: Settings, cache: Cache[str, str]
+) -> AuthAttemptLimiter:
+    aiocache = ty.cast(RedisCache[str], cache)
+    config = settings.throttling.pre_auth
+    keyspace = settings.redis.keyspaces.THROTTLER / "auth"
+    limits = [
+        Limit(
+            "auth_ip",
+            keyspace / "ip",
+            config.IP_MAX_ATTEMPTS_PER_MINUTE,
+            config.IP_MAX_ATTEMPTS_PER_MINUTE / 60,
+        ),
+        Limit(
+            "auth_email",
+            keyspace / "email",
+            config.EMAIL_MAX_ATTEMPTS_PER_MINUTE,
+            config.EMAIL_MAX_ATTEMPTS_PER_MINUTE / 60,
+        ),
+    ]
+    controller = AdmissionController(
+        aiocache.load_script(settings.redis.ADMISSION_SCRIPT),
+        aiocache.load_script(settings.redis.ADMISSION_ADJUST_SCRIPT),
+        limits,
+    )
+    return AuthAttemptLimiter(
+        aiocache,
+        controller,
+        keyspace / "failures",
+        lockout_threshold=config.LOCKOUT_THRESHOLD,
+        lockout_base=config.LOCKOUT_BASE,
+        lockout_max=config.LOCKOUT_MAX,
+        failure_window=config.FAILURE_WINDOW,
+        allow_networks=config.ALLOW_NETWORKS,
+        allow_emails=config.ALLOW_EMAILS,
+    )
+
+
+@dg.node
+def cpu_executor_factory(settings: Settings) -> CPUExecutor:
+    "shared, one pool of threads per process"
+    config = settings.cpu_executor
+    return CPUExecutor(max_workers=config.MAX_WORKERS, max_queue=config.MAX_QUEUE)
+
+
 @dg.node
 def auth_service_factory(
     settings: Settings,
@@ -82,6 +275,8 @@ def auth_service_factory(
         encryptor=encryptor,
         eventstore=eventstore,
         security_settings=settings.security,
+        # the instance of dg, whose lifespan the app enters
+        executor=dg.resolve(CPUExecutor),
     )
     return auth_service
 
@@ -19,6 +19,12 @@ class SessionNotFoundError(EntityNotFoundError, GPTError):
         super().__init__(msg)
 
 
+class InvalidCursorError(GPTError):
+    def __init__(self, cursor: str):
+        msg = f"Invalid cursor {cursor}"
+        super().__init__(msg)
+
+
 class OrphanSessionError(GPTError):
     "You are accessing a session that does not belong to you, if you believe this is an error, please contact support."
 
@@ -46,6 +46,20 @@ class ClientRegistry:
         return inner
 
 
+class TokenUsage:
+    "tokens of a completion, filled by `GPTClient.complete` as the provider reports them"
+
+    __slots__ = ("input_tokens", "output_tokens")
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    @property
+    def total(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+
 class GPTClient(ty.Protocol):
     """
     Abstract GPT client
@@ -56,6 +70,7 @@ class GPTClient(ty.Protocol):
         self,
         messages: list[ty.Any],
         params: dict[str, ty.Any],
+        usage: TokenUsage | None = None,
     ) -> ty.AsyncGenerator[str, None]:
         yield ""
         raise NotImplementedError
@@ -73,10 +88,14 @@ class OpenAIClient(GPTClient):
         self,
         messages: list[openai_params.CompletionMessage],
         params: openai_params.OpenAIChatMessageOptions,
+        usage: TokenUsage | None = None,
     ) -> ty.AsyncGenerator[str, None]:
         s_resp: ty.AsyncIterable[openai_chat.ChatCompletionChunk]
         params["messages"] = messages
         params["stream"] = True
+        if usage is not None:
+            # usage comes in a last chunk without choices
+            params["stream_options"] = {"include_usage": True}
 
         try:
             s_resp = await self.chatgpt.create(**params)  # type: ignore
@@ -84,10 +103,16 @@ class OpenAIClient(GPTClient):
             raise OpenAIRequestError(e.status_code, e.message, e.body)
 
         if isinstance(s_resp, openai_chat.ChatCompletion):
+            if usage is not None and s_resp.usage:
+                usage.input_tokens = s_resp.usage.prompt_tokens
+                usage.output_tokens = s_resp.usage.completion_tokens
             yield (s_resp.choices[0].message.content or "")
         else:
             s_resp = ty.cast(ty.AsyncIterable[openai_chat.ChatCompletionChunk], s_resp)
             async for chunk in s_resp:
+                if usage is not None and chunk.usage:
+                    usage.input_tokens = chunk.usage.prompt_tokens
+                    usage.output_tokens = chunk.usage.completion_tokens
                 if not chunk.choices:
                     continue
                 choice = chunk.choices[0]
@@ -135,6 +160,7 @@ class AnthropicClient(GPTClient):
         self,
         messages: list[anthropic_params.MessageParam],
         params: anthropic_params.AnthropicChatMessageOptions,
+        usage: TokenUsage | None = None,
     ) -> ty.AsyncGenerator[str, None]:
         params["messages"] = messages
         params["stream"] = True
@@ -143,7 +169,14 @@ class AnthropicClient(GPTClient):
         async for chunk in resp:
             if isinstance(chunk, anthropic.types.RawContentBlockDeltaEvent):
                 yield chunk.delta.text
+            elif isinstance(chunk, anthropic.types.RawMessageStartEvent):
+                if usage is not None:
+                    usage.input_tokens = chunk.message.usage.input_tokens
+                    usage.output_tokens = chunk.message.usage.output_tokens
             elif isinstance(chunk, anthropic.types.RawMessageDeltaEvent):
+                # output tokens so far, the last delta has them all
+                if usage is not None:
+                    usage.output_tokens = chunk.usage.output_tokens
                 if chunk.delta.stop_reason:
                     break
             else:
@@ -1,3 +1,5 @@
+import base64
+import datetime
 import typing as ty
 from collections import defaultdict
 from functools import singledispatchmethod
@@ -60,6 +62,55 @@ class ChatMessage(ValueObject):
         return d
 
 
+class SessionMessage(ValueObject):
+    "a chat message with its position in the session, numbered from 1"
+
+    seq: int
+    chat_message: ChatMessage
+
+
+class SessionSummary(ty.NamedTuple):
+    "a row of the session list, without messages"
+
+    session_id: str
+    session_name: str
+    last_active_at: datetime.datetime
+
+
+class SessionCursor(ty.NamedTuple):
+    """
+    keyset position in the session list of a user, ordered by (last_active_at, session_id) desc
+    sent to clients as an opaque string
+    """
+
+    last_active_at: datetime.datetime
+    session_id: str
+
+    @classmethod
+    def after(cls, summary: SessionSummary) -> ty.Self:
+        return cls(summary.last_active_at, summary.session_id)
+
+    def encode(self) -> str:
+        raw = f"{self.last_active_at.isoformat()}|{self.session_id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @classmethod
+    def decode(cls, cursor: str) -> ty.Self:
+        "raises ValueError on malformed cursors"
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+            last_active_at, session_id = raw.split("|", 1)
+            return cls(datetime.datetime.fromisoformat(last_active_at), session_id)
+        except (ValueError, UnicodeDecodeError) as exc:
+            raise ValueError(cursor) from exc
+
+
+class SessionPage(ty.NamedTuple):
+    sessions: list[SessionSummary]
+    next_cursor: str | None
+    total: int | None
+
+
 class UserRelated(DataStruct):
     entity_id: str = Field(alias="user_id")
 
@@ -1,8 +1,22 @@
+import datetime
+import typing as ty
+
 import sqlalchemy as sa
 from askgpt.helpers.sql import UnitOfWork
-from askgpt.infra.schema import SessionsTable
+from askgpt.helpers.time import utc_now
+from askgpt.infra.schema import SessionMessagesTable, SessionsTable
+
+from ._model import (
+    ChatMessage,
+    ChatMessageSent,
+    ChatSession,
+    ISessionRepository,
+    SessionCursor,
+    SessionMessage,
+    SessionSummary,
+)
 
-from ._model import ChatSession, ISessionRepository
+DEFAULT_SESSION_PAGE_SIZE = 50
 
 
 def session_from_row(row: sa.RowMapping) -> ChatSession:
@@ -11,6 +25,18 @@ def session_from_row(row: sa.RowMapping) -> ChatSession:
     )
 
 
+def message_from_row(row: sa.RowMapping) -> SessionMessage:
+    return SessionMessage(
+        seq=row.seq,
+        chat_message=ChatMessage(
+            role=row.role,
+            content=row.content,
+            gpt_type=row.gpt_type,
+            timestamp=row.sent_at.replace(tzinfo=datetime.UTC),
+        ),
+    )
+
+
 from askgpt.domain.config import dg
 
 
@@ -22,21 +48,58 @@ class SessionRepository(ISessionRepository):
     def uow(self) -> UnitOfWork:
         return self._uow
 
-    async def list_sessions(self, user_id: str) -> list[ChatSession]:
-        stmt = sa.select(SessionsTable).where(SessionsTable.user_id == user_id)
+    async def list_sessions(
+        self,
+        user_id: str,
+        *,
+        after: SessionCursor | None = None,
+        limit: int = DEFAULT_SESSION_PAGE_SIZE,
+    ) -> list[SessionSummary]:
+        """
+        sessions of the user by last activity, newest first,
+        a range scan on ix_sessions_user_active starting right after the cursor.
+        """
+        stmt = (
+            sa.select(
+                SessionsTable.id, SessionsTable.session_name, SessionsTable.last_active_at
+            )
+            .where(SessionsTable.user_id == user_id)
+            .order_by(SessionsTable.last_active_at.desc(), SessionsTable.id.desc())
+            .limit(limit)
+        )
+        if after is not None:
+            stmt = stmt.where(
+                sa.tuple_(SessionsTable.last_active_at, SessionsTable.id)
+                < sa.tuple_(sa.literal(after.last_active_at), sa.literal(after.session_id))
+            )
         cursor = await self._uow.execute(stmt)
-        rows = cursor.mappings().all()
-        return [session_from_row(row) for row in rows]
+        return [SessionSummary(*row) for row in cursor.all()]
+
+    async def count_sessions(self, user_id: str) -> int:
+        stmt = sa.select(sa.func.count()).where(SessionsTable.user_id == user_id)
+        return (await self._uow.execute(stmt)).scalar_one()
 
     async def add(self, entity: ChatSession):
         stmt = sa.insert(SessionsTable).values(
             id=entity.entity_id,
             user_id=entity.user_id,
             session_name=entity.session_name,
+            last_active_at=utc_now().replace(tzinfo=None),
+            # a new session has no history to project
+            message_seq=0,
         )
 
         await self._uow.execute(stmt)
 
+    async def touch(self, entity_id: str) -> None:
+        "mark the session as active now"
+        stmt = (
+            sa.update(SessionsTable)
+            .where(SessionsTable.id == entity_id)
+            .values(last_active_at=utc_now().replace(tzinfo=None))
+        )
+        await self._uow.execute(stmt)
+
     async def rename(self, entity: ChatSession):
         stmt = (
             sa.update(SessionsTable)
@@ -64,3 +127,116 @@ class SessionRepository(ISessionRepository):
         if not row:
             return None
         return session_from_row(row)
+
+
+class MessageRepository:
+    """
+    messages of a session in session_messages, ordered by seq.
+    all reads are range scans on the (session_id, seq) primary key.
+    seqs are allocated on the session row, which serializes writers of a session.
+    """
+
+    def __init__(self, uow: UnitOfWork):
+        self._uow = uow
+
+    @property
+    def uow(self) -> UnitOfWork:
+        return self._uow
+
+    async def last_seq(self, session_id: str) -> int | None:
+        "seq of the latest message of the session, None until its messages are projected"
+        stmt = sa.select(SessionsTable.message_seq).where(SessionsTable.id == session_id)
+        return (await self._uow.execute(stmt)).scalar()
+
+    def _rows(
+        self, session_id: str, first_seq: int, events: ty.Sequence[ChatMessageSent]
+    ) -> list[dict[str, ty.Any]]:
+        return [
+            dict(
+                session_id=session_id,
+                seq=seq,
+                event_id=event.event_id,
+                role=event.chat_message.role,
+                content=event.chat_message.content,
+                gpt_type=event.chat_message.gpt_type,
+                sent_at=event.chat_message.timestamp.astimezone(datetime.UTC).replace(
+                    tzinfo=None
+                ),
+            )
+            for seq, event in enumerate(events, start=first_seq)
+        ]
+
+    async def add_all(
+        self, session_id: str, events: ty.Sequence[ChatMessageSent]
+    ) -> int:
+        "append messages after the latest one, returns the new last seq"
+        stmt = (
+            sa.update(SessionsTable)
+            .where(SessionsTable.id == session_id)
+            .values(
+                message_seq=sa.func.coalesce(SessionsTable.message_seq, 0) + len(events)
+            )
+            .returning(SessionsTable.message_seq)
+        )
+        last_seq = (await self._uow.execute(stmt)).scalar_one()
+        if events:
+            rows = self._rows(session_id, last_seq - len(events) + 1, events)
+            await self._uow.bulk_insert(SessionMessagesTable.__table__, rows)  # type: ignore
+        return last_seq
+
+    async def project(
+        self, session_id: str, events: ty.Sequence[ChatMessageSent]
+    ) -> int:
+        """
+        number the messages of a session from before the read table, returns its last seq.
+        a session projected meanwhile, e.g. by a concurrent request, is left as is.
+        """
+        stmt = (
+            sa.update(SessionsTable)
+            .where(SessionsTable.id == session_id, SessionsTable.message_seq.is_(None))
+            .values(message_seq=len(events))
+            .returning(SessionsTable.message_seq)
+        )
+        if (await self._uow.execute(stmt)).scalar() is None:
+            return await self.last_seq(session_id) or 0
+        if events:
+            rows = self._rows(session_id, 1, events)
+            await self._uow.bulk_insert(SessionMessagesTable.__table__, rows)  # type: ignore
+        return len(events)
+
+    async def list_before(
+        self, session_id: str, before: int | None, limit: int
+    ) -> list[SessionMessage]:
+        "the latest `limit` messages older than `before`, oldest first"
+        stmt = (
+            sa.select(SessionMessagesTable)
+            .where(SessionMessagesTable.session_id == session_id)
+            .order_by(SessionMessagesTable.seq.desc())
+            .limit(limit)
+        )
+        if before is not None:
+            stmt = stmt.where(SessionMessagesTable.seq < before)
+        rows = (await self._uow.execute(stmt)).mappings().all()
+        return [message_from_row(row) for row in reversed(rows)]
+
+    async def list_after(
+        self, session_id: str, after: int, limit: int
+    ) -> list[SessionMessage]:
+        "the first `limit` messages newer than `after`, oldest first"
+        stmt = (
+            sa.select(SessionMessagesTable)
+            .where(
+                SessionMessagesTable.session_id == session_id,
+                SessionMessagesTable.seq > after,
+            )
+            .order_by(SessionMessagesTable.seq)
+            .limit(limit)
+        )
+        rows = (await self._uow.execute(stmt)).mappings().all()
+        return [message_from_row(row) for row in rows]
+
+    async def remove(self, session_id: str) -> None:
+        stmt = sa.delete(SessionMessagesTable).where(
+            SessionMessagesTable.session_id == session_id
+        )
+        await self._uow.execute(stmt)
@@ -1,35 +1,79 @@
+import asyncio
+import datetime
 import typing as ty
 
-from fastapi import APIRouter, Body, Depends
+from fastapi import APIRouter, Body, Depends, Query
+from fastapi import Response as HTTPResponse
 from fastapi.responses import RedirectResponse, StreamingResponse
 from starlette import status
+from starlette.background import BackgroundTask
 
+from askgpt.adapters.admission import TOKEN_REVOKED
 from askgpt.api.errors import QuotaExceededError
 from askgpt.api.model import EmptyResponse, RequestBody, Response, ResponseData
-from askgpt.api.throttler import UserRequestThrottler
-from askgpt.app.auth.api import ParsedToken
+from askgpt.api.throttler import ChatAdmission, StreamLimiter
+from askgpt.api.xheaders import XHeaders
+from askgpt.app.auth._errors import InvalidCredentialError
+from askgpt.app.auth._model import AccessToken
+from askgpt.app.auth.api import BearerToken, ParsedToken
+from askgpt.app.gpt._repository import DEFAULT_SESSION_PAGE_SIZE
 from askgpt.app.gpt.service import GPTService
 from askgpt.app.gpt_factory import SessionService, dynamic_gpt_service_resolver
 from askgpt.domain.config import dg
 
-from ._model import ChatSession
+from ._model import ChatSession, SessionMessage
 from .anthropic._params import AnthropicChatMessageOptions
 from .openai._params import ChatGPTRoles, OpenAIChatMessageOptions
 
 gpt_router = APIRouter(prefix="/gpt")
 sessions = APIRouter(prefix="/sessions")
 
+MAX_SESSION_PAGE_SIZE = 200
+DEFAULT_MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+
 DSessionService = ty.Annotated[SessionService, Depends(dg.factory(SessionService))]
 DGPTService = ty.Annotated[GPTService, Depends(dynamic_gpt_service_resolver)]
 
 
+ChatMessageOptions = AnthropicChatMessageOptions | OpenAIChatMessageOptions
+
+
+async def resume_stream(
+    first: str | None,
+    stream: ty.AsyncGenerator[str, None],
+    release: ty.Callable[[], ty.Awaitable[None]],
+) -> ty.AsyncGenerator[str, None]:
+    """
+    releases the stream slot however the stream ends, starlette skips
+    the background task of a response whose stream raised
+    """
+    try:
+        if first is not None:
+            yield first
+        async for chunk in stream:
+            yield chunk
+    finally:
+        # a disconnected client cancels the stream, the release is finished regardless
+        await asyncio.shield(release())
+
+
 async def throttle_user_request(
-    access_token: ParsedToken,
+    access_token: AccessToken, bearer: str, params: ChatMessageOptions
 ):
-    throttler = dg.resolve(UserRequestThrottler)
-    wait_time = await throttler.validate(access_token.sub)
-    if wait_time:
-        raise QuotaExceededError(throttler.max_tokens, wait_time)
+    """
+    every request limit and the access token are checked in one redis call,
+    token limits are charged by GPTService.chatcomplete, see ChatAdmission
+    """
+    admission = dg.resolve(ChatAdmission)
+    violation = await admission.validate(
+        access_token.sub, model=params["model"], access_token=bearer
+    )
+    if violation is None:
+        return
+    if violation.limit == TOKEN_REVOKED:
+        raise InvalidCredentialError("Your access token has been revoked")
+    raise QuotaExceededError(admission.quota(violation.limit), violation.wait_time)
 
 
 class SessionRenameRequest(RequestBody):
@@ -39,6 +83,7 @@ class SessionRenameRequest(RequestBody):
 class PublicSessionInfo(ResponseData):
     session_id: str
     session_name: str
+    last_active_at: datetime.datetime
 
 
 class PublicChatMessage(ResponseData):
@@ -65,6 +110,41 @@ class PublicChatSession(ResponseData):
         )
 
 
+class PublicSessionMessage(PublicChatMessage):
+    version: int
+
+    @classmethod
+    def from_message(cls, message: SessionMessage) -> ty.Self:
+        return cls.model_construct(
+            role=message.chat_message.role,
+            content=message.chat_message.content,
+            version=message.seq,
+        )
+
+
+class PublicMessagePage(ResponseData):
+    """
+    version: version of the latest message in the session, to pass as `after_version` for deltas
+    next_cursor: pass as `before` to fetch older messages, null on the first message
+    """
+
+    session_id: str
+    version: int
+    messages: list[PublicSessionMessage]
+    next_cursor: int | None
+
+
+class PublicMessageDelta(ResponseData):
+    """
+    messages are capped at `limit`,
+    more are available while the version of the last message is below `version`
+    """
+
+    session_id: str
+    version: int
+    messages: list[PublicSessionMessage]
+
+
 @gpt_router.post("/sessions", response_model=PublicChatSession)
 async def create_session(service: DSessionService, token: ParsedToken):
     # TODO: 1. limit rate 2. require idem id to avoid creating multiple sessions accidentally
@@ -77,11 +157,33 @@ async def create_session(service: DSessionService, token: ParsedToken):
 
 
 @gpt_router.get("/sessions", response_model=list[PublicSessionInfo])
-async def list_sessions(service: DSessionService, token: ParsedToken):
-    user_sessions = await service.list_sessions(user_id=token.sub)
+async def list_sessions(
+    service: DSessionService,
+    token: ParsedToken,
+    response: HTTPResponse,
+    cursor: str | None = None,
+    limit: int = Query(DEFAULT_SESSION_PAGE_SIZE, ge=1, le=MAX_SESSION_PAGE_SIZE),
+    with_count: bool = False,
+):
+    """
+    sessions by last activity, newest first.
+    the next page is requested with `cursor` set to the X-Next-Cursor header,
+    which is absent on the last page, X-Total-Count is set when `with_count` is true.
+    """
+    page = await service.list_sessions(
+        user_id=token.sub, cursor=cursor, limit=limit, with_count=with_count
+    )
+    if page.next_cursor is not None:
+        response.headers[XHeaders.NEXT_CURSOR.value] = page.next_cursor
+    if page.total is not None:
+        response.headers[XHeaders.TOTAL_COUNT.value] = str(page.total)
     public_sessions = [
-        PublicSessionInfo(session_id=ss.entity_id, session_name=ss.session_name)
-        for ss in user_sessions
+        PublicSessionInfo.model_construct(
+            session_id=ss.session_id,
+            session_name=ss.session_name,
+            last_active_at=ss.last_active_at,
+        )
+        for ss in page.sessions
     ]
     return public_sessions
 
@@ -95,6 +197,49 @@ async def get_session(
     return chat
 
 
+@sessions.get("/{session_id}/messages")
+async def list_session_messages(
+    service: DSessionService,
+    token: ParsedToken,
+    session_id: str,
+    before: int | None = Query(None, ge=1),
+    limit: int = Query(DEFAULT_MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+) -> PublicMessagePage:
+    "latest messages of the session, older pages are fetched with `before=next_cursor`"
+    messages, version = await service.list_messages(
+        user_id=token.sub, session_id=session_id, before=before, limit=limit
+    )
+    first_seq = messages[0].seq if messages else 1
+    return PublicMessagePage.model_construct(
+        session_id=session_id,
+        version=version,
+        messages=[PublicSessionMessage.from_message(m) for m in messages],
+        next_cursor=first_seq if first_seq > 1 else None,
+    )
+
+
+@sessions.get("/{session_id}/messages/delta")
+async def get_session_delta(
+    service: DSessionService,
+    token: ParsedToken,
+    session_id: str,
+    after_version: int = Query(0, ge=0),
+    limit: int = Query(MAX_MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+) -> PublicMessageDelta:
+    "messages added since `after_version`"
+    messages, version = await service.messages_since(
+        user_id=token.sub,
+        session_id=session_id,
+        after_version=after_version,
+        limit=limit,
+    )
+    return PublicMessageDelta.model_construct(
+        session_id=session_id,
+        version=version,
+        messages=[PublicSessionMessage.from_message(m) for m in messages],
+    )
+
+
 @sessions.put("/{session_id}")
 async def rename_session(
     service: DSessionService,
@@ -124,25 +269,39 @@ async def delete_session(service: DSessionService, token: ParsedToken, session_i
 #         raise ValueError("Invalid query parameter value")
 
 
-@sessions.post(
-    "/{session_id}/messages",
-    dependencies=[Depends(throttle_user_request)],
-)
+@sessions.post("/{session_id}/messages")
 async def add_chat_message(
     token: ParsedToken,
+    bearer: BearerToken,
     service: DGPTService,
     session_id: str,
-    params: AnthropicChatMessageOptions | OpenAIChatMessageOptions = Body(),
+    params: ChatMessageOptions = Body(),
 ) -> StreamingResponse:
     "Create a chat message"
+    # admission needs the model of the body, unlike a dependency
+    await throttle_user_request(token, bearer, params)
     stream = params.pop("stream", True)
 
     if stream:
-        stream_ans = service.chatcomplete(
-            user_id=token.sub,
-            session_id=session_id,
-            params=params,
+        # the slot is held until the stream ends, fails or the client disconnects
+        release = await dg.resolve(StreamLimiter).acquire(token.sub, token.role)
+        try:
+            stream_ans = service.chatcomplete(
+                user_id=token.sub,
+                session_id=session_id,
+                params=params,
+            )
+            # errors raised before the first chunk, e.g. an exceeded token quota,
+            # are answered as errors instead of breaking a started response
+            first = await anext(stream_ans, None)
+        except BaseException:
+            await release()
+            raise
+        # releasing twice is a no-op, the background task covers a stream
+        # that was never iterated
+        return StreamingResponse(
+            resume_stream(first, stream_ans, release),
+            background=BackgroundTask(release),
         )
-        return StreamingResponse(stream_ans)
     else:
         raise NotImplementedError("Not implemented")
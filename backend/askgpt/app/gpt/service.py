@@ -6,10 +6,16 @@ from askgpt.app.auth.service import AuthService
 from askgpt.app.gpt._api_pool import APIPool
 from askgpt.app.gpt._errors import (
     APIKeyNotProvidedError,
+    InvalidCursorError,
     OrphanSessionError,
     SessionNotFoundError,
 )
-from askgpt.app.gpt._gptclient import AnthropicClient, GPTClient, OpenAIClient
+from askgpt.app.gpt._gptclient import (
+    AnthropicClient,
+    GPTClient,
+    OpenAIClient,
+    TokenUsage,
+)
 from askgpt.app.gpt._model import (
     DEFAULT_SESSION_NAME,
     ChatMessage,
@@ -18,29 +24,60 @@ from askgpt.app.gpt._model import (
     ChatSession,
     SessionCreated,
     SessionRemoved,
+    SessionCursor,
+    SessionMessage,
+    SessionPage,
     SessionRenamed,
     uuid_factory,
 )
-from askgpt.app.gpt._repository import SessionRepository
+from askgpt.app.gpt._repository import (
+    DEFAULT_SESSION_PAGE_SIZE,
+    MessageRepository,
+    SessionRepository,
+)
 from askgpt.app.gpt.anthropic import _params as anthropic_params
 from askgpt.app.gpt.openai import _params as openai_params
 from askgpt.domain.config import SETTINGS_CONTEXT
 from askgpt.domain.types import SupportedGPTs
+from askgpt.helpers._log import logger
+from askgpt.helpers.sql import UnitOfWork
 from askgpt.infra.eventstore import EventStore
 
 
+class TokenQuota(ty.Protocol):
+    "limits on the tokens of completions, see askgpt.api.throttler.ChatAdmission"
+
+    async def reserve(self, user_id: str, model: str, tokens: int) -> None:
+        "raises QuotaExceededError when a limit has no room for `tokens`"
+
+    async def settle(self, user_id: str, model: str, reserved: int, used: int) -> None: ...
+
+
+def estimate_tokens(context: ty.Sequence[ty.Any]) -> int:
+    "rough token count of a message context, about 4 characters a token"
+    chars = sum(len(str(message["content"])) for message in context)
+    # roles and separators take a few tokens per message
+    return chars // 4 + 4 * len(context)
+
+
 class SessionService:
     def __init__(
         self,
         session_repo: SessionRepository,
         event_store: EventStore,
+        message_repo: MessageRepository | None = None,
     ):
         self._uow = session_repo.uow
         self._session_repo = session_repo
         self._event_store = event_store
+        self._message_repo = message_repo or MessageRepository(self._uow)
+
+    @property
+    def uow(self) -> UnitOfWork:
+        return self._uow
 
     async def _rebuild_session(self, user_id: str, session_id: str) -> ChatSession:
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             user_events = await self._event_store.get(entity_id=user_id)
             for e in user_events:
                 if type(e) is SessionCreated:
@@ -77,10 +114,108 @@ class SessionService:
         session = await self._rebuild_session(user_id=user_id, session_id=session_id)
         return session
 
-    async def list_sessions(self, user_id: str) -> list[ChatSession]:
+    async def list_sessions(
+        self,
+        user_id: str,
+        *,
+        cursor: str | None = None,
+        limit: int = DEFAULT_SESSION_PAGE_SIZE,
+        with_count: bool = False,
+    ) -> SessionPage:
+        """
+        a page of the user's sessions by last activity,
+        cursor is the `next_cursor` of the previous page, the total is only counted on request
+        """
+        try:
+            after = SessionCursor.decode(cursor) if cursor else None
+        except ValueError:
+            raise InvalidCursorError(ty.cast(str, cursor))
+
+        async with self._uow.trans(readonly=True):
+            # one extra row tells whether there is a next page
+            sessions = await self._session_repo.list_sessions(
+                user_id=user_id, after=after, limit=limit + 1
+            )
+            total = (
+                await self._session_repo.count_sessions(user_id) if with_count else None
+            )
+        next_cursor = None
+        if len(sessions) > limit:
+            sessions = sessions[:limit]
+            next_cursor = SessionCursor.after(sessions[-1]).encode()
+        return SessionPage(sessions=sessions, next_cursor=next_cursor, total=total)
+
+    async def _message_version(self, user_id: str, session_id: str) -> int | None:
+        """
+        seq of the latest message of the session, should be called within uow.trans()
+        None until the messages of the session are projected
+        """
+        session = await self._session_repo.get(entity_id=session_id)
+        if not session:
+            raise SessionNotFoundError(session_id)
+        if session.user_id != user_id:
+            raise OrphanSessionError(session_id, user_id)
+        return await self._message_repo.last_seq(session_id)
+
+    async def _read_messages[T](
+        self,
+        user_id: str,
+        session_id: str,
+        read: ty.Callable[[int], ty.Awaitable[T]],
+    ) -> tuple[T, int]:
+        """
+        `read` the messages of the session at its version off the writer,
+        messages of sessions from before the read table are projected on first access
+        """
+        async with self._uow.trans(readonly=True):
+            version = await self._message_version(user_id, session_id)
+            if version is not None:
+                return await read(version), version
         async with self._uow.trans():
-            sessions = await self._session_repo.list_sessions(user_id=user_id)
-        return sessions
+            version = await self._project_messages(session_id)
+            return await read(version), version
+
+    async def _project_messages(self, session_id: str) -> int:
+        events = await self._event_store.get(entity_id=session_id)
+        sent = [event for event in events if isinstance(event, ChatMessageSent)]
+        return await self._message_repo.project(session_id, sent)
+
+    async def record_messages(
+        self, session_id: str, events: list[ChatMessageSent]
+    ) -> None:
+        """
+        append messages to the read table and mark the session as active,
+        should be called within the transaction
+        that stores the events, before they are added to the event store.
+        an archived session is faulted back in, it is in use again.
+        """
+        await self._event_store.restore(session_id)
+        if await self._message_repo.last_seq(session_id) is None:
+            await self._project_messages(session_id)
+        await self._message_repo.add_all(session_id, events)
+        await self._session_repo.touch(session_id)
+
+    async def list_messages(
+        self, user_id: str, session_id: str, *, before: int | None, limit: int
+    ) -> tuple[list[SessionMessage], int]:
+        "a page of the latest messages older than `before`, with the session version"
+
+        async def read(version: int) -> list[SessionMessage]:
+            return await self._message_repo.list_before(session_id, before, limit)
+
+        return await self._read_messages(user_id, session_id, read)
+
+    async def messages_since(
+        self, user_id: str, session_id: str, *, after_version: int, limit: int
+    ) -> tuple[list[SessionMessage], int]:
+        "messages added after `after_version`, with the session version"
+
+        async def read(version: int) -> list[SessionMessage]:
+            if after_version >= version:
+                return []
+            return await self._message_repo.list_after(session_id, after_version, limit)
+
+        return await self._read_messages(user_id, session_id, read)
 
     async def rename_session(self, session_id: str, new_name: str) -> None:
         async with self._uow.trans():
@@ -99,6 +234,7 @@ class SessionService:
         async with self._uow.trans():
             await self._event_store.add(session_removed)
             await self._session_repo.remove(entity_id=session_id)
+            await self._message_repo.remove(session_id)
 
 
 class GPTService:
@@ -110,11 +246,13 @@ class GPTService:
         session_service: SessionService,
         event_store: EventStore,
         cache: Cache[str, str],
+        token_quota: TokenQuota | None = None,
     ):
         self._auth_service = auth_service
         self._session_service = session_service
         self._cache = cache
         self._event_store = event_store
+        self._token_quota = token_quota
         self._settings = SETTINGS_CONTEXT.get()
 
     async def _build_api_pool(self, user_id: str, api_type: str):
@@ -172,12 +310,35 @@ class GPTService:
         )
         messages = await self.build_message_context(session, messages=[msg])
         api_pool = await self._build_api_pool(user_id=user_id, api_type=self.gpt_type)
-        async with api_pool.reserve_api_key() as api_key:
-            client = self._client_factory(api_key, timeout=3.0)
-            answer = ""
-            async for chunk in client.complete(messages=messages, params=params):
-                yield chunk
-                answer += chunk
+
+        model = params.get("model", "")
+        reserved = 0
+        if self._token_quota:
+            max_tokens = params.get("max_tokens")
+            reserved = estimate_tokens(messages) + (
+                max_tokens or self._settings.throttling.COMPLETION_TOKENS_ESTIMATE
+            )
+            await self._token_quota.reserve(user_id, model, reserved)
+
+        usage = TokenUsage()
+        try:
+            async with api_pool.reserve_api_key() as api_key:
+                client = self._client_factory(api_key, timeout=3.0)
+                answer = ""
+                async for chunk in client.complete(
+                    messages=messages, params=params, usage=usage
+                ):
+                    yield chunk
+                    answer += chunk
+        finally:
+            # without reported usage, e.g. a failed or cut off stream, the reservation is kept
+            if self._token_quota:
+                try:
+                    await self._token_quota.settle(
+                        user_id, model, reserved, usage.total or reserved
+                    )
+                except Exception:
+                    logger.exception("Failed to settle the tokens of a completion")
 
         events = [
             ChatMessageSent(
@@ -196,8 +357,14 @@ class GPTService:
 
         # TODO: extract this to be an event serivce
         # await self._event_service.publish(events)
-        async with self._event_store.uow.trans():
-            await self._event_store.add_all(events)
+        uow = self._session_service.uow
+        # the stream outlives the scope of its request, the write is recorded
+        # for the user here so their next reads see the messages
+        async with uow.scope():
+            uow.track(user_id)
+            async with uow.trans():
+                await self._session_service.record_messages(session_id, events)
+                await self._event_store.add_all(events)
 
 
 class OpenAIGPT(GPTService):
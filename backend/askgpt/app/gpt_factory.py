@@ -1,8 +1,31 @@
-from askgpt.adapters.cache import RedisCache
-from askgpt.adapters.tokenbucket import TokenBucketFactory
-from askgpt.api.throttler import UserRequestThrottler
+import typing as ty
+
+from askgpt.adapters.admission import AdmissionController, Limit
+from askgpt.adapters.cache import Cache, RedisCache
+from askgpt.adapters.semaphore import DistributedSemaphore
+from askgpt.adapters.tokenbucket import (
+    GCRALimiter,
+    HybridTokenBucket,
+    KeyedLimiter,
+    TokenBucketFactory,
+    TokenLeaser,
+)
+from askgpt.api.throttler import (
+    USER_REQUESTS,
+    ChatAdmission,
+    LimitScope,
+    LimitUnit,
+    StreamLimiter,
+    UserRequestThrottler,
+)
+from askgpt.app.auth.service import TokenRegistry
 from askgpt.app.gpt._repository import SessionRepository
-from askgpt.app.gpt.service import AnthropicGPT, OpenAIGPT, SessionService
+from askgpt.app.gpt.service import (
+    AnthropicGPT,
+    OpenAIGPT,
+    SessionService,
+    TokenQuota,
+)
 from askgpt.app.user._repository import UserRepository
 from askgpt.app.user.service import UserService
 from askgpt.domain.config import Settings, dg
@@ -24,15 +47,122 @@ def token_bucket_factory(
     )
 
 
+def make_token_leaser(settings: Settings, aiocache: RedisCache[str]) -> TokenLeaser:
+    config = settings.redis
+    return TokenLeaser(
+        redis=aiocache,
+        lease_script=aiocache.load_script(config.TOKEN_LEASE_SCRIPT),
+        give_back_script=aiocache.load_script(config.TOKEN_GIVE_BACK_SCRIPT),
+        keyspace=config.keyspaces.THROTTLER / "user_request",
+    )
+
+
+@dg.node
 def user_request_throttler_factory(
-    settings: Settings, token_bucket_factory: TokenBucketFactory
+    settings: Settings, cache: Cache[str, str]
 ) -> UserRequestThrottler:
-    throttler = UserRequestThrottler(
-        bucket_factory=token_bucket_factory,
-        max_requests=settings.throttling.USER_MAX_REQUEST_PER_MINUTE,
-        refill_duration_s=settings.throttling.USER_MAX_REQUEST_DURATION_MINUTE * 60,
+    "shared, leases are held per process"
+    aiocache = ty.cast(RedisCache[str], cache)
+    config = settings.throttling
+    max_requests = config.USER_MAX_REQUEST_PER_MINUTE
+    refill_rate_s = max_requests / (config.USER_MAX_REQUEST_DURATION_MINUTE * 60)
+    bucket: KeyedLimiter
+    if config.ALGORITHM == "gcra":
+        bucket = GCRALimiter(
+            aiocache,
+            aiocache.load_script(settings.redis.GCRA_SCRIPT),
+            max_tokens=max_requests,
+            refill_rate_s=refill_rate_s,
+            # a string instead of a hash, keys of the token bucket would be WRONGTYPE
+            keyspace=settings.redis.keyspaces.THROTTLER / "user_request_gcra",
+        )
+        return UserRequestThrottler(bucket)
+
+    bucket = HybridTokenBucket(
+        make_token_leaser(settings, aiocache),
+        max_tokens=max_requests,
+        refill_rate_s=refill_rate_s,
+        lease_size=config.LEASE_SIZE,
+        lease_ttl=config.LEASE_TTL,
+        sync_interval=config.LEASE_SYNC_INTERVAL,
+        strict_below=config.STRICT_BELOW,
+        strict=config.MODE == "strict",
+    )
+    return UserRequestThrottler(bucket)
+
+
+@dg.node
+def chat_admission_factory(settings: Settings, cache: Cache[str, str]) -> ChatAdmission:
+    aiocache = ty.cast(RedisCache[str], cache)
+    config = settings.throttling
+    keyspace = settings.redis.keyspaces.THROTTLER / "admission"
+    max_requests = config.USER_MAX_REQUEST_PER_MINUTE
+    limits = [
+        Limit(
+            USER_REQUESTS,
+            keyspace / USER_REQUESTS,
+            max_requests,
+            max_requests / (config.USER_MAX_REQUEST_DURATION_MINUTE * 60),
+        )
+    ]
+    scopes: list[tuple[LimitScope, LimitUnit]] = [("user", "request")]
+    extra = list(config.LIMITS)
+    if config.USER_MAX_TOKENS_PER_MINUTE:
+        extra.append(
+            Settings.Throttling.Limit(
+                NAME="user_tokens",
+                SCOPE="user",
+                UNIT="token",
+                MAX_TOKENS=config.USER_MAX_TOKENS_PER_MINUTE,
+            )
+        )
+    for limit in extra:
+        limits.append(
+            Limit(
+                limit.NAME,
+                keyspace / limit.NAME,
+                limit.MAX_TOKENS,
+                limit.MAX_TOKENS / (limit.DURATION_MINUTE * 60),
+            )
+        )
+        scopes.append((limit.SCOPE, limit.UNIT))
+
+    controller = AdmissionController(
+        aiocache.load_script(settings.redis.ADMISSION_SCRIPT),
+        aiocache.load_script(settings.redis.ADMISSION_ADJUST_SCRIPT),
+        limits,
+    )
+    token_key = dg.resolve(TokenRegistry).token_key_by if config.CHECK_TOKEN else None
+    return ChatAdmission(
+        dg.resolve(UserRequestThrottler),
+        controller,
+        scopes,
+        token_key=token_key,
+        max_wait=config.MAX_WAIT,
+        max_waiting=config.MAX_WAITING_PER_USER,
+    )
+
+
+@dg.node
+def token_quota_factory(settings: Settings) -> TokenQuota:
+    "the ChatAdmission of dg, reservations share its queue of waiting requests"
+    return dg.resolve(ChatAdmission)
+
+
+@dg.node
+def stream_limiter_factory(settings: Settings, cache: Cache[str, str]) -> StreamLimiter:
+    "shared, leases are renewed per process"
+    aiocache = ty.cast(RedisCache[str], cache)
+    config = settings.throttling
+    semaphore = DistributedSemaphore(
+        aiocache,
+        aiocache.load_script(settings.redis.SEMAPHORE_SCRIPT),
+        aiocache.load_script(settings.redis.SEMAPHORE_RENEW_SCRIPT),
+        keyspace=settings.redis.keyspaces.THROTTLER / "streams",
+        lease_ttl=config.STREAM_LEASE_TTL,
+        renew_interval=config.STREAM_LEASE_TTL / 3,
     )
-    return throttler
+    return StreamLimiter(semaphore, config.MAX_STREAMS_PER_ROLE)
 
 
 def user_service_factory(user_repo: UserRepository, event_store: EventStore):
@@ -21,7 +21,7 @@ class UserRepository:
         return self._uow
 
     async def get(self, user_id: str) -> UserInfo | None:
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             stmt = select(UsersTable).where(UsersTable.id == user_id)
             cursor = await self._uow.execute(stmt)
             row = cursor.mappings().one_or_none()
@@ -30,7 +30,7 @@ class UserRepository:
             return load_user(row)
 
     async def search_user_by_email(self, email: str) -> UserInfo | None:
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             stmt = select(UsersTable).where(UsersTable.email == email)
             cursor = await self._uow.execute(stmt)
             row = cursor.mappings().one_or_none()
@@ -11,10 +11,10 @@ class UserService:
         self._uow = self._user_repo.uow
 
     async def get_user(self, user_id: str) -> UserInfo | None:
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             return await self._user_repo.get(user_id)
 
     async def find_user(self, email: str) -> UserInfo | None:
-        async with self._uow.trans():
+        async with self._uow.trans(readonly=True):
             user_or_none = await self._user_repo.search_user_by_email(email)
         return user_or_none
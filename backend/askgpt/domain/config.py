@@ -27,6 +27,9 @@ WEEK = 7 * DAY
 
 TIME_EPSILON_S = 0.001  # 1ms
 
+# directory that contains the askgpt package, relative script paths are resolved against it
+SOURCE_ROOT = pathlib.Path(__file__).resolve().parents[2]
+
 
 SETTINGS_READ_ORDER: tuple[str, ...] = (
     "test.settings.toml",
@@ -109,6 +112,10 @@ class Settings(SettingsBase):
         ALGORITHM: SUPPORTED_ALGORITHMS  # jose.constants.ALGORITHMS
         ACCESS_TOKEN_EXPIRE_MINUTES: int
         CORS_ORIGINS: list[str]
+        # verified access tokens kept per process, a revoked token is dropped by the process
+        # revoking it at once and by the others within TOKEN_CACHE_MAX_AGE seconds, 0 disables it
+        TOKEN_CACHE_SIZE: int = 10_000
+        TOKEN_CACHE_MAX_AGE: float = 60
 
         @field_validator("CORS_ORIGINS", mode="before")
         def _(cls, v: str) -> list[str]:
@@ -118,6 +125,14 @@ class Settings(SettingsBase):
 
     security: Security
 
+    class CPUExecutor(SettingsBase):
+        # threads running bcrypt and fernet off the event loop, the number of cpus by default
+        MAX_WORKERS: int = os.cpu_count() or 1
+        # calls waiting for a thread, further ones are answered 503 with Retry-After
+        MAX_QUEUE: int = 64
+
+    cpu_executor: CPUExecutor = CPUExecutor()
+
     class DB(SettingsBase):
         """
         Perhaps separate this for PGDB, SqliteDB, MysqlDB etc.
@@ -135,6 +150,38 @@ class Settings(SettingsBase):
         ISOLATION_LEVEL: SQL_ISOLATIONLEVEL
         ENGINE_ECHO: bool = False
 
+        # connection pool of each worker process, see sqlalchemy.pool.QueuePool
+        POOL_SIZE: int = 5
+        MAX_OVERFLOW: int = 10
+        POOL_TIMEOUT: float = 30.0  # seconds to wait for a connection before giving up
+        POOL_USE_LIFO: bool = False  # lifo lets idle connections beyond the load expire
+        POOL_RECYCLE: int = 3600
+        POOL_PRE_PING: bool = True
+
+        @property
+        def POOL_OPTIONS(self) -> dict[str, ty.Any]:
+            "QueuePool parameters, sqlite uses a NullPool or StaticPool which takes none of them"
+            if self.DIALECT == "sqlite":
+                return {}
+            return dict(
+                pool_size=self.POOL_SIZE,
+                max_overflow=self.MAX_OVERFLOW,
+                pool_timeout=self.POOL_TIMEOUT,
+                pool_use_lifo=self.POOL_USE_LIFO,
+            )
+
+        # full urls of read replicas serving uow.trans(readonly=True)
+        REPLICA_URLS: list[str] = []
+        # seconds, replicas lagging further behind the primary are not read from
+        REPLICA_MAX_LAG: float = 1.0
+        REPLICA_PROBE_INTERVAL: float = 1.0
+
+        @field_validator("REPLICA_URLS", mode="before")
+        def _(cls, v: str | list[str]) -> list[str]:
+            if isinstance(v, list):
+                return v
+            return [url for url in v.split(",") if url]
+
         @property
         def DB_URL(self) -> str:
             proto = f"{self.DIALECT}+{self.DRIVER}" if self.DRIVER else self.DIALECT
@@ -158,9 +205,17 @@ class Settings(SettingsBase):
             """
             Driver-specific connection arguments
             https://magicstack.github.io/asyncpg/current/api/index.html
+            unset arguments are not passed to the driver
             """
 
             server_settings: dict[str, ty.Any] | None = None
+            # asyncpg only, size of sqlalchemy's prepared statement cache per connection
+            prepared_statement_cache_size: int | None = None
+            # asyncpg's own statement cache, set to 0 behind pgbouncer in transaction mode
+            statement_cache_size: int | None = None
+            max_cached_statement_lifetime: int | None = None
+            max_cacheable_statement_size: int | None = None
+            command_timeout: float | None = None
 
         connect_args: CONNECT_ARGS | None = None
 
@@ -170,6 +225,37 @@ class Settings(SettingsBase):
 
         execution_options: ExeuctionOptions | None = None
 
+        class SqliteProfile(SettingsBase):
+            """
+            Production profile for sqlite, see askgpt.infra.factory
+            pragmas are applied to every new connection.
+            """
+
+            JOURNAL_MODE: str = "WAL"
+            SYNCHRONOUS: str = "NORMAL"  # durable in WAL mode except on power loss
+            MMAP_SIZE: int = 256 * 1024 * 1024
+            CACHE_SIZE: int = -64 * 1024  # negative values are KiB
+            BUSY_TIMEOUT: int = 5000  # ms
+
+            # writes of the process go through one connection, reads through a separate pool
+            SINGLE_WRITER: bool = True
+            READ_POOL_SIZE: int = 4
+            # writers queued behind each other share one commit
+            GROUP_COMMIT: bool = False
+            GROUP_COMMIT_MAX_BATCH: int = 64
+
+        sqlite_profile: SqliteProfile | None = None
+
+        @property
+        def SQLITE_SINGLE_WRITER(self) -> bool:
+            "an in memory database is private to its connection, so it can't be split"
+            return bool(
+                self.DIALECT == "sqlite"
+                and self.sqlite_profile
+                and self.sqlite_profile.SINGLE_WRITER
+                and self.DATABASE != ":memory:"
+            )
+
     class SqliteDB(DB):
         DIALECT: str = "sqlite"
         DRIVER: str = "aiosqlite"
@@ -182,8 +268,9 @@ class Settings(SettingsBase):
         ISOLATION_LEVEL: SQL_ISOLATIONLEVEL = "SERIALIZABLE"
 
     class Postgres(DB):
-        DIALECT: str = "postgres"
-        DRIVER: str = "aiopg"
+        DIALECT: str = "postgresql"
+        DRIVER: str = "asyncpg"
+        ISOLATION_LEVEL: SQL_ISOLATIONLEVEL = "READ COMMITTED"
 
     db: DB
 
@@ -226,6 +313,33 @@ class Settings(SettingsBase):
         TOKEN_BUCKET_SCRIPT: pathlib.Path = pathlib.Path(
             "askgpt/script/tokenbucket.lua"
         )
+        TOKEN_LEASE_SCRIPT: pathlib.Path = pathlib.Path("askgpt/script/tokenlease.lua")
+        TOKEN_GIVE_BACK_SCRIPT: pathlib.Path = pathlib.Path(
+            "askgpt/script/tokengiveback.lua"
+        )
+        GCRA_SCRIPT: pathlib.Path = pathlib.Path("askgpt/script/gcra.lua")
+        ADMISSION_SCRIPT: pathlib.Path = pathlib.Path("askgpt/script/admission.lua")
+        ADMISSION_ADJUST_SCRIPT: pathlib.Path = pathlib.Path(
+            "askgpt/script/gcraadjust.lua"
+        )
+        SEMAPHORE_SCRIPT: pathlib.Path = pathlib.Path("askgpt/script/semaphore.lua")
+        SEMAPHORE_RENEW_SCRIPT: pathlib.Path = pathlib.Path(
+            "askgpt/script/semaphorerenew.lua"
+        )
+
+        @field_validator(
+            "TOKEN_BUCKET_SCRIPT",
+            "TOKEN_LEASE_SCRIPT",
+            "TOKEN_GIVE_BACK_SCRIPT",
+            "GCRA_SCRIPT",
+            "ADMISSION_SCRIPT",
+            "ADMISSION_ADJUST_SCRIPT",
+            "SEMAPHORE_SCRIPT",
+            "SEMAPHORE_RENEW_SCRIPT",
+        )
+        def _(cls, v: pathlib.Path) -> pathlib.Path:
+            "independent of the working directory"
+            return v if v.is_absolute() else SOURCE_ROOT / v
         MAX_CONNECTIONS: int = 10
         DECODE_RESPONSES: bool = True
         SOCKET_TIMEOUT: int = 10
@@ -265,11 +379,103 @@ class Settings(SettingsBase):
     class Throttling(SettingsBase):
         USER_MAX_REQUEST_PER_MINUTE: int
         USER_MAX_REQUEST_DURATION_MINUTE: int
+        # token_bucket: two hash fields per user, admissions can be leased, see MODE
+        # gcra: one string per user, every request is checked against redis
+        ALGORITHM: ty.Literal["token_bucket", "gcra"] = "token_bucket"
+        # for token_bucket only
+        # hybrid: workers lease tokens in batches and admit locally, see HybridTokenBucket
+        # strict: every request is checked against redis
+        MODE: ty.Literal["hybrid", "strict"] = "hybrid"
+        # tokens a worker takes from redis at once, up to LEASE_SIZE * workers tokens
+        # of a user can sit unused in leases, for at most LEASE_TTL seconds
+        LEASE_SIZE: int = 10
+        LEASE_TTL: float = 1.0
+        LEASE_SYNC_INTERVAL: float = 0.5
+        # limits this tight are always enforced strictly
+        STRICT_BELOW: int = 100
+
+        class Limit(SettingsBase):
+            NAME: str
+            # user: a bucket per user, model: a bucket per model shared by every user
+            SCOPE: ty.Literal["user", "model"]
+            # request: each request costs 1, checked along with USER_MAX_REQUEST_PER_MINUTE
+            # token: each completion costs its tokens, reserved before the completion and
+            # settled with the usage it reports, see ChatAdmission
+            UNIT: ty.Literal["request", "token"] = "request"
+            MAX_TOKENS: int
+            DURATION_MINUTE: float = 1
+
+        LIMITS: list[Limit] = []
+        # a token limit per user, in addition to LIMITS
+        USER_MAX_TOKENS_PER_MINUTE: int | None = None
+        # reserved for the answer of requests without max_tokens
+        COMPLETION_TOKENS_ESTIMATE: int = 512
+        # requests waiting up to MAX_WAIT seconds for tokens are held instead of rejected,
+        # at most MAX_WAITING_PER_USER of a user per worker, 0 rejects them at once
+        MAX_WAIT: float = 0.5
+        MAX_WAITING_PER_USER: int = 4
+        # reject access tokens missing from TokenRegistry, in the same call
+        CHECK_TOKEN: bool = False
+        # streams a user can have open at once, by role, e.g. {"user": 3, "admin": 20},
+        # roles left out are not capped
+        MAX_STREAMS_PER_ROLE: dict[str, int] = {}
+        # slots of a crashed worker are reclaimed after STREAM_LEASE_TTL seconds,
+        # live ones are renewed three times as often
+        STREAM_LEASE_TTL: float = 30
+
+        class PreAuth(SettingsBase):
+            # attempts at auth/login and auth/signup, per client ip and per email,
+            # checked before the body is parsed and the password hashed, see PreAuthMiddleware
+            IP_MAX_ATTEMPTS_PER_MINUTE: int = 10
+            EMAIL_MAX_ATTEMPTS_PER_MINUTE: int = 5
+            # from LOCKOUT_THRESHOLD failed logins of an ip or an email, it is locked out
+            # for LOCKOUT_BASE seconds, doubled by each further failure up to LOCKOUT_MAX,
+            # failures are forgotten once FAILURE_WINDOW seconds pass without one
+            LOCKOUT_THRESHOLD: int = 5
+            LOCKOUT_BASE: float = 30
+            LOCKOUT_MAX: float = 3600
+            FAILURE_WINDOW: float = 3600
+            # never limited, addresses or networks, e.g. "10.0.0.0/8", and emails
+            ALLOW_NETWORKS: list[str] = []
+            ALLOW_EMAILS: list[str] = []
+            # bodies larger than this are only limited by ip
+            MAX_BODY_SIZE: int = 16 * 1024
+
+        pre_auth: PreAuth = PreAuth()
 
     throttling: Throttling
 
     class EventRecord(SettingsBase):
         EVENT_FETCH_INTERVAL: float = 0.1
+        VALIDATE_ON_LOAD: bool = False  # run pydantic validation when reading events
+        # compress event bodies with the active zstd dictionary, see askgpt.infra.bodycodec
+        COMPRESS_BODY: bool = False
+        COMPRESSION_LEVEL: int = 3
+        # seconds between reads of the active dictionary, to pick up one activated after startup
+        CODEC_REFRESH_INTERVAL: float = 60
+        # move events of sessions idle longer than this to event_archives, None disables it
+        ARCHIVE_IDLE_DAYS: float | None = None
+        ARCHIVE_INTERVAL: float = 3600
+        ARCHIVE_BATCH_SIZE: int = 100
+        # reads include archived events, on while ARCHIVE_IDLE_DAYS is set,
+        # keep it on after disabling archiving for as long as archives remain
+        READ_ARCHIVE: bool = False
+        # strings at least this long are stored once in content_blobs, None disables it,
+        # blobs are kept for as long as the events referencing them, which is forever
+        BLOB_THRESHOLD: int | None = None
+        BLOB_CACHE_SIZE: int = 32 * 1024 * 1024
+        # add_all batches at least this large are written with COPY on asyncpg, None disables it
+        COPY_THRESHOLD: int | None = 1000
+        # order events by their uuid7 ids, enable once events with uuid4 ids are gone
+        ORDER_BY_ID: bool = False
+        # "segments" keeps events in append-only files of SEGMENT_DIR instead of the database,
+        # for single node deployments, see askgpt.infra.segmentstore.
+        # events are then not written in the database transaction,
+        # archiving, blobs and COPY only apply to "database"
+        BACKEND: ty.Literal["database", "segments"] = "database"
+        SEGMENT_DIR: pathlib.Path = pathlib.Path("events")
+        SEGMENT_SIZE: int = 64 * 1024 * 1024
+        SEGMENT_FSYNC: ty.Literal["always", "batch", "never"] = "batch"
 
     event_record: EventRecord
 
@@ -42,6 +42,12 @@ class EntityNotFoundError(GeneralWebError):
     "Entity not found"
 
 
+class ServerBusyError(GeneralWebError):
+    "Server is too busy to take the request, it can be retried shortly"
+
+    source: ErrorSource = "server"
+
+
 class BoostrapingFailedError(GeneralAPPError):
     """
     Raised when the app failed to bootstrap.
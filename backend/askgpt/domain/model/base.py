@@ -1,7 +1,6 @@
 import abc
 import datetime
 import typing as ty
-import uuid
 from dataclasses import dataclass
 from functools import singledispatchmethod
 
@@ -17,6 +16,7 @@ from pydantic import computed_field as computed_field
 from pydantic import field_serializer as field_serializer
 
 from askgpt.domain.model.interface import ICommand, IEvent
+from askgpt.helpers.ids import uuid7
 from askgpt.helpers.string import str_to_snake
 from askgpt.helpers.time import utc_now as utc_now
 
@@ -33,7 +33,8 @@ as we do not need data validation in domain layer
 
 
 def uuid_factory() -> str:
-    return str(uuid.uuid4())
+    "time ordered, ids of events, sessions and users sort in creation order"
+    return str(uuid7())
 
 
 def request_id_factory() -> bytes:
@@ -0,0 +1,138 @@
+"""
+In process metrics, served as json by GET /health/metrics.
+
+Metrics are registered by name on first use, so components can create them at import or build time:
+
+>>> checkouts = metrics.counter("db.primary.pool.checkouts")
+>>> checkouts.inc()
+
+values that are cheaper to read on demand, e.g. the size of a pool,
+are registered as collectors and evaluated on every snapshot.
+"""
+
+import bisect
+import math
+import typing as ty
+
+# seconds, suited for waits and latencies
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    30.0,
+)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> int:
+        return self.value
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value: float = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+class Histogram:
+    "count, sum, max and cumulative bucket counts of observed values"
+
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, buckets: ty.Sequence[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self) -> dict[str, ty.Any]:
+        buckets: dict[str, int] = {}
+        cumulative = 0
+        for bound, count in zip((*self.bounds, math.inf), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return dict(count=self.count, sum=self.total, max=self.max, buckets=buckets)
+
+
+type Metric = Counter | Gauge | Histogram
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: dict[str, ty.Callable[[], ty.Mapping[str, float]]] = {}
+
+    def _get[T: Metric](self, name: str, metric_type: type[T], factory: ty.Callable[[], T]) -> T:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = factory()
+        elif not isinstance(metric, metric_type):
+            raise TypeError(f"metric {name} is a {type(metric).__name__}")
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get(name, Gauge, Gauge)
+
+    def histogram(
+        self, name: str, buckets: ty.Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._get(name, Histogram, lambda: Histogram(buckets))
+
+    def register_collector(
+        self, prefix: str, collect: ty.Callable[[], ty.Mapping[str, float]]
+    ) -> None:
+        "collect() returns values keyed by name, reported as `prefix.name`"
+        self._collectors[prefix] = collect
+
+    def snapshot(self) -> dict[str, ty.Any]:
+        data: dict[str, ty.Any] = {
+            name: metric.snapshot() for name, metric in self._metrics.items()
+        }
+        for prefix, collect in self._collectors.items():
+            for name, value in collect().items():
+                data[f"{prefix}.{name}"] = value
+        return dict(sorted(data.items()))
+
+    def clear(self) -> None:
+        self._metrics.clear()
+        self._collectors.clear()
+
+
+metrics = MetricsRegistry()
@@ -1,3 +1,6 @@
+import asyncio
+import datetime
+import time
 import typing as ty
 from contextlib import asynccontextmanager
 from contextvars import ContextVar
@@ -13,6 +16,9 @@ from sqlalchemy.sql import Executable, FromClause, func, text
 from askgpt.helpers.string import str_to_snake
 
 type StrMap = ty.Mapping[str, ty.Any]
+
+# inserts of at least this many rows are written with COPY on asyncpg
+COPY_THRESHOLD = 1000
 type SQL_ISOLATIONLEVEL = ty.Literal[
     "SERIALIZABLE",
     "REPEATABLE READ",
@@ -27,6 +33,38 @@ class IEngine(ty.Protocol):
     @asynccontextmanager
     async def begin(self) -> ty.AsyncGenerator[AsyncConnection, None]: ...
 
+    def connect(self) -> AsyncConnection: ...
+
+    async def acquire(self) -> AsyncConnection:
+        "a started connection checked out from the pool"
+        ...
+
+
+class IReplicas(ty.Protocol):
+    def pick(self, fresh_after: float | None = None) -> IEngine | None:
+        """
+        a healthy replica that has replayed every write committed before `fresh_after`(unix time),
+        None when reads should go to the primary
+        """
+        ...
+
+
+class IWriter(ty.Protocol):
+    "runs write transactions on a connection it owns, e.g. to serialize writers"
+
+    def transaction(self) -> ty.AsyncContextManager[AsyncConnection]: ...
+
+
+class WriteFence(ty.Protocol):
+    """
+    Remembers when a key(e.g. a user) last wrote to the primary,
+    shared between processes so that its later reads are not served by a replica that is behind.
+    """
+
+    async def last_write(self, key: str) -> float | None: ...
+
+    async def record(self, key: str, at: float) -> None: ...
+
 
 class ExecutionOptions(ty.TypedDict, total=False):
     """
@@ -73,15 +111,31 @@ def engine_factory(
     pool_pre_ping: bool = True,
     pool_recycle: int = 3600,
     poolclass: type[sa.Pool] | None = None,
+    pool_size: int | None = None,
+    max_overflow: int | None = None,
+    pool_timeout: float | None = None,
+    pool_use_lifo: bool = False,
     execution_options: dict[str, ty.Any] | None = None,
     isolation_level: sa.engine.interfaces.IsolationLevel = "READ COMMITTED",
 ):
+    """
+    pool_size, max_overflow, pool_timeout and pool_use_lifo only apply to QueuePool,
+    they are left out when None, e.g. for sqlite :memory: which uses a StaticPool.
+    """
     extra: dict[str, ty.Any] = dict()
 
     if execution_options:
         extra.update(execution_options=execution_options)
     if connect_args:
         extra.update(connect_args=connect_args)
+    if pool_size is not None:
+        extra.update(pool_size=pool_size)
+    if max_overflow is not None:
+        extra.update(max_overflow=max_overflow)
+    if pool_timeout is not None:
+        extra.update(pool_timeout=pool_timeout)
+    if pool_use_lifo:
+        extra.update(pool_use_lifo=pool_use_lifo)
 
     engine = sa.create_engine(
         db_url,
@@ -144,17 +198,119 @@ class OutOfContextError(Exception):
         super().__init__(msg)
 
 
+class ReadOnlyTransactionError(Exception):
+    "raised when a write transaction is opened inside a readonly one"
+
+    def __init__(self):
+        super().__init__(
+            "trans() can't be nested in trans(readonly=True), "
+            "the enclosing transaction may be on a replica and rejects writes"
+        )
+
+
+def _naive_utc(value: datetime.datetime | None) -> datetime.datetime | None:
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.UTC).replace(tzinfo=None)
+
+
+class UnitOfWorkStats:
+    "connection usage of a single `UnitOfWork.scope`"
+
+    __slots__ = ("checkouts", "transactions", "savepoints", "replica_reads")
+
+    def __init__(self):
+        self.checkouts = 0
+        self.transactions = 0
+        self.savepoints = 0
+        self.replica_reads = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(checkouts={self.checkouts}, "
+            f"transactions={self.transactions}, savepoints={self.savepoints}, "
+            f"replica_reads={self.replica_reads})"
+        )
+
+
+class _Scope:
+    def __init__(self):
+        self.owner = asyncio.current_task()
+        self.connection: AsyncConnection | None = None
+        self.replica: tuple[IEngine, AsyncConnection] | None = None
+        self.stats = UnitOfWorkStats()
+        self.closed = False
+        # reads of the scope must observe writes committed before this time
+        self.fresh_after: float | None = None
+        self.key: str | None = None
+        self.fence_loaded = False
+
+    async def close(self) -> None:
+        self.closed = True
+        if self.connection is not None:
+            await self.connection.close()
+        if self.replica is not None:
+            await self.replica[1].close()
+
+
+class _Transaction:
+    __slots__ = ("connection", "owner", "readonly", "wrote")
+
+    def __init__(
+        self,
+        connection: AsyncConnection,
+        owner: asyncio.Task[ty.Any] | None,
+        readonly: bool,
+    ):
+        self.connection = connection
+        self.owner = owner
+        self.readonly = readonly
+        # whether a statement of the transaction, or of its savepoints, wrote
+        self.wrote = False
+
+
+WRITE_KEYWORDS = frozenset(("INSERT", "UPDATE", "DELETE", "REPLACE", "MERGE", "UPSERT"))
+
+
+def _is_write(query: Executable) -> bool:
+    if isinstance(query, sa.TextClause):
+        keyword, *_ = query.text.lstrip().split(None, 1) or [""]
+        return keyword.upper() in WRITE_KEYWORDS
+    return bool(getattr(query, "is_dml", False))
+
+
 class UnitOfWork:
     """
     Unit of Work pattern implementation to manage database connections using ContextVar,
     ensuring that each coroutine gets its own connection.
 
     This approach prevents shared connections across different async tasks, similar to a transaction scope in .NET.
+
+    Within `scope()`, every `trans()` reuses the same connection instead of checking out a new one,
+    a `trans()` nested in another one becomes a savepoint.
+
+    With `replicas`, `trans(readonly=True)` reads from a replica unless the scope,
+    or the key it `track`s, wrote more recently than the replica has replayed.
+    With `writer`, other transactions are handed to it instead of checking out a connection.
     """
 
-    def __init__(self, aiodb: IEngine):
+    def __init__(
+        self,
+        aiodb: IEngine,
+        *,
+        replicas: IReplicas | None = None,
+        fence: WriteFence | None = None,
+        writer: IWriter | None = None,
+    ):
         self._aiodb = aiodb
+        self._replicas = replicas
+        self._fence = fence
+        self._writer = writer
         self._connection_context = ContextVar[AsyncConnection]("connection_context")
+        self._transaction_context = ContextVar[_Transaction | None](
+            "transaction_context", default=None
+        )
+        self._scope_context = ContextVar[_Scope | None]("scope_context", default=None)
 
     @property
     def conn(self) -> AsyncConnection:
@@ -165,6 +321,17 @@ class UnitOfWork:
             raise OutOfContextError(self._aiodb) from e
         return _conn
 
+    def _mark_write(self) -> None:
+        "writes are recorded for read-your-writes once their transaction commits"
+        if (current := self._transaction_context.get()) is not None:
+            current.wrote = True
+
+    @property
+    def stats(self) -> UnitOfWorkStats | None:
+        "stats of the current scope, None outside of scope()"
+        scope = self._scope_context.get()
+        return scope.stats if scope else None
+
     async def execute(
         self,
         query: str | Executable,
@@ -174,23 +341,239 @@ class UnitOfWork:
     ):
         if isinstance(query, str):
             query = text(query)
+        if _is_write(query):
+            self._mark_write()
         return await self.conn.execute(
             statement=query,
             parameters=parameters,
             execution_options=execution_options,
         )
 
+    async def stream(
+        self,
+        query: str | Executable,
+        *,
+        parameters: StrMap | None = None,
+        execution_options: StrMap | ExecutionOptions | None = None,
+    ) -> sa_aio.AsyncResult[ty.Any]:
+        """
+        Execute query with a server side cursor, rows are fetched lazily
+        use execution_options={"yield_per": n} to control the buffer size.
+        """
+        if isinstance(query, str):
+            query = text(query)
+        return await self.conn.stream(
+            query,
+            parameters=parameters,
+            execution_options=execution_options,
+        )
+
+    async def bulk_insert(
+        self,
+        table: sa.Table,
+        rows: ty.Sequence[StrMap],
+        *,
+        copy_threshold: int | None = COPY_THRESHOLD,
+    ) -> None:
+        """
+        insert rows sharing the same keys, as an executemany whose statement is compiled once,
+        or with COPY on asyncpg when there are at least `copy_threshold` rows.
+        """
+        if not rows:
+            return
+        conn = self.conn
+        self._mark_write()
+        if (
+            copy_threshold is not None
+            and len(rows) >= copy_threshold
+            and conn.dialect.driver == "asyncpg"
+        ):
+            await self._copy(table, rows)
+        else:
+            await conn.execute(sa.insert(table), list(rows))
+
+    def _copy_processor(
+        self, type_: sa.types.TypeEngine[ty.Any]
+    ) -> ty.Callable[[ty.Any], ty.Any] | None:
+        if isinstance(type_, sa.DateTime) and not type_.timezone:
+            # binary copy rejects aware datetimes for timestamp columns, which are utc
+            return _naive_utc
+        dialect = self.conn.dialect
+        return type_.dialect_impl(dialect).bind_processor(dialect)
+
+    async def _copy(self, table: sa.Table, rows: ty.Sequence[StrMap]) -> None:
+        conn = self.conn
+        columns = list(rows[0])
+        # e.g. json columns are serialized by sqlalchemy before reaching the driver
+        processors = [self._copy_processor(table.c[name].type) for name in columns]
+        records = [
+            tuple(
+                process(row[name]) if process else row[name]
+                for name, process in zip(columns, processors)
+            )
+            for row in rows
+        ]
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(  # type: ignore
+            table.name, records=records, columns=columns, schema_name=table.schema
+        )
+
+    @asynccontextmanager
+    async def scope(self) -> ty.AsyncGenerator[UnitOfWorkStats, None]:
+        """
+        Share one connection between every trans() of the current task,
+        e.g. for the lifetime of a request.
+        The connection is checked out on the first trans() and returned when scope exits.
+        """
+        current = self._scope_context.get()
+        if current is not None and not current.closed:
+            yield current.stats
+            return
+
+        scope = _Scope()
+        self._scope_context.set(scope)
+        try:
+            yield scope.stats
+        finally:
+            await scope.close()
+
+    def track(self, key: str) -> None:
+        """
+        reads of the current scope observe writes made under key in other scopes,
+        e.g. by the same user in an earlier request, writes of the scope are recorded under key.
+        """
+        scope = self._scope_context.get()
+        if scope is not None and not scope.closed:
+            scope.key = key
+
+    async def _fresh_after(self, scope: _Scope | None) -> float | None:
+        if scope is None:
+            return None
+        if scope.key and self._fence and not scope.fence_loaded:
+            scope.fence_loaded = True
+            last_write = await self._fence.last_write(scope.key)
+            if last_write is not None:
+                scope.fresh_after = max(scope.fresh_after or 0, last_write)
+        return scope.fresh_after
+
+    async def _record_write(self, scope: _Scope | None) -> None:
+        if scope is None or self._replicas is None:
+            return
+        scope.fresh_after = now = time.time()
+        if scope.key and self._fence:
+            await self._fence.record(scope.key, now)
+
+    async def _checkout_replica(
+        self, scope: _Scope | None, replica: IEngine
+    ) -> tuple[AsyncConnection, bool]:
+        if scope is None:
+            return await replica.acquire(), True
+        scope.stats.replica_reads += 1
+        if scope.replica is not None:
+            if scope.replica[0] is replica:
+                return scope.replica[1], False
+            await scope.replica[1].close()
+        scope.replica = (replica, await replica.acquire())
+        scope.stats.checkouts += 1
+        return scope.replica[1], False
+
+    async def _checkout(
+        self, scope: _Scope | None, readonly: bool = False
+    ) -> tuple[AsyncConnection, bool]:
+        "returns (connection, whether it should be closed after the transaction)"
+        if readonly and self._replicas is not None:
+            replica = self._replicas.pick(await self._fresh_after(scope))
+            if replica is not None:
+                return await self._checkout_replica(scope, replica)
+        if scope is None:
+            return await self._aiodb.acquire(), True
+        if scope.connection is None:
+            scope.connection = await self._aiodb.acquire()
+            scope.stats.checkouts += 1
+        return scope.connection, False
+
+    async def _set_readonly(self, connection: AsyncConnection, readonly: bool) -> None:
+        match connection.dialect.name:
+            case "postgresql" if readonly:
+                await connection.execute(text("SET TRANSACTION READ ONLY"))
+            case "sqlite":
+                await connection.exec_driver_sql(f"PRAGMA query_only = {int(readonly)}")
+            case _:
+                pass
+
     @asynccontextmanager
-    async def trans(self) -> ty.AsyncGenerator[ty.Self, None]:
+    async def trans(self, *, readonly: bool = False) -> ty.AsyncGenerator[ty.Self, None]:
         """
         An async context manager to handle the lifecycle of the UnitOfWork transaction.
         This allows for reusing the same UnitOfWork instance across multiple objects.
+
+        readonly: the transaction only reads, it is rolled back instead of committed
+        and the database rejects writes where supported, it is served by a replica when one is fresh enough.
+        a write trans() nested in a readonly one raises ReadOnlyTransactionError.
         """
-        transaction = self._aiodb.begin()
-        connection = await transaction.__aenter__()
-        token = self._connection_context.set(connection)
+        task = asyncio.current_task()
+        scope = self._scope_context.get()
+        if scope is not None and (scope.closed or scope.owner is not task):
+            scope = None
+
+        current = self._transaction_context.get()
+        if current is not None and current.owner is task:
+            if current.readonly and not readonly:
+                raise ReadOnlyTransactionError()
+            if readonly:
+                # reads see the enclosing transaction, no savepoint needed
+                yield self
+                return
+            async with current.connection.begin_nested():
+                if scope:
+                    scope.stats.savepoints += 1
+                yield self
+            return
+
+        if not readonly and self._writer is not None:
+            async with self._writer.transaction() as connection:
+                if scope:
+                    scope.stats.transactions += 1
+                conn_token = self._connection_context.set(connection)
+                current = _Transaction(connection, task, readonly)
+                trans_token = self._transaction_context.set(current)
+                try:
+                    yield self
+                finally:
+                    self._transaction_context.reset(trans_token)
+                    self._connection_context.reset(conn_token)
+            if current.wrote:
+                await self._record_write(scope)
+            return
+
+        connection, release = await self._checkout(scope, readonly)
+        conn_token = self._connection_context.set(connection)
+        current = _Transaction(connection, task, readonly)
+        trans_token = self._transaction_context.set(current)
         try:
-            yield self
+            transaction = await connection.begin()
+            if scope:
+                scope.stats.transactions += 1
+            if readonly:
+                await self._set_readonly(connection, True)
+            try:
+                yield self
+            except BaseException:
+                if readonly:
+                    await self._set_readonly(connection, False)
+                await transaction.rollback()
+                raise
+            else:
+                if readonly:
+                    # query_only is per connection, undo it before the connection is reused
+                    await self._set_readonly(connection, False)
+                    await transaction.rollback()
+                else:
+                    await transaction.commit()
+                    if current.wrote:
+                        await self._record_write(scope)
         finally:
-            await transaction.__aexit__(None, None, None)
-            self._connection_context.reset(token)
+            self._transaction_context.reset(trans_token)
+            self._connection_context.reset(conn_token)
+            if release:
+                await connection.close()
@@ -0,0 +1,271 @@
+"""
+Hot/cold tiering for domain events.
+
+Streams of sessions idle for longer than `idle_days` are moved out of domain_events
+into a single compressed row of event_archives,
+so the hot table and its indexes grow with active sessions instead of total history.
+
+Reads of an archived stream decode its archive next to its hot events without writing,
+a stream is faulted back into domain_events by an explicit `restore` on a write path,
+e.g. when its session is written to again, the stub row remembers when,
+so the stream won't be archived again until it goes idle.
+"""
+
+import asyncio
+import datetime
+import typing as ty
+from contextlib import asynccontextmanager
+
+import orjson
+import sqlalchemy as sa
+
+from askgpt.helpers._log import logger
+from askgpt.helpers.sql import UnitOfWork
+from askgpt.helpers.time import utc_now
+from askgpt.infra import bodycodec
+from askgpt.infra.bodycodec import BodyCodecs
+from askgpt.infra.schema import DomainEventsTable, EventArchivesTable, SessionsTable
+
+# archives are written once and rarely read, trade cpu for size
+ARCHIVE_LEVEL = 9
+
+# event_id, event_type, version, gmt_created, event_body, blob_refs
+type ArchiveRecord = tuple[str, str, str, str, str, list[str] | None]
+
+
+def _db_now() -> datetime.datetime:
+    "gmt columns are stored as naive utc"
+    return utc_now().replace(tzinfo=None)
+
+
+class EventArchive:
+    def __init__(
+        self, uow: UnitOfWork, bodies: BodyCodecs, *, level: int = ARCHIVE_LEVEL
+    ):
+        self._uow = uow
+        self._bodies = bodies
+        self._level = level
+
+    def _record(self, row: sa.RowMapping) -> ArchiveRecord:
+        body = self._bodies.raw_body(
+            row["event_body"], row["body_codec"], row["event_blob"]
+        )
+        return (
+            row["id"],
+            row["event_type"],
+            row["version"],
+            row["gmt_created"].isoformat(),
+            body.decode(),
+            row["blob_refs"],
+        )
+
+    def _pack(self, records: list[ArchiveRecord]) -> bytes:
+        return bodycodec.compress(orjson.dumps(records), level=self._level)
+
+    def _unpack(self, blob: bytes) -> list[ArchiveRecord]:
+        return [tuple(record) for record in orjson.loads(bodycodec.decompress(blob))]
+
+    def _row(self, entity_id: str, record: ArchiveRecord) -> dict[str, ty.Any]:
+        event_id, event_type, version, gmt_created, body, blob_refs = record
+        codec_id, blob = self._bodies.encode(body.encode())
+        return {
+            "id": event_id,
+            "entity_id": entity_id,
+            "event_type": event_type,
+            "version": version,
+            "gmt_created": datetime.datetime.fromisoformat(gmt_created),
+            "event_body": None if codec_id else body,
+            "body_codec": codec_id,
+            "event_blob": blob if codec_id else None,
+            "blob_refs": blob_refs,
+        }
+
+    def _plain_row(self, entity_id: str, record: ArchiveRecord) -> dict[str, ty.Any]:
+        "a row as read from domain_events, with its body left uncompressed"
+        event_id, event_type, version, gmt_created, body, blob_refs = record
+        return {
+            "id": event_id,
+            "entity_id": entity_id,
+            "event_type": event_type,
+            "version": version,
+            "gmt_created": datetime.datetime.fromisoformat(gmt_created),
+            "event_body": body,
+            "body_codec": None,
+            "event_blob": None,
+            "blob_refs": blob_refs,
+        }
+
+    async def load(self, entity_id: str) -> list[dict[str, ty.Any]]:
+        "rows of the archived events of the entity, oldest first, without restoring them"
+        stmt = sa.select(EventArchivesTable.events).where(
+            EventArchivesTable.entity_id == entity_id,
+            EventArchivesTable.events.is_not(None),
+        )
+        blob = (await self._uow.execute(stmt)).scalar()
+        if blob is None:
+            return []
+        return [self._plain_row(entity_id, record) for record in self._unpack(blob)]
+
+    async def archive(self, entity_id: str) -> int:
+        """
+        move hot events of the entity into its archive,
+        returns number of events moved, should be called within uow.trans()
+        """
+        stmt = (
+            sa.select(DomainEventsTable)
+            .where(DomainEventsTable.entity_id == entity_id)
+            .order_by(DomainEventsTable.gmt_created, DomainEventsTable.id)
+        )
+        rows = (await self._uow.execute(stmt)).mappings().all()
+        if not rows:
+            return 0
+        await self._bodies.ensure_known(self._uow, (row["body_codec"] for row in rows))
+        records = [self._record(row) for row in rows]
+
+        stub_stmt = sa.select(EventArchivesTable.events).where(
+            EventArchivesTable.entity_id == entity_id
+        )
+        stub = (await self._uow.execute(stub_stmt)).first()
+        if stub and stub.events:
+            # events appended to an archived stream without reading it first
+            records = self._unpack(stub.events) + records
+
+        values = dict(
+            events=self._pack(records),
+            event_count=len(records),
+            archived_at=_db_now(),
+        )
+        if stub is None:
+            await self._uow.execute(
+                sa.insert(EventArchivesTable).values(entity_id=entity_id, **values)
+            )
+        else:
+            await self._uow.execute(
+                sa.update(EventArchivesTable)
+                .where(EventArchivesTable.entity_id == entity_id)
+                .values(**values)
+            )
+        await self._uow.execute(
+            sa.delete(DomainEventsTable).where(
+                DomainEventsTable.entity_id == entity_id,
+                DomainEventsTable.id.in_([row["id"] for row in rows]),
+            )
+        )
+        return len(rows)
+
+    async def restore(self, entity_id: str) -> int:
+        """
+        move archived events of the entity back to domain_events,
+        returns number of events restored, should be called within uow.trans()
+        """
+        stmt = sa.select(EventArchivesTable.events).where(
+            EventArchivesTable.entity_id == entity_id,
+            EventArchivesTable.events.is_not(None),
+        )
+        blob = (await self._uow.execute(stmt)).scalar()
+        if blob is None:
+            return 0
+
+        await self._bodies.ensure_active(self._uow)
+        hot_ids_stmt = sa.select(DomainEventsTable.id).where(
+            DomainEventsTable.entity_id == entity_id
+        )
+        # rows an interrupted archive run didn't get to delete
+        hot_ids = set((await self._uow.execute(hot_ids_stmt)).scalars())
+        rows = [
+            self._row(entity_id, record)
+            for record in self._unpack(blob)
+            if record[0] not in hot_ids
+        ]
+        await self._uow.bulk_insert(DomainEventsTable.__table__, rows)  # type: ignore
+        await self._uow.execute(
+            sa.update(EventArchivesTable)
+            .where(EventArchivesTable.entity_id == entity_id)
+            .values(events=None, event_count=0, restored_at=_db_now())
+        )
+        return len(rows)
+
+    async def idle_streams(self, cutoff: datetime.datetime, *, limit: int) -> list[str]:
+        "sessions with no events and no fault-in since cutoff"
+        restored = sa.select(EventArchivesTable.entity_id).where(
+            EventArchivesTable.restored_at >= cutoff
+        )
+        stmt = (
+            sa.select(DomainEventsTable.entity_id)
+            .where(
+                DomainEventsTable.entity_id.in_(sa.select(SessionsTable.id)),
+                DomainEventsTable.entity_id.not_in(restored),
+            )
+            .group_by(DomainEventsTable.entity_id)
+            .having(sa.func.max(DomainEventsTable.gmt_created) < cutoff)
+            .limit(limit)
+        )
+        return list((await self._uow.execute(stmt)).scalars())
+
+    async def archive_idle(self, idle_days: float, *, batch_size: int = 100) -> int:
+        "archive every session idle for longer than idle_days, one transaction per stream"
+        cutoff = _db_now() - datetime.timedelta(days=idle_days)
+        total = 0
+        while True:
+            async with self._uow.trans():
+                entity_ids = await self.idle_streams(cutoff, limit=batch_size)
+            if not entity_ids:
+                return total
+            for entity_id in entity_ids:
+                async with self._uow.trans():
+                    total += await self.archive(entity_id)
+
+
+class EventArchiver:
+    """
+    Background job that archives idle sessions every `interval` seconds.
+    """
+
+    def __init__(
+        self,
+        archive: EventArchive,
+        *,
+        idle_days: float,
+        interval: float = 3600,
+        batch_size: int = 100,
+    ):
+        self._archive = archive
+        self._idle_days = idle_days
+        self._interval = interval
+        self._batch_size = batch_size
+        self.__main_task: asyncio.Task[ty.Any] | None = None
+
+    async def _run_forever(self):
+        while True:
+            try:
+                count = await self._archive.archive_idle(
+                    self._idle_days, batch_size=self._batch_size
+                )
+            except Exception:
+                logger.exception("Failed to archive idle sessions")
+            else:
+                if count:
+                    logger.info(f"Archived {count} events of idle sessions")
+            await asyncio.sleep(self._interval)
+
+    async def start(self):
+        if self.__main_task is None or self.__main_task.done():
+            self.__main_task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self.__main_task is not None:
+            self.__main_task.cancel()
+            try:
+                await self.__main_task
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.__main_task = None
+
+    @asynccontextmanager
+    async def lifespan(self):
+        try:
+            await self.start()
+            yield self
+        finally:
+            await self.stop()
@@ -0,0 +1,181 @@
+"""
+Content addressed storage for large strings in event bodies.
+
+Users paste the same system prompts and documents across sessions,
+instead of storing them inline in every event, strings longer than `threshold`
+are saved once in content_blobs keyed by their sha256,
+and replaced in the event body by a reference `{"$blob": <hash>}`,
+user dicts shaped like a reference are stored as `{"$escape": <dict>}`.
+
+Blobs are permanent: events are never deleted and archived ones keep their references,
+so a blob is never known to be unreferenced and nothing removes it.
+"""
+
+import hashlib
+import typing as ty
+from collections import OrderedDict
+
+import sqlalchemy as sa
+
+from askgpt.helpers.sql import UnitOfWork
+from askgpt.infra.schema import ContentBlobsTable
+
+BLOB_REF = "$blob"
+BLOB_ESCAPE = "$escape"
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _is_marker(value: dict[str, ty.Any]) -> bool:
+    return len(value) == 1 and (BLOB_REF in value or BLOB_ESCAPE in value)
+
+
+def resolve_refs(value: ty.Any, contents: ty.Mapping[str, str]) -> ty.Any:
+    "replace every blob reference in value with its content, and unescape user dicts"
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if BLOB_REF in value:
+                return contents[value[BLOB_REF]]
+            if BLOB_ESCAPE in value:
+                value = value[BLOB_ESCAPE]
+        return {k: resolve_refs(v, contents) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve_refs(v, contents) for v in value]
+    return value
+
+
+class BlobCache:
+    """
+    LRU of blob contents, bounded by total size rather than number of entries
+    since a single pasted document can be larger than hundreds of prompts.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self._max_size = max_size
+        self._size = 0
+        self._data: OrderedDict[str, str] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> str | None:
+        if (content := self._data.get(key)) is not None:
+            self._data.move_to_end(key)
+        return content
+
+    def set(self, key: str, content: str) -> None:
+        if key in self._data:
+            self._data.move_to_end(key)
+            return
+        if len(content) > self._max_size:
+            return
+        self._data[key] = content
+        self._size += len(content)
+        while self._size > self._max_size:
+            _, evicted = self._data.popitem(last=False)
+            self._size -= len(evicted)
+
+
+class BlobBatch:
+    "blobs referenced by events written in the same call"
+
+    def __init__(self, threshold: int):
+        self._threshold = threshold
+        self.contents: dict[str, str] = {}
+        self._escaped = False
+
+    def _extract(self, value: ty.Any, refs: set[str]) -> ty.Any:
+        if isinstance(value, str):
+            if len(value) < self._threshold:
+                return value
+            key = content_hash(value)
+            self.contents[key] = value
+            refs.add(key)
+            return {BLOB_REF: key}
+        if isinstance(value, dict):
+            extracted = {k: self._extract(v, refs) for k, v in value.items()}
+            if _is_marker(value):
+                self._escaped = True
+                return {BLOB_ESCAPE: extracted}
+            return extracted
+        if isinstance(value, list):
+            return [self._extract(v, refs) for v in value]
+        return value
+
+    def externalize(self, data: dict[str, ty.Any]) -> list[str] | None:
+        """
+        replace large strings in data with references, returns the hashes referenced,
+        an empty list when data only has escaped dicts, so it is still resolved
+        """
+        refs: set[str] = set()
+        self._escaped = False
+        for key, value in data.items():
+            data[key] = self._extract(value, refs)
+        if refs or self._escaped:
+            return sorted(refs)
+        return None
+
+
+class BlobStore:
+    def __init__(
+        self,
+        *,
+        threshold: int | None = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        self._threshold = threshold
+        self._cache = BlobCache(cache_size)
+
+    def batch(self) -> BlobBatch | None:
+        "None when externalizing is disabled"
+        return BlobBatch(self._threshold) if self._threshold else None
+
+    def _insert(self, uow: UnitOfWork) -> ty.Any:
+        match uow.conn.dialect.name:
+            case "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+            case "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            case dialect:
+                raise NotImplementedError(f"content blobs are not supported on {dialect}")
+        return insert(ContentBlobsTable).on_conflict_do_nothing(
+            index_elements=[ContentBlobsTable.hash]
+        )
+
+    async def retain(self, uow: UnitOfWork, batch: BlobBatch | None) -> None:
+        """
+        save new blobs, should be called within uow.trans(),
+        the cache is left to `resolve` so it never holds blobs of a rolled back transaction
+        """
+        if not batch or not batch.contents:
+            return
+        values = [
+            dict(hash=key, content=content, size=len(content))
+            for key, content in batch.contents.items()
+        ]
+        await uow.execute(self._insert(uow), parameters=values)
+
+    async def resolve(
+        self, uow: UnitOfWork, refs: ty.Iterable[str]
+    ) -> dict[str, str]:
+        "contents of refs, from the cache when hot"
+        contents: dict[str, str] = {}
+        missing: set[str] = set()
+        for ref in refs:
+            if ref in contents:
+                continue
+            if (content := self._cache.get(ref)) is None:
+                missing.add(ref)
+            else:
+                contents[ref] = content
+        if missing:
+            stmt = sa.select(ContentBlobsTable.hash, ContentBlobsTable.content).where(
+                ContentBlobsTable.hash.in_(missing)
+            )
+            for key, content in (await uow.execute(stmt)).all():
+                contents[key] = content
+                self._cache.set(key, content)
+        return contents
@@ -0,0 +1,381 @@
+"""
+Dictionary compression for domain event bodies.
+
+Chat events repeat the same keys, roles and phrasing in every row,
+zstd with a dictionary trained on our own events compresses them far better than plain zstd,
+especially for short bodies.
+
+Every compressed row stores the id of the codec that encoded it,
+dictionaries are kept in `event_body_codecs` and never deleted,
+so a dictionary can be rotated while rows written with older ones stay readable.
+
+Train a new dictionary from recent events and make it active:
+    python -m askgpt.infra.bodycodec train --samples 20000
+List dictionaries:
+    python -m askgpt.infra.bodycodec list
+Rewrite rows with the active dictionary:
+    python -m askgpt.infra.bodycodec recompress
+"""
+
+import argparse
+import asyncio
+import time
+import typing as ty
+
+import sqlalchemy as sa
+
+from askgpt.domain.errors import GeneralAPPError
+from askgpt.domain.model.base import json_dumps
+from askgpt.helpers.sql import UnitOfWork
+from askgpt.infra.schema import DomainEventsTable, EventBodyCodecsTable
+
+DEFAULT_LEVEL = 3
+DEFAULT_DICT_SIZE = 64 * 1024
+DEFAULT_SAMPLE_SIZE = 20_000
+
+# events that make up most of domain_events, used as training samples
+CHAT_EVENT_TYPES = ("chat_message_sent", "chat_response_received")
+
+
+class BodyCodecError(GeneralAPPError): ...
+
+
+class BodyCodecUnavailableError(BodyCodecError):
+    "Raised when zstandard is not installed"
+
+    def __init__(self):
+        super().__init__("zstandard is required to use compressed event bodies")
+
+
+class UnknownBodyCodecError(BodyCodecError):
+    def __init__(self, codec_id: str):
+        super().__init__(f"No dictionary found for body codec {codec_id}")
+
+
+def _zstd() -> ty.Any:
+    try:
+        import zstandard
+    except ImportError as ie:
+        raise BodyCodecUnavailableError() from ie
+    return zstandard
+
+
+class ZstdBodyCodec:
+    """
+    zstd with a prebuilt dictionary, identified by `codec_id`.
+    compressors are reused across calls, so an instance should not be shared between threads.
+    """
+
+    def __init__(self, codec_id: str, dictionary: bytes, *, level: int = DEFAULT_LEVEL):
+        zstd = _zstd()
+        dict_data = zstd.ZstdCompressionDict(dictionary)
+        dict_data.precompute_compress(level=level)
+        self.codec_id = codec_id
+        self.dictionary = dictionary
+        # dict id is already in the codec_id column, drop it from each frame
+        self._compressor = zstd.ZstdCompressor(
+            level=level, dict_data=dict_data, write_dict_id=False
+        )
+        self._decompressor = zstd.ZstdDecompressor(dict_data=dict_data)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.codec_id!r})"
+
+    def compress(self, body: bytes) -> bytes:
+        return self._compressor.compress(body)
+
+    def decompress(self, blob: bytes) -> bytes:
+        return self._decompressor.decompress(blob)
+
+
+class BodyCodecs:
+    """
+    Registry of every known codec, at most one of them is active and used for writes.
+    the active codec is read again every `refresh_interval` seconds,
+    so dictionaries trained or activated after startup are picked up by writers.
+    """
+
+    def __init__(
+        self,
+        *,
+        compress: bool = True,
+        level: int = DEFAULT_LEVEL,
+        refresh_interval: float = 60,
+        clock: ty.Callable[[], float] = time.monotonic,
+    ):
+        self._codecs: dict[str, ZstdBodyCodec] = {}
+        self._active: ZstdBodyCodec | None = None
+        self._compress = compress
+        self._level = level
+        self._refresh_interval = refresh_interval
+        self._clock = clock
+        self._refreshed_at: float | None = None
+
+    @property
+    def compress(self) -> bool:
+        return self._compress
+
+    @property
+    def active(self) -> ZstdBodyCodec | None:
+        "codec used to encode new bodies, None when writes should stay uncompressed"
+        return self._active if self._compress else None
+
+    def __contains__(self, codec_id: str) -> bool:
+        return codec_id in self._codecs
+
+    def register(
+        self, codec_id: str, dictionary: bytes, *, active: bool = False
+    ) -> ZstdBodyCodec:
+        if (codec := self._codecs.get(codec_id)) is None:
+            codec = self._codecs[codec_id] = ZstdBodyCodec(
+                codec_id, dictionary, level=self._level
+            )
+        if active:
+            self._active = codec
+        return codec
+
+    def get(self, codec_id: str) -> ZstdBodyCodec:
+        try:
+            return self._codecs[codec_id]
+        except KeyError as ke:
+            raise UnknownBodyCodecError(codec_id) from ke
+
+    def encode(self, body: bytes) -> tuple[str | None, bytes]:
+        "returns (codec_id, blob), codec_id is None if the body is left as is"
+        if (codec := self.active) is None:
+            return None, body
+        blob = codec.compress(body)
+        if len(blob) >= len(body):
+            return None, body
+        return codec.codec_id, blob
+
+    def decode(self, codec_id: str, blob: bytes) -> bytes:
+        return self.get(codec_id).decompress(blob)
+
+    def raw_body(self, body: ty.Any, codec_id: str | None, blob: bytes | None) -> bytes:
+        "json bytes of a domain_events row, whether it is compressed or not"
+        if codec_id:
+            return self.decode(codec_id, ty.cast(bytes, blob))
+        return (body if isinstance(body, str) else json_dumps(body)).encode()
+
+    async def load(self, uow: UnitOfWork) -> None:
+        "register every dictionary from db, should be called within uow.trans()"
+        cursor = await uow.execute(sa.select(EventBodyCodecsTable))
+        self._active = None
+        for row in cursor.mappings():
+            self.register(row["id"], row["dictionary"], active=row["is_active"])
+        self._refreshed_at = self._clock()
+
+    async def ensure_active(self, uow: UnitOfWork) -> None:
+        """
+        load dictionaries before the first write when compression is on,
+        then read the active codec id again once `refresh_interval` has passed,
+        dictionaries are only loaded when it is not known yet
+        """
+        if not self._compress:
+            return
+        if self._refreshed_at is None:
+            await self.load(uow)
+            return
+        if self._clock() - self._refreshed_at < self._refresh_interval:
+            return
+        cursor = await uow.execute(
+            sa.select(EventBodyCodecsTable.id).where(EventBodyCodecsTable.is_active)
+        )
+        active_id = cursor.scalar()
+        if active_id is not None and active_id not in self._codecs:
+            await self.load(uow)
+            return
+        self._active = self._codecs[active_id] if active_id is not None else None
+        self._refreshed_at = self._clock()
+
+    async def ensure_known(
+        self, uow: UnitOfWork, codec_ids: ty.Iterable[str | None]
+    ) -> None:
+        "reload when rows refer to dictionaries rotated in by other processes"
+        if any(codec_id and codec_id not in self._codecs for codec_id in codec_ids):
+            await self.load(uow)
+
+
+def compress(data: bytes, *, level: int = DEFAULT_LEVEL) -> bytes:
+    "plain zstd, for payloads large enough to not need a dictionary"
+    return _zstd().ZstdCompressor(level=level).compress(data)
+
+
+def decompress(blob: bytes) -> bytes:
+    return _zstd().ZstdDecompressor().decompress(blob)
+
+
+def train_dictionary(
+    samples: ty.Sequence[bytes], *, dict_size: int = DEFAULT_DICT_SIZE
+) -> tuple[str, bytes]:
+    "returns (codec_id, dictionary)"
+    zstd = _zstd()
+    dict_data = zstd.train_dictionary(dict_size, list(samples))
+    return f"zstd-{dict_data.dict_id()}", dict_data.as_bytes()
+
+
+async def _sample_bodies(
+    uow: UnitOfWork, codecs: BodyCodecs, limit: int
+) -> list[bytes]:
+    stmt = (
+        sa.select(
+            DomainEventsTable.event_body,
+            DomainEventsTable.body_codec,
+            DomainEventsTable.event_blob,
+        )
+        .where(DomainEventsTable.event_type.in_(CHAT_EVENT_TYPES))
+        .order_by(DomainEventsTable.gmt_created.desc())
+        .limit(limit)
+    )
+    cursor = await uow.execute(stmt)
+    return [codecs.raw_body(*row) for row in cursor.all()]
+
+
+async def rotate(
+    uow: UnitOfWork,
+    *,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    dict_size: int = DEFAULT_DICT_SIZE,
+) -> str:
+    """
+    train a dictionary from the latest chat events and make it the active one,
+    previous dictionaries are kept for decoding.
+    """
+    async with uow.trans():
+        codecs = BodyCodecs()
+        await codecs.load(uow)
+        samples = await _sample_bodies(uow, codecs, sample_size)
+        codec_id, dictionary = train_dictionary(samples, dict_size=dict_size)
+        await uow.execute(sa.update(EventBodyCodecsTable).values(is_active=False))
+        if codec_id in codecs:
+            # same samples produced the same dictionary
+            await uow.execute(
+                sa.update(EventBodyCodecsTable)
+                .where(EventBodyCodecsTable.id == codec_id)
+                .values(is_active=True)
+            )
+            return codec_id
+        await uow.execute(
+            sa.insert(EventBodyCodecsTable).values(
+                id=codec_id,
+                dictionary=dictionary,
+                sample_size=len(samples),
+                is_active=True,
+            )
+        )
+    return codec_id
+
+
+async def activate(uow: UnitOfWork, codec_id: str) -> None:
+    "roll back to a previously trained dictionary"
+    async with uow.trans():
+        codecs = BodyCodecs()
+        await codecs.load(uow)
+        codecs.get(codec_id)
+        await uow.execute(sa.update(EventBodyCodecsTable).values(is_active=False))
+        await uow.execute(
+            sa.update(EventBodyCodecsTable)
+            .where(EventBodyCodecsTable.id == codec_id)
+            .values(is_active=True)
+        )
+
+
+async def recompress(uow: UnitOfWork, *, batch_size: int = 1000) -> int:
+    """
+    re-encode uncompressed rows and rows of older dictionaries with the active one,
+    returns the number of rows rewritten.
+    """
+    async with uow.trans(readonly=True):
+        codecs = BodyCodecs()
+        await codecs.load(uow)
+    if (active := codecs.active) is None:
+        return 0
+
+    stale = sa.or_(
+        DomainEventsTable.body_codec.is_(None),
+        DomainEventsTable.body_codec != active.codec_id,
+    )
+    total, last_id = 0, ""
+    while True:
+        async with uow.trans():
+            stmt = (
+                sa.select(
+                    DomainEventsTable.id,
+                    DomainEventsTable.event_body,
+                    DomainEventsTable.body_codec,
+                    DomainEventsTable.event_blob,
+                )
+                .where(stale, DomainEventsTable.id > last_id)
+                .order_by(DomainEventsTable.id)
+                .limit(batch_size)
+            )
+            rows = (await uow.execute(stmt)).all()
+            if not rows:
+                return total
+            for event_id, body, codec_id, blob in rows:
+                raw = codecs.raw_body(body, codec_id, blob)
+                new_codec, new_blob = codecs.encode(raw)
+                if new_codec is None:
+                    continue
+                await uow.execute(
+                    sa.update(DomainEventsTable)
+                    .where(DomainEventsTable.id == event_id)
+                    .values(event_body=None, body_codec=new_codec, event_blob=new_blob)
+                )
+                total += 1
+            last_id = rows[-1][0]
+
+
+async def _list(uow: UnitOfWork) -> None:
+    async with uow.trans(readonly=True):
+        stmt = sa.select(
+            EventBodyCodecsTable.id,
+            EventBodyCodecsTable.is_active,
+            EventBodyCodecsTable.sample_size,
+            sa.func.length(EventBodyCodecsTable.dictionary),
+            EventBodyCodecsTable.gmt_created,
+        ).order_by(EventBodyCodecsTable.gmt_created)
+        for codec_id, is_active, samples, size, created in (
+            await uow.execute(stmt)
+        ).all():
+            mark = "*" if is_active else " "
+            print(f"{mark} {codec_id}\t{size} bytes\t{samples} samples\t{created}")
+
+
+async def main(argv: ty.Sequence[str] | None = None) -> None:
+    from askgpt.domain.config import detect_settings
+    from askgpt.infra.factory import make_database
+
+    parser = argparse.ArgumentParser(prog="python -m askgpt.infra.bodycodec")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train = commands.add_parser("train", help="train and activate a new dictionary")
+    train.add_argument("--samples", type=int, default=DEFAULT_SAMPLE_SIZE)
+    train.add_argument("--dict-size", type=int, default=DEFAULT_DICT_SIZE)
+    use = commands.add_parser("activate", help="activate an existing dictionary")
+    use.add_argument("codec_id")
+    commands.add_parser("list", help="list dictionaries, * marks the active one")
+    commands.add_parser("recompress", help="re-encode rows with the active dictionary")
+    args = parser.parse_args(argv)
+
+    aiodb = make_database(detect_settings())
+    uow = UnitOfWork(aiodb)
+    try:
+        match args.command:
+            case "train":
+                codec_id = await rotate(
+                    uow, sample_size=args.samples, dict_size=args.dict_size
+                )
+                print(f"active dictionary: {codec_id}")
+            case "activate":
+                await activate(uow, args.codec_id)
+            case "recompress":
+                print(f"{await recompress(uow)} rows recompressed")
+            case _:
+                await _list(uow)
+    finally:
+        await aiodb.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,24 @@
+import datetime
+import enum
+import types
 import typing as ty
 
+import orjson
 import sqlalchemy as sa
+from pydantic import AwareDatetime, BaseModel, NaiveDatetime, TypeAdapter
 
 # from askgpt.adapters.queue import MessageProducer
 from askgpt.domain.interface import IEvent, IEventStore
-from askgpt.domain.model.base import Event, json_dumps, json_loads
+from askgpt.domain.model.base import Event, json_loads
 from askgpt.domain.types import UTC_TZ
+from askgpt.infra.archive import EventArchive
+from askgpt.infra.blobstore import BlobBatch, BlobStore, resolve_refs
+from askgpt.infra.bodycodec import BodyCodecs, UnknownBodyCodecError
 from askgpt.infra.schema import DomainEventsTable
-from askgpt.helpers.sql import UnitOfWork
+from askgpt.helpers.sql import COPY_THRESHOLD, UnitOfWork
+
+# number of rows fetched and decoded per round trip when streaming events
+DEFAULT_BATCH_SIZE = 500
 
 table_event_mapping = {
     "id": "event_id",
@@ -17,16 +28,27 @@ table_event_mapping = {
 }
 
 
-def dump_event(event: IEvent) -> dict[str, ty.Any]:
+def dump_event(
+    event: IEvent, bodies: BodyCodecs | None = None, blobs: BlobBatch | None = None
+) -> dict[str, ty.Any]:
     data = event.asdict(by_alias=False)
 
     row = {colname: data.pop(field) for colname, field in table_event_mapping.items()}
-    row["event_body"] = json_dumps(data)
+    row["blob_refs"] = blobs.externalize(data) if blobs else None
+    body = orjson.dumps(data)
+    codec_id, blob = bodies.encode(body) if bodies else (None, body)
+    row["event_body"] = None if codec_id else body.decode()
+    row["body_codec"] = codec_id
+    row["event_blob"] = blob if codec_id else None
     row["version"] = event.__class__.version
     return row
 
 
-def load_event(row_mapping: sa.RowMapping | dict[str, ty.Any]) -> IEvent:
+def load_event(
+    row_mapping: sa.RowMapping | dict[str, ty.Any],
+    bodies: BodyCodecs | None = None,
+    blobs: ty.Mapping[str, str] | None = None,
+) -> IEvent:
     row = dict(row_mapping)
 
     data = {field: row.pop(colname) for colname, field in table_event_mapping.items()}
@@ -34,55 +56,465 @@ def load_event(row_mapping: sa.RowMapping | dict[str, ty.Any]) -> IEvent:
     matched_type = Event.match_event_type(
         event_type=data["event_type"], version=version
     )
-    data = data | (extra if isinstance(extra, dict) else json_loads(extra))
+    if codec_id := row.get("body_codec"):
+        if bodies is None:
+            raise UnknownBodyCodecError(codec_id)
+        extra = orjson.loads(bodies.decode(codec_id, row["event_blob"]))
+    extra = extra if isinstance(extra, dict) else json_loads(extra)
+    if row.get("blob_refs") is not None:
+        extra = resolve_refs(extra, blobs or {})
+    data = data | extra
     data["timestamp"] = data["timestamp"].replace(tzinfo=UTC_TZ)
     event = matched_type.model_validate(data)
     return event
 
 
+type FieldDecoder = ty.Callable[[ty.Any], ty.Any]
+type EventDecoder = ty.Callable[[dict[str, ty.Any]], IEvent]
+
+MISSING = object()
+DATETIME_TYPES: tuple[type, ...] = (datetime.datetime, AwareDatetime, NaiveDatetime)
+
+
+def _decode_datetime(value: ty.Any) -> ty.Any:
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def _decode_bytes(value: ty.Any) -> ty.Any:
+    if isinstance(value, str):
+        return value.encode()
+    return value
+
+
+def _optional(decoder: FieldDecoder) -> FieldDecoder:
+    return lambda value: None if value is None else decoder(value)
+
+
+class EventCodec:
+    """
+    Decode domain_events rows into events without running pydantic validation.
+
+    Stored events were validated when they were created, so on the read path
+    we only convert what json can't carry(datetime, bytes, nested models, enums)
+    and build the event the same way `model_construct` does, minus its per-call overhead.
+    A decoder is compiled once per registered event type in `Event._event_registry`.
+
+    set `validate=True` to fall back to `model_validate`, useful for debugging.
+    compressed bodies are decompressed with `bodies`.
+    """
+
+    def __init__(self, *, validate: bool = False, bodies: BodyCodecs | None = None):
+        self._validate = validate
+        self.bodies = bodies or BodyCodecs(compress=False)
+        self._model_decoders: dict[type[BaseModel], FieldDecoder] = {}
+        self._event_decoders: dict[str, EventDecoder] = {}
+        self._batch_adapters: dict[str, TypeAdapter[list[Event]]] = {}
+        self.precompile()
+
+    @property
+    def validate(self) -> bool:
+        return self._validate
+
+    def precompile(self) -> None:
+        for event_type, event_cls in Event._event_registry.items():
+            self._event_decoders[event_type] = self._compile_event(event_cls)
+
+    def _compile_field(self, annotation: ty.Any) -> FieldDecoder | None:
+        "returns None when the json value can be used as is"
+        if isinstance(annotation, ty.TypeAliasType):
+            return self._compile_field(annotation.__value__)
+
+        origin = ty.get_origin(annotation)
+        if origin is ty.Annotated:
+            return self._compile_field(ty.get_args(annotation)[0])
+        if origin is ty.Literal:
+            return None
+        if origin in (ty.Union, types.UnionType):
+            args = [arg for arg in ty.get_args(annotation) if arg is not type(None)]
+            if len(args) == 1:
+                decoder = self._compile_field(args[0])
+                return _optional(decoder) if decoder else None
+            if all(self._compile_field(arg) is None for arg in args):
+                return None
+            return TypeAdapter(annotation).validate_python
+        if origin in (list, tuple, set, frozenset):
+            args = ty.get_args(annotation)
+            decoder = self._compile_field(args[0]) if args else None
+            if decoder is None:
+                return None if origin is list else origin
+            return lambda values: origin(decoder(value) for value in values)
+        if origin is dict:
+            args = ty.get_args(annotation)
+            if not args or all(self._compile_field(arg) is None for arg in args):
+                return None
+            return TypeAdapter(annotation).validate_python
+        if origin is not None:
+            return TypeAdapter(annotation).validate_python
+
+        if not isinstance(annotation, type):
+            return None
+        if annotation in DATETIME_TYPES or issubclass(annotation, datetime.datetime):
+            return _decode_datetime
+        if issubclass(annotation, bytes):
+            return _decode_bytes
+        if issubclass(annotation, enum.Enum):
+            return annotation
+        if issubclass(annotation, BaseModel):
+            return self._compile_model(annotation)
+        return None
+
+    def _compile_model(self, model: type[BaseModel]) -> FieldDecoder:
+        """
+        Build a constructor equivalent to `model.model_construct`,
+        with field lookup, defaults and conversions resolved upfront
+        """
+        if (decoder := self._model_decoders.get(model)) is not None:
+            return decoder
+
+        if model.__pydantic_post_init__ or model.__private_attributes__:
+            # models with private state need pydantic's own bookkeeping
+            construct = model.model_construct
+            decode = lambda data: construct(**data)  # noqa: E731
+            self._model_decoders[model] = decode
+            return decode
+
+        names = list(model.model_fields)
+        field_decoders: dict[str, FieldDecoder] = {}
+        namespace: dict[str, ty.Any] = dict(
+            model=model,
+            new=model.__new__,
+            setattr_=object.__setattr__,
+            MISSING=MISSING,
+            field_decoders=field_decoders,
+        )
+        lookups: list[str] = []
+        converts: list[str] = []
+
+        # registered before compiling fields so self-referencing models terminate
+        self._model_decoders[model] = lambda data: namespace["decode"](data)
+        for i, (name, finfo) in enumerate(model.model_fields.items()):
+            lookups.append(f"    v{i} = get({name!r}, MISSING)")
+            if finfo.alias:
+                lookups.append(f"    if v{i} is MISSING:")
+                lookups.append(f"        v{i} = get({finfo.alias!r}, MISSING)")
+            if (field_decoder := self._compile_field(finfo.annotation)) is not None:
+                field_decoders[name] = namespace[f"decode_{i}"] = field_decoder
+                if finfo.alias:
+                    field_decoders[finfo.alias] = field_decoder
+                converts.append(f"    v{i} = decode_{i}(v{i})")
+
+        any_missing = " or ".join(f"v{i} is MISSING" for i in range(len(names)))
+        values = ", ".join(f"{name!r}: v{i}" for i, name in enumerate(names))
+        source = "\n".join(
+            [
+                "def decode(data):",
+                "    get = data.get",
+                *lookups,
+                f"    if {any_missing or 'False'}:",
+                "        # fields added after the event was stored fall back to defaults",
+                "        for key in field_decoders.keys() & data.keys():",
+                "            data[key] = field_decoders[key](data[key])",
+                "        return model.model_construct(**data)",
+                *converts,
+                "    instance = new(model)",
+                f"    setattr_(instance, '__dict__', {{{values}}})",
+                f"    setattr_(instance, '__pydantic_fields_set__', {set(names)!r})",
+                "    setattr_(instance, '__pydantic_extra__', None)",
+                "    setattr_(instance, '__pydantic_private__', None)",
+                "    return instance",
+            ]
+        )
+        exec(compile(source, f"<decoder {model.__qualname__}>", "exec"), namespace)
+        decode = self._model_decoders[model] = namespace["decode"]
+        return decode
+
+    def _compile_event(self, event_cls: type[Event]) -> EventDecoder:
+        if self._validate:
+            return event_cls.model_validate
+        return ty.cast(EventDecoder, self._compile_model(event_cls))
+
+    def decoder_for(self, event_type: str, version: str) -> EventDecoder:
+        try:
+            return self._event_decoders[event_type]
+        except KeyError:
+            event_cls = Event.match_event_type(event_type=event_type, version=version)
+            decoder = self._event_decoders[event_type] = self._compile_event(
+                event_cls
+            )
+            return decoder
+
+    def _row_data(
+        self,
+        row: sa.RowMapping | dict[str, ty.Any],
+        blobs: ty.Mapping[str, str] | None = None,
+    ) -> dict[str, ty.Any]:
+        body = row["event_body"]
+        data: dict[str, ty.Any]
+        if (codec_id := row.get("body_codec")) is not None:
+            data = orjson.loads(self.bodies.decode(codec_id, row["event_blob"]))
+        elif isinstance(body, dict):
+            data = dict(body)
+        else:
+            # orjson parses str directly, no need to encode it first
+            data = orjson.loads(body)
+        if row.get("blob_refs") is not None:
+            data = resolve_refs(data, blobs or {})
+        data["event_id"] = row["id"]
+        data["entity_id"] = row["entity_id"]
+        data["event_type"] = row["event_type"]
+        data["timestamp"] = row["gmt_created"].replace(tzinfo=UTC_TZ)
+        return data
+
+    def decode(
+        self,
+        row: sa.RowMapping | dict[str, ty.Any],
+        blobs: ty.Mapping[str, str] | None = None,
+    ) -> IEvent:
+        "blobs: contents of blobs referenced by the row"
+        decoder = self.decoder_for(row["event_type"], row["version"])
+        return decoder(self._row_data(row, blobs))
+
+    def decode_rows(
+        self,
+        rows: ty.Sequence[sa.RowMapping | dict[str, ty.Any]],
+        blobs: ty.Mapping[str, str] | None = None,
+    ) -> list[IEvent]:
+        if self._validate:
+            return self._validate_rows(rows, blobs)
+
+        decoders = self._event_decoders
+        row_data = self._row_data
+        events: list[IEvent] = []
+        for row in rows:
+            event_type = row["event_type"]
+            decoder = decoders.get(event_type) or self.decoder_for(
+                event_type, row["version"]
+            )
+            events.append(decoder(row_data(row, blobs)))
+        return events
+
+    def _validate_rows(
+        self,
+        rows: ty.Sequence[sa.RowMapping | dict[str, ty.Any]],
+        blobs: ty.Mapping[str, str] | None = None,
+    ) -> list[IEvent]:
+        "validate rows of the same event type in one pydantic call"
+        groups: dict[str, tuple[list[int], list[dict[str, ty.Any]]]] = {}
+        for idx, row in enumerate(rows):
+            event_type = row["event_type"]
+            if event_type not in groups:
+                self.decoder_for(event_type, row["version"])
+                groups[event_type] = ([], [])
+            indices, batch = groups[event_type]
+            indices.append(idx)
+            batch.append(self._row_data(row, blobs))
+
+        events: list[ty.Any] = [None] * len(rows)
+        for event_type, (indices, batch) in groups.items():
+            adapter = self._batch_adapter(event_type)
+            for idx, event in zip(indices, adapter.validate_python(batch)):
+                events[idx] = event
+        return events
+
+    def _batch_adapter(self, event_type: str) -> TypeAdapter[list[Event]]:
+        if (adapter := self._batch_adapters.get(event_type)) is None:
+            event_cls = Event._event_registry[event_type]
+            adapter = self._batch_adapters[event_type] = TypeAdapter(list[event_cls])
+        return adapter
+
+
 class EventStore(IEventStore):
-    def __init__(self, uow: UnitOfWork):
+    """
+    with `read_archive`, reads of a single entity include the events of its archive,
+    without faulting them back in, see `restore`.
+    `list_all` and `stream_all` only see the hot table.
+    """
+
+    def __init__(
+        self,
+        uow: UnitOfWork,
+        codec: EventCodec | None = None,
+        blobs: BlobStore | None = None,
+        *,
+        copy_threshold: int | None = COPY_THRESHOLD,
+        order_by_id: bool = False,
+        read_archive: bool = False,
+    ):
+        """
+        order_by_id: order events of an entity by their time ordered ids alone,
+        only once every stored event id is a uuid7
+        read_archive: look up event_archives on reads of an entity, a primary key lookup
+        """
         self._uow = uow
+        self._codec = codec or EventCodec()
+        self._blobs = blobs or BlobStore()
+        self._copy_threshold = copy_threshold
+        self._order = (
+            (DomainEventsTable.id,)
+            if order_by_id
+            else (DomainEventsTable.gmt_created, DomainEventsTable.id)
+        )
+        self._archive = EventArchive(uow, self._codec.bodies)
+        self._read_archive = read_archive
 
     @property
     def uow(self) -> UnitOfWork:
         return self._uow
 
+    @property
+    def archive(self) -> EventArchive:
+        return self._archive
+
+    async def _dump(self, events: ty.Iterable[IEvent]) -> list[dict[str, ty.Any]]:
+        bodies = self._codec.bodies
+        await bodies.ensure_active(self._uow)
+        batch = self._blobs.batch()
+        values = [dump_event(event, bodies, batch) for event in events]
+        await self._blobs.retain(self._uow, batch)
+        return values
+
+    async def _decode(
+        self, rows: ty.Sequence[sa.RowMapping | dict[str, ty.Any]]
+    ) -> list[IEvent]:
+        await self._codec.bodies.ensure_known(
+            self._uow, (row["body_codec"] for row in rows)
+        )
+        refs = [ref for row in rows if row["blob_refs"] for ref in row["blob_refs"]]
+        blobs = await self._blobs.resolve(self._uow, refs) if refs else None
+        return self._codec.decode_rows(rows, blobs)
+
     async def add(self, event: IEvent) -> None:
-        value = dump_event(event)
+        (value,) = await self._dump((event,))
         stmt = sa.insert(DomainEventsTable).values(value)
         await self._uow.execute(stmt)
 
     async def add_all(self, events: list[IEvent]) -> None:
-        values = [dump_event(event) for event in events]
-        stmt = sa.insert(DomainEventsTable).values(values)
-        await self._uow.execute(stmt)
+        values = await self._dump(events)
+        await self._uow.bulk_insert(
+            DomainEventsTable.__table__,  # type: ignore
+            values,
+            copy_threshold=self._copy_threshold,
+        )
 
-    async def get(self, entity_id: str) -> list[IEvent]:
-        stmt = sa.select(DomainEventsTable).where(
-            DomainEventsTable.entity_id == entity_id
+    def _select_by_entity(self, entity_id: str) -> sa.Select[ty.Any]:
+        return (
+            sa.select(DomainEventsTable)
+            .where(DomainEventsTable.entity_id == entity_id)
+            .order_by(*self._order)
         )
-        cursor = await self._uow.execute(stmt)
-        rows = cursor.mappings().all()
-        events = [load_event(row) for row in rows]
-        return events
 
-    async def get_by_type(self, entity_id: str, event_type: str) -> list[IEvent]:
-        stmt = sa.select(DomainEventsTable).where(
-            DomainEventsTable.entity_id == entity_id,
-            DomainEventsTable.event_type == event_type,
+    def _select_by_type(self, entity_id: str, event_type: str) -> sa.Select[ty.Any]:
+        return self._select_by_entity(entity_id).where(
+            DomainEventsTable.event_type == event_type
+        )
+
+    def _select_all(self) -> sa.Select[ty.Any]:
+        return sa.select(DomainEventsTable).order_by(
+            DomainEventsTable.entity_id, *self._order
         )
+
+    async def _fetch(self, stmt: sa.Select[ty.Any]) -> list[IEvent]:
         cursor = await self._uow.execute(stmt)
         rows = cursor.mappings().all()
-        events = [load_event(row) for row in rows]
-        return events
+        return await self._decode(rows)
 
-    async def list_all(self) -> list[IEvent]:
-        stmt = sa.select(DomainEventsTable)
+    async def _archived(
+        self, entity_id: str, event_type: str | None = None
+    ) -> list[dict[str, ty.Any]]:
+        "archived rows of the entity, they are older than its hot rows"
+        if not self._read_archive:
+            return []
+        rows = await self._archive.load(entity_id)
+        if event_type is not None:
+            rows = [row for row in rows if row["event_type"] == event_type]
+        return rows
+
+    async def _fetch_entity(
+        self, stmt: sa.Select[ty.Any], entity_id: str, event_type: str | None = None
+    ) -> list[IEvent]:
+        archived = await self._archived(entity_id, event_type)
         cursor = await self._uow.execute(stmt)
         rows = cursor.mappings().all()
-        events = [load_event(row) for row in rows]
-        return events
+        if archived:
+            # rows an interrupted archive run didn't get to delete are in both
+            hot_ids = {row["id"] for row in rows}
+            archived = [row for row in archived if row["id"] not in hot_ids]
+        return await self._decode([*archived, *rows])
+
+    async def _stream(
+        self,
+        stmt: sa.Select[ty.Any],
+        batch_size: int,
+        entity_id: str | None = None,
+        event_type: str | None = None,
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        """
+        fetch rows through a server side cursor, at most `batch_size` rows
+        are buffered and decoded at a time, regardless of the table size.
+        """
+        archived = await self._archived(entity_id, event_type) if entity_id else []
+        archived_ids = {row["id"] for row in archived}
+        for start in range(0, len(archived), batch_size):
+            for event in await self._decode(archived[start : start + batch_size]):
+                yield event
+        result = await self._uow.stream(
+            stmt, execution_options={"yield_per": batch_size}
+        )
+        try:
+            async for rows in result.mappings().partitions(batch_size):
+                if archived_ids:
+                    rows = [row for row in rows if row["id"] not in archived_ids]
+                for event in await self._decode(rows):
+                    yield event
+        finally:
+            await result.close()
+
+    async def get(self, entity_id: str) -> list[IEvent]:
+        return await self._fetch_entity(self._select_by_entity(entity_id), entity_id)
+
+    async def get_by_type(self, entity_id: str, event_type: str) -> list[IEvent]:
+        return await self._fetch_entity(
+            self._select_by_type(entity_id, event_type), entity_id, event_type
+        )
+
+    async def restore(self, entity_id: str) -> int:
+        """
+        fault the archived events of the entity back into domain_events,
+        returns number of events restored, should be called within a write uow.trans()
+        """
+        if not self._read_archive:
+            return 0
+        return await self._archive.restore(entity_id)
+
+    async def list_all(self) -> list[IEvent]:
+        return await self._fetch(self._select_all())
+
+    def stream(
+        self, entity_id: str, *, batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        """
+        lazy version of `get`, should be consumed within uow.trans()
+        >>> async with eventstore.uow.trans():
+        ...     async for event in eventstore.stream(entity_id):
+        ...         entity.apply(event)
+        """
+        return self._stream(self._select_by_entity(entity_id), batch_size, entity_id)
+
+    def stream_by_type(
+        self, entity_id: str, event_type: str, *, batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        "lazy version of `get_by_type`"
+        return self._stream(
+            self._select_by_type(entity_id, event_type), batch_size, entity_id, event_type
+        )
+
+    def stream_all(
+        self, *, batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        "lazy version of `list_all`"
+        return self._stream(self._select_all(), batch_size)
 
     async def remove(self, entity_id: str) -> None:
         """
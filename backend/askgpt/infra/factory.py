@@ -1,3 +1,5 @@
+import typing as ty
+
 import sqlalchemy as sa
 from sqlalchemy.ext import asyncio as sa_aio
 
@@ -6,6 +8,43 @@ from askgpt.domain.config import Settings, settingfactory
 from askgpt.helpers.sql import async_engine, engine_factory
 
 
+def sqlite_pragmas(profile: Settings.DB.SqliteProfile) -> list[str]:
+    return [
+        f"PRAGMA journal_mode = {profile.JOURNAL_MODE}",
+        f"PRAGMA synchronous = {profile.SYNCHRONOUS}",
+        f"PRAGMA mmap_size = {profile.MMAP_SIZE}",
+        f"PRAGMA cache_size = {profile.CACHE_SIZE}",
+        f"PRAGMA busy_timeout = {profile.BUSY_TIMEOUT}",
+    ]
+
+
+def apply_sqlite_profile(engine: sa.Engine, profile: Settings.DB.SqliteProfile) -> None:
+    "run the profile's pragmas on every new connection of engine"
+    pragmas = sqlite_pragmas(profile)
+
+    def set_pragmas(dbapi_conn: ty.Any, record: ty.Any) -> None:
+        cursor = dbapi_conn.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    sa.event.listen(engine, "connect", set_pragmas)
+
+
+def sqlite_pool_options(
+    profile: Settings.DB.SqliteProfile, *, readers: bool = False
+) -> dict[str, ty.Any]:
+    """
+    with a single writer, the write engine keeps one connection
+    and readers share a pool of READ_POOL_SIZE.
+    """
+    return dict(
+        poolclass=sa.AsyncAdaptedQueuePool,
+        pool_size=profile.READ_POOL_SIZE if readers else 1,
+        max_overflow=0,
+    )
+
+
 @settingfactory
 def make_async_engine(settings: Settings) -> sa_aio.AsyncEngine:
     async_engine_ = async_engine(make_engine(settings))
@@ -15,7 +54,9 @@ def make_async_engine(settings: Settings) -> sa_aio.AsyncEngine:
 @settingfactory
 def make_engine(settings: Settings) -> sa.Engine:
     connect_args = (
-        settings.db.connect_args.model_dump() if settings.db.connect_args else None
+        settings.db.connect_args.model_dump(exclude_none=True)
+        if settings.db.connect_args
+        else None
     )
     execution_options = (
         settings.db.execution_options.model_dump()
@@ -26,10 +67,14 @@ def make_engine(settings: Settings) -> sa.Engine:
         db_url=settings.db.DB_URL,
         echo=settings.db.ENGINE_ECHO,
         isolation_level=settings.db.ISOLATION_LEVEL,
-        pool_pre_ping=True,
+        pool_pre_ping=settings.db.POOL_PRE_PING,
+        pool_recycle=settings.db.POOL_RECYCLE,
+        **settings.db.POOL_OPTIONS,
         connect_args=connect_args,
         execution_options=execution_options,
     )
+    if settings.db.DIALECT == "sqlite" and settings.db.sqlite_profile:
+        apply_sqlite_profile(engine, settings.db.sqlite_profile)
     return engine
 
 
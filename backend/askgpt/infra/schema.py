@@ -11,14 +11,72 @@ class DomainEventsTable(TableBase):
     """
 
     __tablename__: str = "domain_events"
+    # reads of an entity filter on entity_id and are ordered by (gmt_created, id),
+    # both indexes cover the filter and the order so no sort is needed
+    __table_args__ = (
+        sa.Index("ix_domain_events_entity_created", "entity_id", "gmt_created", "id"),
+        sa.Index(
+            "ix_domain_events_entity_type_created",
+            "entity_id",
+            "event_type",
+            "gmt_created",
+            "id",
+        ),
+    )
+
     id = sa.Column("id", sa.String, primary_key=True)
     event_type = sa.Column("event_type", sa.String, index=True)
-    event_body = sa.Column("event_body", sa.JSON)
-    entity_id = sa.Column("entity_id", sa.String, index=True)
-    version = sa.Column("version", sa.String, index=True)
+    event_body = sa.Column("event_body", sa.JSON(none_as_null=True), nullable=True)
+    entity_id = sa.Column("entity_id", sa.String)
+    version = sa.Column("version", sa.String)
+    # compressed rows have event_body set to null, see askgpt.infra.bodycodec
+    body_codec = sa.Column("body_codec", sa.String, nullable=True)
+    event_blob = sa.Column("event_blob", sa.LargeBinary, nullable=True)
+    # hashes of content_blobs referenced by event_body, see askgpt.infra.blobstore
+    blob_refs = sa.Column("blob_refs", sa.JSON(none_as_null=True), nullable=True)
     # consumed_at: sa.DateTime, nullable=True
 
 
+class EventArchivesTable(TableBase):
+    """
+    Cold storage for streams of idle sessions, see askgpt.infra.archive
+    events holds the zstd compressed rows moved out of domain_events,
+    it is set to null once the stream is faulted back in, the row itself stays as a stub.
+    """
+
+    __tablename__: str = "event_archives"
+
+    entity_id = sa.Column("entity_id", sa.String, primary_key=True)
+    events = sa.Column("events", sa.LargeBinary, nullable=True)
+    event_count = sa.Column("event_count", sa.Integer, nullable=False, default=0)
+    archived_at = sa.Column("archived_at", sa.DateTime, nullable=True)
+    restored_at = sa.Column("restored_at", sa.DateTime, nullable=True)
+
+
+class ContentBlobsTable(TableBase):
+    "large strings shared by event bodies, keyed by their sha256, never deleted"
+
+    __tablename__: str = "content_blobs"
+
+    hash = sa.Column("hash", sa.String(64), primary_key=True)
+    content = sa.Column("content", sa.Text, nullable=False)
+    size = sa.Column("size", sa.Integer, nullable=False)
+
+
+class EventBodyCodecsTable(TableBase):
+    """
+    zstd dictionaries used to compress event bodies,
+    rows are never deleted as long as events encoded with them exist.
+    """
+
+    __tablename__: str = "event_body_codecs"
+
+    id = sa.Column("id", sa.String, primary_key=True, comment="codec_id")
+    dictionary = sa.Column("dictionary", sa.LargeBinary, nullable=False)
+    sample_size = sa.Column("sample_size", sa.Integer, nullable=False)
+    is_active = sa.Column("is_active", sa.Boolean, default=False)
+
+
 # class EventTaskScheduleTable(DomainEventsTable):
 #     __tablename__: str = "event_task_schedule"
 #     status = sa.Column("status", sa.String, index=True)  # started, failed
@@ -40,11 +98,38 @@ class UsersTable(TableBase):
 
 class SessionsTable(TableBase):
     __tablename__: str = "sessions"
+    # sessions of a user are listed by last activity, newest first, see SessionRepository
+    __table_args__ = (
+        sa.Index("ix_sessions_user_active", "user_id", "last_active_at", "id"),
+    )
 
     id = sa.Column("id", sa.String, primary_key=True, comment="session_id")
     user_id = sa.Column("user_id", sa.String, sa.ForeignKey("users.id"))
     session_name = sa.Column("session_name", sa.String, unique=False, index=False)
     is_active = sa.Column("is_active", sa.Boolean, default=True)
+    last_active_at = sa.Column(
+        "last_active_at", sa.DateTime, nullable=False, server_default=sa.func.now()
+    )
+    # seq of the latest message in session_messages, NULL until its messages are projected
+    message_seq = sa.Column("message_seq", sa.Integer, nullable=True)
+
+
+class SessionMessagesTable(TableBase):
+    """
+    read model of chat messages, written along with the events of a session.
+    seq numbers the messages of a session from 1 and is exposed as the session version,
+    the primary key serves both pages of history and deltas without reading the event stream.
+    """
+
+    __tablename__: str = "session_messages"
+
+    session_id = sa.Column("session_id", sa.String, primary_key=True)
+    seq = sa.Column("seq", sa.Integer, primary_key=True, autoincrement=False)
+    event_id = sa.Column("event_id", sa.String, nullable=False, unique=True)
+    role = sa.Column("role", sa.String, nullable=False)
+    content = sa.Column("content", sa.Text, nullable=False)
+    gpt_type = sa.Column("gpt_type", sa.String, nullable=False)
+    sent_at = sa.Column("sent_at", sa.DateTime, nullable=False)
 
 
 class UserAPIKeysTable(TableBase):
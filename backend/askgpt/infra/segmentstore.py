@@ -0,0 +1,557 @@
+"""
+Embedded event store on append-only segment files, for single node deployments
+where going through sqlalchemy and a database costs more than the workload needs.
+
+Layout of the store directory:
+    00000001.seg, 00000002.seg, ...  records appended in order, the last one is active
+    00000001.idx, ...                per entity offsets of a sealed segment
+
+Each record is `<length:u32><crc32:u32><payload>`, payload is an orjson array.
+A record that is incomplete or fails the crc check marks the end of the segment,
+so a torn write at the tail of the active segment is truncated on open.
+
+The per entity index lives in memory, sealed segments are read through mmap.
+"""
+
+import asyncio
+import datetime
+import mmap
+import os
+import struct
+import time
+import typing as ty
+import zlib
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+import orjson
+
+from askgpt.domain.interface import IEvent, IEventStore
+from askgpt.domain.types import UTC_TZ
+from askgpt.infra.eventstore import DEFAULT_BATCH_SIZE, EventCodec
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+COMPACT_SUFFIX = ".compact"
+HEADER = struct.Struct("<II")
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+type FsyncPolicy = ty.Literal["always", "batch", "never"]
+# segment, offset of the record, length of the payload, event_type
+type IndexEntry = tuple[int, int, int, str]
+# entity_id, event_type or None for tombstones, payload
+type Record = tuple[str, str | None, bytes]
+
+
+class CorruptRecordError(Exception):
+    "an indexed record no longer matches its crc"
+
+
+def _segment_path(directory: Path, seq: int, suffix: str = SEGMENT_SUFFIX) -> Path:
+    return directory / f"{seq:08d}{suffix}"
+
+
+def _encode(event: IEvent) -> bytes:
+    data = event.asdict(by_alias=False)
+    created: datetime.datetime = data.pop("timestamp")
+    record = [
+        data.pop("event_id"),
+        data.pop("entity_id"),
+        data.pop("event_type"),
+        event.__class__.version,
+        created.astimezone(UTC_TZ).replace(tzinfo=None),
+        data,
+    ]
+    return orjson.dumps(record)
+
+
+def _row(payload: bytes) -> dict[str, ty.Any]:
+    "convert a record to the same mapping as a domain_events row"
+    event_id, entity_id, event_type, version, created, body = orjson.loads(payload)
+    return {
+        "id": event_id,
+        "entity_id": entity_id,
+        "event_type": event_type,
+        "version": version,
+        "gmt_created": datetime.datetime.fromisoformat(created),
+        "event_body": body,
+    }
+
+
+def _tombstone(entity_id: str) -> bytes:
+    return orjson.dumps([entity_id])
+
+
+class SegmentIndex(ty.TypedDict):
+    entities: dict[str, list[tuple[int, int, str]]]
+    # entities removed in this segment, their entries in older segments are dropped
+    tombstones: list[str]
+
+
+class SegmentUnitOfWork:
+    """
+    Appends within `trans()` are held back and appended together when the outermost
+    trans exits without error, so with the `always` policy a whole transaction
+    costs a single fsync, and a failed one leaves nothing on disk or in the index.
+    reads within a trans see its held back events after the appended ones.
+    """
+
+    def __init__(self, store: "SegmentEventStore"):
+        self._store = store
+        self._pending = ContextVar[list[Record] | None]("segment_trans", default=None)
+
+    @property
+    def in_trans(self) -> bool:
+        return self._pending.get() is not None
+
+    @property
+    def pending(self) -> list[Record] | None:
+        return self._pending.get()
+
+    @asynccontextmanager
+    async def trans(self) -> ty.AsyncGenerator[ty.Self, None]:
+        if self._pending.get() is not None:
+            yield self
+            return
+        records: list[Record] = []
+        token = self._pending.set(records)
+        try:
+            yield self
+        finally:
+            self._pending.reset(token)
+        if records:
+            await self._store._append(records)
+
+
+class SegmentEventStore(IEventStore):
+    """
+    fsync policies:
+    - always: sync after every append outside of trans()
+    - batch: sync once `fsync_bytes` are written or `fsync_interval` seconds passed
+    - never: leave it to the os
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        *,
+        codec: EventCodec | None = None,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        fsync: FsyncPolicy = "batch",
+        fsync_interval: float = 0.05,
+        fsync_bytes: int = 1024 * 1024,
+    ):
+        self._dir = Path(directory)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._codec = codec or EventCodec()
+        self._segment_size = segment_size
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._fsync_bytes = fsync_bytes
+        self._uow = SegmentUnitOfWork(self)
+
+        self._index: dict[str, list[IndexEntry]] = {}
+        self._maps: dict[int, mmap.mmap] = {}
+        self._sealed: list[int] = []
+        self._active_entries: dict[str, list[IndexEntry]] = {}
+        self._active_tombstones: set[str] = set()
+
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_lock = asyncio.Lock()
+        self._sync_task: asyncio.Task[None] | None = None
+        self._compact_lock = asyncio.Lock()
+        # open streams read entries lazily, compaction waits for them before the swap
+        self._readers = 0
+        self._no_readers = asyncio.Event()
+        self._no_readers.set()
+
+        self._recover_compaction()
+        self._active_seq = self._load()
+        path = _segment_path(self._dir, self._active_seq)
+        self._file = path.open("ab")
+        self._size = self._file.tell()
+
+    @property
+    def uow(self) -> SegmentUnitOfWork:
+        return self._uow
+
+    @property
+    def directory(self) -> Path:
+        return self._dir
+
+    # ===========loading===========
+
+    def _segments(self) -> list[int]:
+        return sorted(int(p.stem) for p in self._dir.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def _apply(self, index: SegmentIndex, seq: int) -> None:
+        for entity_id in index["tombstones"]:
+            self._index.pop(entity_id, None)
+        for entity_id, entries in index["entities"].items():
+            self._index.setdefault(entity_id, []).extend(
+                (seq, offset, length, event_type)
+                for offset, length, event_type in entries
+            )
+
+    def _scan(self, seq: int) -> SegmentIndex:
+        "rebuild index of a segment from its records, truncating a torn tail"
+        path = _segment_path(self._dir, seq)
+        data = path.read_bytes()
+        entities: dict[str, list[tuple[int, int, str]]] = {}
+        tombstones: list[str] = []
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            payload = data[start : start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            record = orjson.loads(payload)
+            if len(record) == 1:
+                entities.pop(record[0], None)
+                tombstones.append(record[0])
+            else:
+                entities.setdefault(record[1], []).append((offset, length, record[2]))
+            offset = start + length
+        if offset < len(data):
+            with path.open("r+b") as f:
+                f.truncate(offset)
+        return SegmentIndex(entities=entities, tombstones=tombstones)
+
+    def _load(self) -> int:
+        "load every segment, returns seq of the active one"
+        segments = self._segments() or [1]
+        *sealed, active = segments
+        for seq in sealed:
+            idx_path = _segment_path(self._dir, seq, INDEX_SUFFIX)
+            if idx_path.exists():
+                index: SegmentIndex = orjson.loads(idx_path.read_bytes())
+            else:
+                index = self._scan(seq)
+                self._write_index(seq, index)
+            self._apply(index, seq)
+            self._sealed.append(seq)
+
+        if _segment_path(self._dir, active).exists():
+            index = self._scan(active)
+            self._apply(index, active)
+            self._active_tombstones.update(index["tombstones"])
+            for entity_id, entries in index["entities"].items():
+                self._active_entries[entity_id] = [
+                    (active, offset, length, event_type)
+                    for offset, length, event_type in entries
+                ]
+        return active
+
+    def _write_index(self, seq: int, index: SegmentIndex, suffix: str = "") -> None:
+        path = _segment_path(self._dir, seq, INDEX_SUFFIX + suffix)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(orjson.dumps(index))
+        os.replace(tmp, path)
+
+    # ===========writing===========
+
+    async def _append(self, records: list[Record]) -> None:
+        if (pending := self._uow.pending) is not None:
+            pending.extend(records)
+            return
+        if self._size >= self._segment_size:
+            await self._roll()
+
+        seq, buffer = self._active_seq, bytearray()
+        entries: list[tuple[str, IndexEntry | None]] = []
+        for entity_id, event_type, payload in records:
+            offset = self._size + len(buffer)
+            buffer += HEADER.pack(len(payload), zlib.crc32(payload))
+            buffer += payload
+            entry = (seq, offset, len(payload), event_type) if event_type else None
+            entries.append((entity_id, entry))
+        self._file.write(buffer)
+        self._file.flush()
+        self._size += len(buffer)
+        self._unsynced += len(buffer)
+
+        for entity_id, entry in entries:
+            if entry is None:
+                self._index.pop(entity_id, None)
+                self._active_entries.pop(entity_id, None)
+                self._active_tombstones.add(entity_id)
+            else:
+                self._index.setdefault(entity_id, []).append(entry)
+                self._active_entries.setdefault(entity_id, []).append(entry)
+        await self.commit()
+
+    async def _sync(self) -> None:
+        async with self._sync_lock:
+            if not self._unsynced:
+                return
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+
+    async def _delayed_sync(self) -> None:
+        await asyncio.sleep(self._fsync_interval)
+        self._sync_task = None
+        await self._sync()
+
+    async def commit(self) -> None:
+        "make appended records durable according to the fsync policy"
+        if not self._unsynced or self._fsync == "never":
+            return
+        if self._fsync == "always":
+            due = True
+        else:
+            elapsed = time.monotonic() - self._last_sync
+            due = self._unsynced >= self._fsync_bytes or elapsed >= self._fsync_interval
+        if due:
+            await self._sync()
+        elif self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._delayed_sync())
+
+    async def _roll(self) -> None:
+        "seal the active segment and start a new one"
+        async with self._sync_lock:
+            self._file.flush()
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+            self._unsynced = 0
+            self._file.close()
+            self._write_index(
+                self._active_seq,
+                SegmentIndex(
+                    entities={
+                        entity_id: [entry[1:] for entry in entries]
+                        for entity_id, entries in self._active_entries.items()
+                    },
+                    tombstones=sorted(self._active_tombstones),
+                ),
+            )
+            self._sealed.append(self._active_seq)
+            self._active_entries.clear()
+            self._active_tombstones.clear()
+            if (mm := self._maps.pop(self._active_seq, None)) is not None:
+                mm.close()
+
+            self._active_seq += 1
+            self._file = _segment_path(self._dir, self._active_seq).open("ab")
+            self._size = 0
+
+    async def add(self, event: IEvent) -> None:
+        await self._append([(event.entity_id, event.event_type, _encode(event))])
+
+    async def add_all(self, events: list[IEvent]) -> None:
+        await self._append(
+            [(event.entity_id, event.event_type, _encode(event)) for event in events]
+        )
+
+    async def remove(self, entity_id: str) -> None:
+        "events of the entity are dropped from the index now, and from disk by `compact`"
+        await self._append([(entity_id, None, _tombstone(entity_id))])
+
+    async def restore(self, entity_id: str) -> int:
+        "nothing is archived, for the interface of EventStore"
+        return 0
+
+    # ===========reading===========
+
+    def _map(self, seq: int, end: int) -> mmap.mmap:
+        mm = self._maps.get(seq)
+        if mm is None or len(mm) < end:
+            # the active segment grows, remap once reads go past the mapped size
+            if mm is not None:
+                mm.close()
+            with _segment_path(self._dir, seq).open("rb") as f:
+                mm = self._maps[seq] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mm
+
+    def _read(self, entries: ty.Sequence[IndexEntry]) -> list[IEvent]:
+        rows: list[dict[str, ty.Any]] = []
+        for seq, offset, length, _ in entries:
+            start = offset + HEADER.size
+            mm = self._map(seq, start + length)
+            stored_length, crc = HEADER.unpack_from(mm, offset)
+            payload = mm[start : start + length]
+            if stored_length != length or zlib.crc32(payload) != crc:
+                raise CorruptRecordError(f"record at {offset} of segment {seq}")
+            rows.append(_row(payload))
+        return self._codec.decode_rows(rows)
+
+    def _entries(self, entity_id: str, event_type: str | None = None) -> list[IndexEntry]:
+        entries = self._index.get(entity_id, [])
+        if event_type is None:
+            return list(entries)
+        return [entry for entry in entries if entry[3] == event_type]
+
+    def _all_entries(self, removed: ty.Container[str] = ()) -> list[IndexEntry]:
+        return [
+            entry
+            for entity_id in sorted(self._index)
+            if entity_id not in removed
+            for entry in self._index[entity_id]
+        ]
+
+    def _select(
+        self, entity_id: str | None = None, event_type: str | None = None
+    ) -> tuple[list[IndexEntry], list[dict[str, ty.Any]]]:
+        """
+        indexed entries of the entity, or of every entity when None,
+        with the rows appended so far by the current transaction
+        """
+        removed: set[str] = set()
+        rows: list[dict[str, ty.Any]] = []
+        for record_entity, record_type, payload in self._uow.pending or ():
+            if entity_id is not None and record_entity != entity_id:
+                continue
+            if record_type is None:
+                removed.add(record_entity)
+                rows = [row for row in rows if row["entity_id"] != record_entity]
+            elif event_type is None or record_type == event_type:
+                rows.append(_row(payload))
+        if entity_id is None:
+            return self._all_entries(removed), rows
+        if entity_id in removed:
+            return [], rows
+        return self._entries(entity_id, event_type), rows
+
+    def _read_selected(
+        self, selected: tuple[list[IndexEntry], list[dict[str, ty.Any]]]
+    ) -> list[IEvent]:
+        entries, rows = selected
+        return self._read(entries) + self._codec.decode_rows(rows)
+
+    async def _stream(
+        self,
+        select: ty.Callable[[], tuple[list[IndexEntry], list[dict[str, ty.Any]]]],
+        batch_size: int,
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        "entries are selected once the stream is registered as a reader"
+        self._readers += 1
+        self._no_readers.clear()
+        try:
+            entries, rows = select()
+            for i in range(0, len(entries), batch_size):
+                for event in self._read(entries[i : i + batch_size]):
+                    yield event
+            for event in self._codec.decode_rows(rows):
+                yield event
+        finally:
+            self._readers -= 1
+            if not self._readers:
+                self._no_readers.set()
+
+    async def get(self, entity_id: str) -> list[IEvent]:
+        return self._read_selected(self._select(entity_id))
+
+    async def get_by_type(self, entity_id: str, event_type: str) -> list[IEvent]:
+        return self._read_selected(self._select(entity_id, event_type))
+
+    async def list_all(self) -> list[IEvent]:
+        return self._read_selected(self._select())
+
+    def stream(
+        self, entity_id: str, *, batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        return self._stream(lambda: self._select(entity_id), batch_size)
+
+    def stream_by_type(
+        self, entity_id: str, event_type: str, *, batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        return self._stream(lambda: self._select(entity_id, event_type), batch_size)
+
+    def stream_all(
+        self, *, batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ty.AsyncGenerator[IEvent, None]:
+        return self._stream(self._select, batch_size)
+
+    # ===========compaction===========
+
+    def _recover_compaction(self) -> None:
+        "finish a compaction interrupted after its index was written, discard it otherwise"
+        for path in self._dir.glob(f"*{SEGMENT_SUFFIX}{COMPACT_SUFFIX}"):
+            target = int(path.name.split(".")[0])
+            idx = _segment_path(self._dir, target, INDEX_SUFFIX + COMPACT_SUFFIX)
+            if idx.exists():
+                self._swap_compacted(target)
+            else:
+                path.unlink()
+
+    def _swap_compacted(self, target: int) -> None:
+        for seq in self._segments():
+            if seq > target:
+                break
+            _segment_path(self._dir, seq).unlink()
+            _segment_path(self._dir, seq, INDEX_SUFFIX).unlink(missing_ok=True)
+        for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+            compacted = _segment_path(self._dir, target, suffix + COMPACT_SUFFIX)
+            os.replace(compacted, _segment_path(self._dir, target, suffix))
+
+    async def compact(self) -> int:
+        """
+        rewrite sealed segments into one, keeping only events still in the index,
+        grouped by entity so rebuilds read them sequentially.
+        returns number of bytes reclaimed.
+
+        appends, rolls and removes may run while the segment is written,
+        the index is only swapped to the compacted segment afterwards,
+        once no stream is reading entries of the segments it replaces.
+        """
+        async with self._compact_lock:
+            return await self._compact()
+
+    async def _compact(self) -> int:
+        if not self._sealed:
+            return 0
+        sealed, target = set(self._sealed), self._sealed[-1]
+        before = sum(_segment_path(self._dir, seq).stat().st_size for seq in sealed)
+
+        # (segment, offset) of a record to its entry in the compacted segment
+        relocated: dict[tuple[int, int], IndexEntry] = {}
+        entities: dict[str, list[tuple[int, int, str]]] = {}
+        path = _segment_path(self._dir, target, SEGMENT_SUFFIX + COMPACT_SUFFIX)
+        with path.open("wb") as f:
+            offset = 0
+            for entity_id in sorted(self._index):
+                for seq, start, length, event_type in self._index[entity_id]:
+                    if seq not in sealed:
+                        continue
+                    begin = start + HEADER.size
+                    payload = self._map(seq, begin + length)[begin : begin + length]
+                    f.write(HEADER.pack(length, zlib.crc32(payload)))
+                    f.write(payload)
+                    relocated[(seq, start)] = (target, offset, length, event_type)
+                    entities.setdefault(entity_id, []).append((offset, length, event_type))
+                    offset += HEADER.size + length
+            f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        # the index marks the compacted segment complete
+        self._write_index(
+            target, SegmentIndex(entities=entities, tombstones=[]), COMPACT_SUFFIX
+        )
+
+        await self._no_readers.wait()
+        # no awaits from here on, readers never see a half swapped state
+        for seq in sealed:
+            if (mm := self._maps.pop(seq, None)) is not None:
+                mm.close()
+        self._swap_compacted(target)
+        # entities removed meanwhile are no longer indexed, their records in the
+        # compacted segment are dropped by the next compaction
+        for entity_id, entries in self._index.items():
+            self._index[entity_id] = [
+                relocated[(e[0], e[1])] if e[0] in sealed else e for e in entries
+            ]
+        # segments sealed by a roll meanwhile are kept
+        self._sealed = [target, *(seq for seq in self._sealed if seq not in sealed)]
+        return before - offset
+
+    async def close(self) -> None:
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        if self._fsync != "never":
+            await self._sync()
+        self._file.close()
+        for mm in self._maps.values():
+            mm.close()
+        self._maps.clear()
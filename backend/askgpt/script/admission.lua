@@ -0,0 +1,52 @@
+-- Admission of a request against several limits and its access token, in one call
+-- Keys: [token_zset, bucket_key...]
+-- Args: [token, now, max_wait, (emission_interval, burst, cost)...], a triple per bucket key
+-- Returns: {0, wait_time} when admitted, every bucket is then charged its cost
+-- and the request may proceed after wait_time, the longest wait of its buckets, no more than max_wait,
+-- {i, wait_time} for the first bucket i whose wait is longer, {-1, '0'} when the token is not in token_zset,
+-- nothing is charged unless the request is admitted, wait times are strings to keep their fraction.
+-- token_zset is scored by the expiry of its tokens, in seconds since epoch, see TokenRegistry,
+-- the token is not checked when empty, now is optional, redis TIME is used when it is empty,
+-- max_wait is 0 when empty, buckets are gcra buckets, see gcra.lua
+
+local current_time = tonumber(ARGV[2])
+if not current_time then
+    local now = redis.call('TIME')
+    current_time = tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+
+local token = ARGV[1]
+if token ~= '' then
+    local expires_at = tonumber(redis.call('ZSCORE', KEYS[1], token))
+    if not expires_at or expires_at <= current_time then
+        return { -1, '0' }
+    end
+end
+local max_wait = tonumber(ARGV[3]) or 0
+
+local new_tats, longest_wait = {}, 0
+for i = 2, #KEYS do
+    local arg = 4 + (i - 2) * 3
+    local emission_interval, burst, cost = tonumber(ARGV[arg]), tonumber(ARGV[arg + 1]), tonumber(ARGV[arg + 2])
+    if cost > 0 then
+        local tat = math.max(tonumber(redis.call('GET', KEYS[i])) or current_time, current_time)
+        local new_tat = tat + cost * emission_interval
+        local wait_time = math.max(0, new_tat - burst * emission_interval - current_time)
+        -- a cost above the burst is let through a full bucket, the debt delays the next request,
+        -- otherwise it would never be admitted
+        if tat == current_time then
+            wait_time = 0
+        end
+        if wait_time > max_wait then
+            return { i - 1, tostring(wait_time) }
+        end
+        new_tats[i], longest_wait = new_tat, math.max(longest_wait, wait_time)
+    end
+end
+
+for i, new_tat in pairs(new_tats) do
+    -- formatted, numbers passed to redis.call keep only 14 significant digits
+    local ms_to_full = math.ceil((new_tat - current_time) * 1000)
+    redis.call('SET', KEYS[i], string.format('%.6f', new_tat), 'PX', math.max(ms_to_full, 1))
+end
+return { 0, tostring(longest_wait) }
@@ -0,0 +1,33 @@
+-- Generic cell rate algorithm, one string key per bucket holding its theoretical arrival time
+-- Keys: [bucket_key]
+-- Args: [emission_interval, burst, cost, now, max_wait]
+-- Returns: the seconds until the request conforms, as a string to keep its fraction,
+-- it is admitted when that is no more than max_wait, 0 by default, and may proceed after the wait
+-- emission_interval is the seconds one token takes to refill, burst the max tokens,
+-- now is optional and in seconds, redis TIME is used when it is empty
+-- same limits as tokenbucket.lua, with one value instead of a hash of two.
+
+local bucket_key = KEYS[1]
+local emission_interval, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+
+local max_wait = tonumber(ARGV[5]) or 0
+local current_time = tonumber(ARGV[4])
+if not current_time then
+    local now = redis.call('TIME')
+    current_time = tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+
+-- a missing or past arrival time is a full bucket
+local tat = math.max(tonumber(redis.call('GET', bucket_key)) or current_time, current_time)
+local new_tat = tat + cost * emission_interval
+local wait_time = math.max(0, new_tat - burst * emission_interval - current_time)
+
+if wait_time > max_wait then
+    return tostring(wait_time)
+end
+
+-- formatted, numbers passed to redis.call keep only 14 significant digits,
+-- the key expires when the bucket would be full again
+local ms_to_full = math.ceil((new_tat - current_time) * 1000)
+redis.call('SET', bucket_key, string.format('%.6f', new_tat), 'PX', math.max(ms_to_full, 1))
+return tostring(wait_time)
@@ -0,0 +1,33 @@
+-- Move gcra buckets by a number of tokens without checking their limits, e.g. to settle a reservation
+-- Keys: [bucket_key...]
+-- Args: [now, from_now, (emission_interval, tokens)...], a pair per bucket key
+-- positive tokens are charged, negative ones given back, a bucket is never more than full
+-- with from_now set to 1, a bucket owes at least `tokens` from now on instead, e.g. for a lockout,
+-- debts already charged are not added to it
+-- now is optional, redis TIME is used when it is empty, see gcra.lua
+
+local current_time = tonumber(ARGV[1])
+if not current_time then
+    local now = redis.call('TIME')
+    current_time = tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+local from_now = ARGV[2] == '1'
+
+for i = 1, #KEYS do
+    local emission_interval, tokens = tonumber(ARGV[i * 2 + 1]), tonumber(ARGV[i * 2 + 2])
+    local tat = math.max(tonumber(redis.call('GET', KEYS[i])) or current_time, current_time)
+    local new_tat
+    if from_now then
+        new_tat = math.max(tat, current_time + tokens * emission_interval)
+    else
+        new_tat = tat + tokens * emission_interval
+    end
+    if new_tat > current_time then
+        -- formatted, numbers passed to redis.call keep only 14 significant digits
+        local ms_to_full = math.ceil((new_tat - current_time) * 1000)
+        redis.call('SET', KEYS[i], string.format('%.6f', new_tat), 'PX', math.max(ms_to_full, 1))
+    else
+        redis.call('DEL', KEYS[i])
+    end
+end
+return 1
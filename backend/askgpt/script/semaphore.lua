@@ -0,0 +1,27 @@
+-- Acquire a slot of a distributed semaphore, a sorted set of lease ids scored by their expiry
+-- Keys: [semaphore_key]
+-- Args: [lease_id, limit, lease_ttl, now]
+-- Returns: 1 when the lease is added, 0 when `limit` leases are held already
+-- expired leases, e.g. of a crashed worker, are removed first,
+-- leases live `lease_ttl` seconds unless renewed, see semaphorerenew.lua,
+-- now is optional and in seconds, redis TIME is used when it is empty
+
+local semaphore_key, lease_id = KEYS[1], ARGV[1]
+local limit, lease_ttl = tonumber(ARGV[2]), tonumber(ARGV[3])
+
+local current_time = tonumber(ARGV[4])
+if not current_time then
+    local now = redis.call('TIME')
+    current_time = tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+
+redis.call('ZREMRANGEBYSCORE', semaphore_key, '-inf', string.format('%.6f', current_time))
+if redis.call('ZCARD', semaphore_key) >= limit then
+    return 0
+end
+
+-- formatted, numbers passed to redis.call keep only 14 significant digits,
+-- the key expires with the lease expiring last
+redis.call('ZADD', semaphore_key, string.format('%.6f', current_time + lease_ttl), lease_id)
+redis.call('PEXPIRE', semaphore_key, math.ceil(lease_ttl * 1000))
+return 1
@@ -0,0 +1,28 @@
+-- Extend the leases held by a worker, in every semaphore at once
+-- Keys: [semaphore_key...]
+-- Args: [lease_ttl, now, (count, lease_id...)...], the lease ids of each key, prefixed by their count
+-- Returns: the number of leases renewed, a lease already removed is not added again
+-- now is optional, redis TIME is used when it is empty, see semaphore.lua
+
+local lease_ttl = tonumber(ARGV[1])
+local current_time = tonumber(ARGV[2])
+if not current_time then
+    local now = redis.call('TIME')
+    current_time = tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+
+local expires_at = string.format('%.6f', current_time + lease_ttl)
+local ttl_ms = math.ceil(lease_ttl * 1000)
+local renewed, arg = 0, 3
+for i = 1, #KEYS do
+    local count = tonumber(ARGV[arg])
+    local members = {}
+    for j = 1, count do
+        members[#members + 1] = expires_at
+        members[#members + 1] = ARGV[arg + j]
+    end
+    arg = arg + count + 1
+    renewed = renewed + redis.call('ZADD', KEYS[i], 'XX', 'CH', unpack(members))
+    redis.call('PEXPIRE', KEYS[i], ttl_ms)
+end
+return renewed
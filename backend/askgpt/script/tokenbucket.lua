@@ -1,31 +1,44 @@
 -- Token bucket algorithm implementation
 -- Keys: [bucket_key]
--- Args: [max_tokens, refill_rate_s, token_cost]
+-- Args: [max_tokens, refill_rate_s, token_cost, now, max_wait]
+-- Returns: the seconds until the tokens are refilled, as a string to keep its fraction,
+-- the tokens are taken when it is no more than max_wait, 0 by default,
+-- a wait up to max_wait reserves tokens not refilled yet, the bucket is left in debt.
+-- now is optional and in seconds, redis TIME is used when it is empty, tests pass it to control the clock
 
 local bucket_key, max_tokens, refill_rate_s, token_cost = KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]),
     tonumber(ARGV[3])
 
+local max_wait = tonumber(ARGV[5]) or 0
+local current_time = tonumber(ARGV[4])
+if not current_time then
+    local now = redis.call('TIME')
+    current_time = tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+
 -- Retrieve the current state from Redis
 local bucket = redis.call('HMGET', bucket_key, 'last_refill_time', 'tokens')
 local last_refill_time, tokens = tonumber(bucket[1]), tonumber(bucket[2])
 
 -- Initialize if not present
 if not last_refill_time then
-    last_refill_time, tokens = redis.call('TIME')[1], max_tokens
+    last_refill_time, tokens = current_time, max_tokens
 end
 
 -- Calculate tokens based on the elapsed time
-local current_time = redis.call('TIME')[1]
-local elapsed = current_time - last_refill_time
+local elapsed = math.max(0, current_time - last_refill_time)
 local new_tokens = math.min(max_tokens, tokens + elapsed * refill_rate_s)
 
--- Check if there are enough tokens
-if new_tokens >= token_cost then
-    local token_left = new_tokens - token_cost
-    redis.call('HMSET', bucket_key, 'last_refill_time', current_time, 'tokens', token_left)
-    return 0
-else
-    local needed = token_cost - new_tokens
-    local wait_time = needed / refill_rate_s
-    return wait_time
+-- Check if the tokens are refilled soon enough
+local wait_time = math.max(0, token_cost - new_tokens) / refill_rate_s
+if wait_time > max_wait then
+    return tostring(wait_time)
 end
+
+local token_left = new_tokens - token_cost
+-- formatted, numbers passed to redis.call keep only 14 significant digits
+redis.call('HSET', bucket_key, 'last_refill_time', string.format('%.6f', current_time), 'tokens', token_left)
+-- once refilled the bucket is the same as a missing one, let it go
+local ms_to_full = math.ceil((max_tokens - token_left) / refill_rate_s * 1000)
+redis.call('PEXPIRE', bucket_key, math.max(ms_to_full, 1))
+return tostring(wait_time)
@@ -0,0 +1,14 @@
+-- Return unused leased tokens to a token bucket
+-- Keys: [bucket_key]
+-- Args: [max_tokens, tokens]
+-- the bucket is left as is when it expired meanwhile, it is full by then anyway
+
+local bucket_key = KEYS[1]
+local max_tokens, returned = tonumber(ARGV[1]), tonumber(ARGV[2])
+
+local tokens = tonumber(redis.call('HGET', bucket_key, 'tokens'))
+if not tokens then
+    return 0
+end
+redis.call('HSET', bucket_key, 'tokens', math.min(max_tokens, tokens + returned))
+return 1
@@ -0,0 +1,45 @@
+-- Lease a batch of tokens out of a token bucket
+-- Keys: [bucket_key]
+-- Args: [max_tokens, refill_rate_s, want, least, now, max_wait]
+-- Returns: [granted, wait_time], wait_time is a string to keep its fraction
+-- now is optional and in seconds, redis TIME is used when it is empty
+-- grants up to `want` tokens, but only if at least `least` are available,
+-- otherwise returns how long until `least` tokens are refilled, when that is no more than max_wait,
+-- 0 by default, `least` tokens are granted in advance and usable after wait_time, else nothing is.
+
+local bucket_key = KEYS[1]
+local max_tokens, refill_rate_s = tonumber(ARGV[1]), tonumber(ARGV[2])
+local want, least = tonumber(ARGV[3]), tonumber(ARGV[4])
+
+local max_wait = tonumber(ARGV[6]) or 0
+local current_time = tonumber(ARGV[5])
+if not current_time then
+    local now = redis.call('TIME')
+    current_time = tonumber(now[1]) + tonumber(now[2]) / 1000000
+end
+
+local bucket = redis.call('HMGET', bucket_key, 'last_refill_time', 'tokens')
+local last_refill_time, tokens = tonumber(bucket[1]), tonumber(bucket[2])
+
+if not last_refill_time then
+    last_refill_time, tokens = current_time, max_tokens
+end
+
+local elapsed = math.max(0, current_time - last_refill_time)
+tokens = math.min(max_tokens, tokens + elapsed * refill_rate_s)
+
+local granted, wait_time = 0, (least - tokens) / refill_rate_s
+if tokens >= least then
+    granted, wait_time = math.min(want, math.floor(tokens)), 0
+elseif wait_time <= max_wait then
+    -- reserved, the bucket is left in debt
+    granted = least
+end
+
+tokens = tokens - granted
+-- formatted, numbers passed to redis.call keep only 14 significant digits
+redis.call('HSET', bucket_key, 'last_refill_time', string.format('%.6f', current_time), 'tokens', tokens)
+-- once refilled the bucket is the same as a missing one, let it go
+local ms_to_full = math.ceil((max_tokens - tokens) / refill_rate_s * 1000)
+redis.call('PEXPIRE', bucket_key, math.max(ms_to_full, 1))
+return { granted, tostring(wait_time) }
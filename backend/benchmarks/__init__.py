@@ -0,0 +1,5 @@
+"""
+Micro benchmarks, each module is runnable on its own:
+
+python -m benchmarks.<module>
+"""
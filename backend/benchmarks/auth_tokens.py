@@ -0,0 +1,79 @@
+"""
+Cost per request of verifying the access token, as parse_access_token does,
+decoded every time and kept in VerifiedTokenCache,
+the revocation check that follows is a single cache GET either way and is left out
+
+python -m benchmarks.auth_tokens
+BENCH_TOKENS=100000 python -m benchmarks.auth_tokens
+"""
+
+import datetime
+import os
+import time
+import types
+
+from askgpt.adapters.cache import MemoryCache
+from askgpt.app.auth._model import AccessToken, UserRoles
+from askgpt.app.auth.service import AuthService, TokenRegistry, VerifiedTokenCache
+from askgpt.domain.config import Settings
+from askgpt.domain.model.base import utc_now
+from askgpt.helpers.string import KeySpace
+from askgpt.infra.security import Encryptor
+
+REQUESTS = 100_000
+# distinct tokens in use, e.g. one per active user
+TOKENS = int(os.environ.get("BENCH_TOKENS", 1000))
+
+
+def make_service(verified: VerifiedTokenCache | None) -> AuthService:
+    security = Settings.Security(
+        SECRET_KEY="bench-secret-key-of-32-bytes-000",  # type: ignore
+        ALGORITHM="HS256",
+        ACCESS_TOKEN_EXPIRE_MINUTES=30,
+        CORS_ORIGINS=["*"],
+    )
+    encryptor = Encryptor(security.SECRET_KEY.get_secret_value(), security.ALGORITHM)
+    registry = TokenRegistry(MemoryCache(), KeySpace("bench"), verified=verified)
+    return AuthService(
+        auth_repo=types.SimpleNamespace(uow=None),  # type: ignore
+        token_registry=registry,
+        encryptor=encryptor,
+        eventstore=None,  # type: ignore
+        security_settings=security,
+    )
+
+
+def make_tokens(service: AuthService) -> list[str]:
+    now_ = utc_now()
+    return [
+        service._encryptor.encrypt_jwt(
+            AccessToken(
+                sub=f"user-{i}",
+                role=UserRoles.user,
+                exp=now_ + datetime.timedelta(minutes=30),
+                nbf=now_,
+                iat=now_,
+            )
+        )
+        for i in range(TOKENS)
+    ]
+
+
+def bench(name: str, service: AuthService, tokens: list[str]):
+    pre = time.perf_counter()
+    for i in range(REQUESTS):
+        service.decrypt_access_token(tokens[i % len(tokens)])
+    per_request = (time.perf_counter() - pre) / REQUESTS
+    print(f"{name:<20} {per_request * 1e6:>8.2f} us/request")
+
+
+def main():
+    print(f"{REQUESTS:,} requests over {TOKENS:,} tokens")
+    uncached = make_service(None)
+    tokens = make_tokens(uncached)
+    bench("decoded every time", uncached, tokens)
+    bench("verified cache", make_service(VerifiedTokenCache(max_size=TOKENS)), tokens)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Stored size and decode speed of chat event bodies,
+plain json vs zstd vs zstd with a dictionary trained on other chat events.
+
+python -m benchmarks.body_codec
+"""
+
+import gc
+import random
+import time
+import typing as ty
+
+import zstandard
+
+from askgpt.app.gpt._model import ChatMessage, ChatMessageSent, ChatResponseReceived
+from askgpt.infra.bodycodec import BodyCodecs, train_dictionary
+from askgpt.infra.eventstore import EventCodec, dump_event
+
+ROUNDS = 10
+EVENTS = 20_000
+TRAIN_EVENTS = 5_000
+
+WORDS = (
+    "the a to of and in is it you that for this with on can be use your function "
+    "python code example return value error data file list string class import "
+    "would like should could here how what why when which also need make sure "
+    "async await request response database query index cache token session"
+).split()
+
+
+def make_events(n: int, rand: random.Random) -> list[ChatMessageSent]:
+    events: list[ChatMessageSent] = []
+    for i in range(n):
+        session_id = f"session-{i // 20}"
+        if i % 2:
+            content = " ".join(rand.choices(WORDS, k=rand.randint(5, 30))) + "?"
+            msg = ChatMessage(role="user", content=content, gpt_type="openai")
+            events.append(ChatMessageSent(session_id=session_id, chat_message=msg))
+        else:
+            content = " ".join(rand.choices(WORDS, k=rand.randint(50, 400))) + "."
+            msg = ChatMessage(role="assistant", content=content, gpt_type="openai")
+            events.append(
+                ChatResponseReceived(session_id=session_id, chat_message=msg)
+            )
+    return events
+
+
+def make_rows(
+    events: list[ChatMessageSent], bodies: BodyCodecs | None = None
+) -> list[dict[str, ty.Any]]:
+    rows = [dump_event(event, bodies) for event in events]
+    for row in rows:
+        row["gmt_created"] = row["gmt_created"].replace(tzinfo=None)
+    return rows
+
+
+def stored_size(rows: list[dict[str, ty.Any]]) -> int:
+    return sum(
+        len(row["event_blob"]) if row["body_codec"] else len(row["event_body"])
+        for row in rows
+    )
+
+
+def bench(name: str, rows: list[dict[str, ty.Any]], codec: EventCodec) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        gc.collect()
+        pre = time.perf_counter()
+        codec.decode_rows(rows)
+        best = min(best, time.perf_counter() - pre)
+    rate = len(rows) / best
+    print(f"{name:<24} {rate:>12,.0f} events/s")
+    return rate
+
+
+def main():
+    rand = random.Random(0)
+    train = make_rows(make_events(TRAIN_EVENTS, rand))
+    events = make_events(EVENTS, rand)
+
+    codec_id, dictionary = train_dictionary(
+        [row["event_body"].encode() for row in train]
+    )
+    bodies = BodyCodecs()
+    bodies.register(codec_id, dictionary, active=True)
+
+    plain_rows = make_rows(events)
+    dict_rows = make_rows(events, bodies)
+    no_dict = zstandard.ZstdCompressor(level=3)
+    plain_size = stored_size(plain_rows)
+    zstd_size = sum(len(no_dict.compress(r["event_body"].encode())) for r in plain_rows)
+    dict_size = stored_size(dict_rows)
+
+    print(f"{'plain json':<24} {plain_size / EVENTS:>8.0f} bytes/event")
+    print(
+        f"{'zstd':<24} {zstd_size / EVENTS:>8.0f} bytes/event"
+        f" ({plain_size / zstd_size:.2f}x)"
+    )
+    print(
+        f"{'zstd + dictionary':<24} {dict_size / EVENTS:>8.0f} bytes/event"
+        f" ({plain_size / dict_size:.2f}x, {len(dictionary)} bytes dictionary)"
+    )
+
+    gc.freeze()
+    codec = EventCodec(bodies=bodies)
+    plain = bench("decode plain", plain_rows, codec)
+    compressed = bench("decode zstd + dictionary", dict_rows, codec)
+    print(f"decode cost: {plain / compressed:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
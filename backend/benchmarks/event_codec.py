@@ -0,0 +1,59 @@
+"""
+Events/second decoding ChatMessageSent rows,
+`load_event`(pydantic validation) vs `EventCodec`(compiled, model_construct)
+
+python -m benchmarks.event_codec
+"""
+
+import gc
+import time
+import typing as ty
+
+from askgpt.app.gpt._model import ChatMessage, ChatMessageSent
+from askgpt.infra.eventstore import EventCodec, dump_event, load_event
+
+ROUNDS = 10
+EVENTS = 20_000
+
+
+def make_rows(n: int) -> list[dict[str, ty.Any]]:
+    rows: list[dict[str, ty.Any]] = []
+    for i in range(n):
+        role = "user" if i % 2 else "assistant"
+        msg = ChatMessage(role=role, content=f"message {i} " * 20, gpt_type="openai")
+        row = dump_event(ChatMessageSent(session_id="session", chat_message=msg))
+        row["gmt_created"] = row["gmt_created"].replace(tzinfo=None)
+        rows.append(row)
+    return rows
+
+
+def bench(
+    name: str,
+    rows: list[dict[str, ty.Any]],
+    decode: ty.Callable[[list[dict[str, ty.Any]]], ty.Any],
+) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        gc.collect()
+        pre = time.perf_counter()
+        decode(rows)
+        best = min(best, time.perf_counter() - pre)
+    rate = EVENTS / best
+    print(f"{name:<24} {rate:>12,.0f} events/s")
+    return rate
+
+
+def main():
+    rows = make_rows(EVENTS)
+    gc.freeze()  # keep the fixture rows out of collections we measure
+
+    codec = EventCodec()
+    validating = EventCodec(validate=True)
+    before = bench("load_event", rows, lambda rows: [load_event(r) for r in rows])
+    bench("EventCodec(validate)", rows, validating.decode_rows)
+    after = bench("EventCodec", rows, codec.decode_rows)
+    print(f"speedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
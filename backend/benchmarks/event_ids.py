@@ -0,0 +1,105 @@
+"""
+Insert throughput and primary key index size of a large domain_events table,
+keyed by uuid4 strings, uuid7 strings and uuid7 in 16 bytes(CompactUUID)
+
+python -m benchmarks.event_ids
+"""
+
+import asyncio
+import tempfile
+import time
+import typing as ty
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy.ext import asyncio as sa_aio
+
+from askgpt.helpers.ids import uuid7
+
+ROWS = 500_000
+BATCH = 1000
+BODY = '{"role": "user", "content": "' + "x" * 200 + '"}'
+
+
+class CompactUUID(sa.types.TypeDecorator[str]):
+    """
+    uuid strings stored in 16 bytes, a native uuid on postgres and a blob elsewhere.
+    bytes sort like the strings, so uuid7 keys stay time ordered.
+    """
+
+    impl = sa.LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect: sa.Dialect) -> sa.types.TypeEngine[ty.Any]:
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(sa.Uuid(as_uuid=False))
+        return dialect.type_descriptor(sa.LargeBinary(16))
+
+    def process_bind_param(self, value: str | None, dialect: sa.Dialect) -> ty.Any:
+        if value is None or dialect.name == "postgresql":
+            return value
+        return uuid.UUID(value).bytes
+
+    def process_result_value(self, value: ty.Any, dialect: sa.Dialect) -> str | None:
+        if value is None or dialect.name == "postgresql":
+            return value
+        return str(uuid.UUID(bytes=value))
+
+
+def make_table(name: str, id_type: ty.Any) -> sa.Table:
+    return sa.Table(
+        name,
+        sa.MetaData(),
+        sa.Column("id", id_type, primary_key=True),
+        sa.Column("entity_id", sa.String),
+        sa.Column("event_body", sa.String),
+    )
+
+
+async def bench(
+    engine: sa_aio.AsyncEngine, table: sa.Table, make_id: ty.Callable[[], str]
+):
+    async with engine.begin() as conn:
+        await conn.run_sync(table.metadata.create_all)
+
+    stmt = sa.insert(table)
+    pre = time.perf_counter()
+    for offset in range(0, ROWS, BATCH):
+        rows = [
+            dict(id=make_id(), entity_id=f"session-{(offset + i) // 50}", event_body=BODY)
+            for i in range(BATCH)
+        ]
+        async with engine.begin() as conn:
+            await conn.execute(stmt, rows)
+    rate = ROWS / (time.perf_counter() - pre)
+
+    async with engine.connect() as conn:
+        sizes = dict(
+            (
+                await conn.exec_driver_sql(
+                    "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"
+                )
+            ).all()
+        )
+    index = sum(size for name, size in sizes.items() if name.startswith("sqlite_autoindex"))
+    print(
+        f"{table.name:<16} {rate:>10,.0f} rows/s  "
+        f"pk index {index / 2**20:>7.1f}MB  table {sizes[table.name] / 2**20:>7.1f}MB"
+    )
+
+
+async def main():
+    variants = (
+        ("uuid4_string", sa.String, lambda: str(uuid.uuid4())),
+        ("uuid7_string", sa.String, lambda: str(uuid7())),
+        ("uuid7_compact", CompactUUID, lambda: str(uuid7())),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, id_type, make_id in variants:
+            engine = sa_aio.create_async_engine(f"sqlite+aiosqlite:///{tmp}/{name}.db")
+            await bench(engine, make_table(name, id_type), make_id)
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
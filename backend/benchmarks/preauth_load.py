@@ -0,0 +1,190 @@
+"""
+Login latency of regular users while one ip bursts failed logins at auth/login,
+without and with PreAuthMiddleware, passwords are checked with bcrypt as AuthService does
+
+BENCH_REDIS_URL must point to a disposable database, it is flushed between runs
+BENCH_REDIS_URL=redis://localhost:6379/15 python -m benchmarks.preauth_load
+BENCH_SECONDS=20 BENCH_ATTACKERS=100 python -m benchmarks.preauth_load
+"""
+
+import asyncio
+import os
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+from askgpt.adapters.admission import AdmissionController, Limit
+from askgpt.adapters.cache import RedisCache
+from askgpt.api.middleware import PreAuthMiddleware, TraceMiddleware
+from askgpt.api.throttler import AuthAttemptLimiter
+from askgpt.domain.config import Settings
+from askgpt.helpers.security import hash_password, verify_password
+from askgpt.helpers.string import KeySpace
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+SECONDS = float(os.environ.get("BENCH_SECONDS", 30))
+ATTACKERS = int(os.environ.get("BENCH_ATTACKERS", 50))
+USERS = 10
+# 2 logins a second in all, well within one core with bcrypt at 12 rounds
+USER_INTERVAL = 5.0
+PASSWORD = b"correct horse battery staple"
+LOGIN_PATH = "/v1/auth/login"
+
+
+def login_app() -> ASGIApp:
+    "auth/login reduced to its bcrypt check, 401 unless the password matches"
+    hashed = hash_password(PASSWORD)
+
+    async def app(scope: Scope, receive: Receive, send: Send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+        password = parse_qs(body.decode()).get("password", [""])[0]
+        status = 200 if verify_password(password.encode(), hashed) else 401
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    return app
+
+
+def make_limiter(redis: RedisCache[str]) -> AuthAttemptLimiter:
+    config = Settings.Throttling.PreAuth()
+    # only for the default script paths
+    scripts = Settings.Redis(
+        HOST="localhost",
+        PORT=0,
+        DB=0,
+        keyspaces=Settings.Redis.KeySpaces(APP="bench"),  # type: ignore
+    )
+    keyspace = KeySpace("bench") / "auth"
+    limits = [
+        Limit(
+            "auth_ip",
+            keyspace / "ip",
+            config.IP_MAX_ATTEMPTS_PER_MINUTE,
+            config.IP_MAX_ATTEMPTS_PER_MINUTE / 60,
+        ),
+        Limit(
+            "auth_email",
+            keyspace / "email",
+            config.EMAIL_MAX_ATTEMPTS_PER_MINUTE,
+            config.EMAIL_MAX_ATTEMPTS_PER_MINUTE / 60,
+        ),
+    ]
+    controller = AdmissionController(
+        redis.load_script(scripts.ADMISSION_SCRIPT),
+        redis.load_script(scripts.ADMISSION_ADJUST_SCRIPT),
+        limits,
+    )
+    return AuthAttemptLimiter(
+        redis,
+        controller,
+        keyspace / "failures",
+        lockout_threshold=config.LOCKOUT_THRESHOLD,
+        lockout_base=config.LOCKOUT_BASE,
+        lockout_max=config.LOCKOUT_MAX,
+        failure_window=config.FAILURE_WINDOW,
+    )
+
+
+def client(app: ASGIApp, ip: str) -> httpx.AsyncClient:
+    transport = httpx.ASGITransport(app=app, client=(ip, 5000))  # type: ignore
+    return httpx.AsyncClient(transport=transport, base_url="http://bench")
+
+
+async def user(app: ASGIApp, i: int, start: float, deadline: float) -> list[float]:
+    """
+    logs in every USER_INTERVAL seconds, as a different user and ip each time
+    so regular logins stay within the limits, returns the latency of each login.
+
+    latencies are measured from when the login was due, not from when it was sent,
+    time spent waiting for a blocked event loop counts.
+    """
+    latencies: list[float] = []
+    # users are spread over the interval
+    due = start + USER_INTERVAL * i / USERS
+    n = 0
+    while due < deadline:
+        n += 1
+        await asyncio.sleep(max(0, due - time.perf_counter()))
+        async with client(app, f"10.{i}.{n // 250}.{n % 250 + 1}") as http:
+            form = {"username": f"user{i}-{n}@askgpt.test", "password": PASSWORD.decode()}
+            response = await http.post(LOGIN_PATH, data=form)
+            assert response.status_code == 200, response.status_code
+        latencies.append(time.perf_counter() - due)
+        due += USER_INTERVAL
+    return latencies
+
+
+async def attacker(app: ASGIApp, i: int, deadline: float) -> int:
+    "tries leaked emails with wrong passwords from a single ip, returns the attempts"
+    attempts = 0
+    async with client(app, "198.51.100.7") as http:
+        while time.perf_counter() < deadline:
+            form = {"username": f"victim{i}-{attempts}@askgpt.test", "password": "x"}
+            await http.post(LOGIN_PATH, data=form)
+            attempts += 1
+            # a request that never waits on a socket would never give the loop up,
+            # remote attackers do
+            await asyncio.sleep(0)
+    return attempts
+
+
+def percentile(latencies: list[float], q: int) -> float:
+    "in ms, nearest rank, under an attack users may only get a few logins through"
+    ranked = sorted(latencies)
+    return ranked[min(len(ranked) - 1, len(ranked) * q // 100)] * 1000
+
+
+async def bench(name: str, app: ASGIApp, attackers: int):
+    start = time.perf_counter()
+    deadline = start + SECONDS
+    attacks = asyncio.gather(*(attacker(app, i, deadline) for i in range(attackers)))
+    users = await asyncio.gather(
+        *(user(app, i, start, deadline) for i in range(USERS))
+    )
+    attempts = sum(await attacks)
+    latencies = [latency for user_latencies in users for latency in user_latencies]
+    print(
+        f"{name:<24} p50 {percentile(latencies, 50):>8,.0f} ms"
+        f"  p99 {percentile(latencies, 99):>8,.0f} ms"
+        f"  {len(latencies):>5} logins  {attempts:>7,} attack attempts"
+    )
+
+
+async def main():
+    redis = RedisCache[str].build(
+        url=os.environ.get("BENCH_REDIS_URL", "redis://localhost:6379/15"),
+        keyspace="bench",
+        decode_responses=True,
+        max_connections=ATTACKERS + USERS,
+        socket_timeout=10,
+        socket_connect_timeout=2,
+    )
+    inner = login_app()
+    async with redis.lifespan():
+        await redis.client.flushdb()
+        limiter = make_limiter(redis)
+        guarded = TraceMiddleware(
+            PreAuthMiddleware(
+                inner,
+                login_path=LOGIN_PATH,
+                signup_path="/v1/auth/signup",
+                max_body_size=Settings.Throttling.PreAuth().MAX_BODY_SIZE,
+                limiter=limiter,
+            )
+        )
+        print(f"{USERS} users, {ATTACKERS} concurrent attackers, {SECONDS:.0f}s each")
+        async with limiter.lifespan():
+            await bench("no attack", inner, 0)
+            await bench("attack, unguarded", inner, ATTACKERS)
+            await bench("attack, pre-auth limiter", guarded, ATTACKERS)
+        await redis.client.flushdb()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+"""
+Ops/s and redis memory per user of the user request limiters:
+the token bucket checked on every request, the leased token bucket and GCRA
+
+BENCH_REDIS_URL must point to a disposable database, it is flushed between runs
+BENCH_REDIS_URL=redis://localhost:6379/15 python -m benchmarks.rate_limiters
+BENCH_USERS=100000 python -m benchmarks.rate_limiters
+"""
+
+import asyncio
+import os
+import time
+import typing as ty
+
+from askgpt.adapters.cache import RedisCache
+from askgpt.adapters.tokenbucket import (
+    GCRALimiter,
+    HybridTokenBucket,
+    KeyedLimiter,
+    TokenLeaser,
+)
+from askgpt.domain.config import Settings
+
+USERS = int(os.environ.get("BENCH_USERS", 1_000_000))
+HOT_USERS = 1000
+HOT_REQUESTS = 200_000
+CONCURRENCY = 64
+# slow enough that no key expires during a run
+MAX_TOKENS = 100
+REFILL_RATE_S = MAX_TOKENS / 86400
+
+
+def make_limiters(redis: RedisCache[str]) -> dict[str, KeyedLimiter]:
+    # only for the default script paths
+    config = Settings.Redis(
+        HOST="localhost",
+        PORT=0,
+        DB=0,
+        keyspaces=Settings.Redis.KeySpaces(APP="bench"),  # type: ignore
+    )
+    leaser = TokenLeaser(
+        redis,
+        redis.load_script(config.TOKEN_LEASE_SCRIPT),
+        redis.load_script(config.TOKEN_GIVE_BACK_SCRIPT),
+    )
+    limit = dict(max_tokens=MAX_TOKENS, refill_rate_s=REFILL_RATE_S)
+    return {
+        "token bucket (strict)": HybridTokenBucket(leaser, **limit, strict=True),
+        "token bucket (leased)": HybridTokenBucket(leaser, **limit, strict_below=0),
+        "gcra": GCRALimiter(redis, redis.load_script(config.GCRA_SCRIPT), **limit),
+    }
+
+
+async def run(limiter: KeyedLimiter, keys: ty.Iterator[str], total: int) -> float:
+    "acquires `total` times from CONCURRENCY tasks, returns ops/s"
+
+    async def worker(count: int):
+        for _ in range(count):
+            await limiter.acquire(next(keys))
+
+    pre = time.perf_counter()
+    await asyncio.gather(*(worker(total // CONCURRENCY) for _ in range(CONCURRENCY)))
+    return total // CONCURRENCY * CONCURRENCY / (time.perf_counter() - pre)
+
+
+async def used_memory(redis: RedisCache[str]) -> int:
+    info = await redis.client.info("memory")
+    return int(info["used_memory"])
+
+
+async def bench(name: str, limiter: KeyedLimiter, redis: RedisCache[str]):
+    await redis.client.flushdb()
+    async with limiter.lifespan():
+        before = await used_memory(redis)
+        spread = await run(limiter, (f"user-{i}" for i in range(USERS)), USERS)
+        per_user = (await used_memory(redis) - before) / USERS
+        sample = await redis.client.memory_usage(await redis.client.randomkey())
+
+        hot = (f"user-{i % HOT_USERS}" for i in range(HOT_REQUESTS))
+        hot_rate = await run(limiter, hot, HOT_REQUESTS)
+
+    print(
+        f"{name:<24} {spread:>9,.0f} ops/s  {hot_rate:>9,.0f} ops/s hot"
+        f"  {per_user:>6,.0f} B/user  ({sample} B key)"
+    )
+
+
+async def main():
+    redis = RedisCache[str].build(
+        url=os.environ.get("BENCH_REDIS_URL", "redis://localhost:6379/15"),
+        keyspace="bench",
+        decode_responses=True,
+        max_connections=CONCURRENCY,
+        socket_timeout=10,
+        socket_connect_timeout=2,
+    )
+    async with redis.lifespan():
+        print(f"{USERS:,} users, then {HOT_REQUESTS:,} requests over {HOT_USERS:,}")
+        for name, limiter in make_limiters(redis).items():
+            await bench(name, limiter, redis)
+        await redis.client.flushdb()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+"""
+Append and rebuild throughput, sqlite `EventStore` vs `SegmentEventStore`
+
+python -m benchmarks.segment_store
+"""
+
+import asyncio
+import tempfile
+import time
+import typing as ty
+from pathlib import Path
+
+from sqlalchemy.ext import asyncio as sa_aio
+
+from askgpt.adapters.database import AsyncDatabase
+from askgpt.app.gpt._model import ChatMessage, ChatMessageSent
+from askgpt.helpers.sql import UnitOfWork
+from askgpt.infra.eventstore import EventStore
+from askgpt.infra.schema import create_tables
+from askgpt.infra.segmentstore import SegmentEventStore
+
+SESSIONS = 200
+EVENTS_PER_SESSION = 50
+BATCH = 10  # events appended per transaction, roughly one chat round trip
+
+
+def make_events() -> list[list[ChatMessageSent]]:
+    sessions: list[list[ChatMessageSent]] = []
+    for s in range(SESSIONS):
+        events = [
+            ChatMessageSent(
+                session_id=f"session-{s}",
+                chat_message=ChatMessage(
+                    role="user" if i % 2 else "assistant",
+                    content=f"message {i} " * 20,
+                    gpt_type="openai",
+                ),
+            )
+            for i in range(EVENTS_PER_SESSION)
+        ]
+        sessions.append(events)
+    return sessions
+
+
+class Store(ty.Protocol):
+    @property
+    def uow(self) -> ty.Any: ...
+
+    async def add_all(self, events: list[ty.Any]) -> None: ...
+
+    async def get(self, entity_id: str) -> list[ty.Any]: ...
+
+
+async def bench(name: str, store: Store, sessions: list[list[ChatMessageSent]]):
+    total = SESSIONS * EVENTS_PER_SESSION
+
+    pre = time.perf_counter()
+    for offset in range(0, EVENTS_PER_SESSION, BATCH):
+        for events in sessions:
+            async with store.uow.trans():
+                await store.add_all(events[offset : offset + BATCH])
+    append = total / (time.perf_counter() - pre)
+
+    pre = time.perf_counter()
+    for events in sessions:
+        async with store.uow.trans():
+            rebuilt = await store.get(events[0].entity_id)
+        assert len(rebuilt) == EVENTS_PER_SESSION
+    rebuild = total / (time.perf_counter() - pre)
+
+    print(f"{name:<24} append {append:>10,.0f} events/s  rebuild {rebuild:>10,.0f} events/s")
+
+
+async def main():
+    sessions = make_events()
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sa_aio.create_async_engine(f"sqlite+aiosqlite:///{tmp}/events.db")
+        aiodb = AsyncDatabase(engine)
+        await create_tables(aiodb)
+        await bench("sqlite EventStore", EventStore(UnitOfWork(aiodb)), sessions)
+        await aiodb.close()
+
+        for fsync in ("always", "batch"):
+            store = SegmentEventStore(Path(tmp) / f"segments-{fsync}", fsync=fsync)
+            await bench(f"segments fsync={fsync}", store, sessions)
+            await store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
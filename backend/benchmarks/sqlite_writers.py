@@ -0,0 +1,114 @@
+"""
+Concurrent writers on sqlite: the default engine, WAL pragmas,
+a single writer connection, and a single writer with group commit
+
+python -m benchmarks.sqlite_writers
+"""
+
+import asyncio
+import statistics
+import tempfile
+import time
+
+from sqlalchemy.ext import asyncio as sa_aio
+
+from askgpt.adapters.database import AsyncDatabase, SqliteReadPool, SqliteWriter
+from askgpt.app.gpt._model import ChatMessage, ChatMessageSent
+from askgpt.domain.config import Settings
+from askgpt.helpers.sql import UnitOfWork
+from askgpt.infra.eventstore import EventStore
+from askgpt.infra.factory import apply_sqlite_profile, sqlite_pool_options
+from askgpt.infra.schema import create_tables
+
+WRITERS = 50
+TRANSACTIONS = 20  # per writer
+READERS = 10
+
+
+def make_db(
+    url: str, profile: Settings.DB.SqliteProfile | None, *, readers: bool = False
+) -> AsyncDatabase:
+    options = sqlite_pool_options(profile, readers=readers) if profile else {}
+    engine = sa_aio.create_async_engine(url, **options)
+    if profile:
+        apply_sqlite_profile(engine.sync_engine, profile)
+    return AsyncDatabase(engine)
+
+
+async def writer(store: EventStore, n: int, latencies: list[float], errors: list[str]):
+    for i in range(TRANSACTIONS):
+        event = ChatMessageSent(
+            session_id=f"session-{n}",
+            chat_message=ChatMessage(role="user", content=f"message {i}", gpt_type="openai"),
+        )
+        pre = time.perf_counter()
+        try:
+            async with store.uow.trans():
+                await store.add(event)
+        except Exception as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - pre)
+
+
+async def reader(store: EventStore, stop: asyncio.Event, reads: list[int]):
+    while not stop.is_set():
+        async with store.uow.trans(readonly=True):
+            await store.get("session-0")
+        reads.append(1)
+        await asyncio.sleep(0)
+
+
+async def bench(name: str, uow: UnitOfWork):
+    store = EventStore(uow)
+    latencies: list[float] = []
+    errors: list[str] = []
+    reads: list[int] = []
+    stop = asyncio.Event()
+    readers = [asyncio.create_task(reader(store, stop, reads)) for _ in range(READERS)]
+
+    pre = time.perf_counter()
+    await asyncio.gather(*(writer(store, n, latencies, errors) for n in range(WRITERS)))
+    elapsed = time.perf_counter() - pre
+    stop.set()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    committed = WRITERS * TRANSACTIONS - len(errors)
+    p99 = statistics.quantiles(latencies, n=100)[98] * 1000
+    print(
+        f"{name:<24} {committed / elapsed:>8,.0f} tx/s  p99 {p99:>8.1f}ms  "
+        f"errors {len(errors):>4}  reads {len(reads) / elapsed:>8,.0f}/s"
+    )
+
+
+async def main():
+    profile = Settings.DB.SqliteProfile()
+    grouped = Settings.DB.SqliteProfile(GROUP_COMMIT=True)
+    # every commit is fsynced, which is what group commit amortizes
+    full = Settings.DB.SqliteProfile(SYNCHRONOUS="FULL")
+    full_grouped = Settings.DB.SqliteProfile(SYNCHRONOUS="FULL", GROUP_COMMIT=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, config, writes_through in (
+            ("default", None, False),
+            ("wal pragmas", profile, False),
+            ("single writer", profile, True),
+            ("single writer grouped", grouped, True),
+            ("full sync writer", full, True),
+            ("full sync grouped", full_grouped, True),
+        ):
+            url = f"sqlite+aiosqlite:///{tmp}/{name.replace(' ', '_')}.db"
+            db = make_db(url, config)
+            await create_tables(db)
+            if writes_through and config:
+                uow = UnitOfWork(
+                    db,
+                    replicas=SqliteReadPool(make_db(url, config, readers=True)),
+                    writer=SqliteWriter(db, group_commit=config.GROUP_COMMIT),
+                )
+            else:
+                uow = UnitOfWork(db)
+            await bench(name, uow)
+            await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+"""
+Jitter of streamed chunks while logins check passwords with bcrypt,
+on the event loop as before and on CPUExecutor
+
+python -m benchmarks.stream_jitter
+BENCH_LOGINS_PER_SECOND=8 BENCH_STREAMS=200 python -m benchmarks.stream_jitter
+"""
+
+import asyncio
+import os
+import time
+
+from askgpt.adapters.executor import CPUExecutor
+from askgpt.helpers.metrics import MetricsRegistry
+from askgpt.helpers.security import hash_password, verify_password
+
+SECONDS = float(os.environ.get("BENCH_SECONDS", 10))
+STREAMS = int(os.environ.get("BENCH_STREAMS", 50))
+LOGINS_PER_SECOND = float(os.environ.get("BENCH_LOGINS_PER_SECOND", 4))
+# a chunk every 20ms, about the pace of a streamed completion
+CHUNK_INTERVAL = 0.02
+PASSWORD = b"correct horse battery staple"
+
+
+async def stream(deadline: float) -> list[float]:
+    "delays of each chunk past its interval, in seconds"
+    delays: list[float] = []
+    while time.perf_counter() < deadline:
+        pre = time.perf_counter()
+        await asyncio.sleep(CHUNK_INTERVAL)
+        delays.append(time.perf_counter() - pre - CHUNK_INTERVAL)
+    return delays
+
+
+async def logins(executor: CPUExecutor | None, rate: float, deadline: float) -> int:
+    "checks a password `rate` times a second, returns the logins done"
+    if not rate:
+        return 0
+    hashed = hash_password(PASSWORD)
+    offloaded: list[asyncio.Future[bool]] = []
+    done = 0
+    while time.perf_counter() < deadline:
+        if executor is None:
+            verify_password(PASSWORD, hashed)
+            done += 1
+        else:
+            login = executor.run(verify_password, PASSWORD, hashed)
+            offloaded.append(asyncio.ensure_future(login))
+        await asyncio.sleep(1 / rate)
+    return done + len(await asyncio.gather(*offloaded))
+
+
+def ms(delays: list[float], q: int) -> float:
+    ranked = sorted(delays)
+    return ranked[min(len(ranked) - 1, len(ranked) * q // 100)] * 1000
+
+
+async def bench(name: str, executor: CPUExecutor | None, rate: float):
+    deadline = time.perf_counter() + SECONDS
+    login_task = asyncio.ensure_future(logins(executor, rate, deadline))
+    streams = await asyncio.gather(*(stream(deadline) for _ in range(STREAMS)))
+    done = await login_task
+    delays = [delay for chunks in streams for delay in chunks]
+    print(
+        f"{name:<20} chunk delay p50 {ms(delays, 50):>7.1f} ms"
+        f"  p99 {ms(delays, 99):>7.1f} ms  max {ms(delays, 100):>7.1f} ms"
+        f"  {done:>4} logins"
+    )
+
+
+async def main():
+    print(
+        f"{STREAMS} streams, a chunk every {CHUNK_INTERVAL * 1000:.0f} ms,"
+        f" {LOGINS_PER_SECOND:g} logins/s, {SECONDS:.0f}s each"
+    )
+    await bench("no logins", None, 0)
+    await bench("bcrypt on the loop", None, LOGINS_PER_SECOND)
+    executor = CPUExecutor(
+        max_workers=os.cpu_count() or 1, max_queue=64, registry=MetricsRegistry()
+    )
+    async with executor.lifespan():
+        await bench("bcrypt on executor", executor, LOGINS_PER_SECOND)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,20 @@
+class FakeClock:
+    "wall clock in seconds, moved by hand"
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class RecordingScript:
+    "a lua script that records its calls and always returns `result`"
+
+    def __init__(self, result: list[int | str]):
+        self.result = result
+        self.calls: list[tuple[list[str], list[str | float | int]]] = []
+
+    async def __call__(self, keys: list[str], args: list[str | float | int]):
+        self.calls.append((keys, args))
+        return self.result
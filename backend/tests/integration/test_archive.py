@@ -0,0 +1,67 @@
+import datetime
+
+import sqlalchemy as sa
+
+from askgpt.app.gpt._model import ChatMessage, ChatMessageSent
+from askgpt.helpers.sql import UnitOfWork
+from askgpt.helpers.time import utc_now
+from askgpt.infra.eventstore import EventStore
+from askgpt.infra.schema import DomainEventsTable, EventArchivesTable, SessionsTable
+from tests.conftest import dft
+
+
+async def count_hot(uow: UnitOfWork, entity_id: str) -> int:
+    stmt = sa.select(sa.func.count()).where(DomainEventsTable.entity_id == entity_id)
+    return (await uow.execute(stmt)).scalar_one()
+
+
+async def test_archive_idle_session_and_fault_in(uow: UnitOfWork):
+    eventstore = EventStore(uow, read_archive=True)
+    session_id, active_id = "idle_session", "active_session"
+    long_ago = utc_now() - datetime.timedelta(days=90)
+    idle = [
+        ChatMessageSent(
+            session_id=session_id,
+            chat_message=ChatMessage(role="user", content=f"hi {i}", gpt_type="openai"),
+            timestamp=long_ago + datetime.timedelta(seconds=i),
+        )
+        for i in range(3)
+    ]
+    active = ChatMessageSent(
+        session_id=active_id,
+        chat_message=ChatMessage(role="user", content="hello", gpt_type="openai"),
+    )
+    async with uow.trans():
+        await uow.execute(
+            sa.insert(SessionsTable),
+            parameters=[
+                dict(id=sid, user_id=dft.USER_ID, session_name="archive")
+                for sid in (session_id, active_id)
+            ],
+        )
+        await eventstore.add_all([*idle, active])
+
+    assert await eventstore.archive.archive_idle(30) == len(idle)
+    async with uow.trans(readonly=True):
+        assert await count_hot(uow, session_id) == 0
+        assert await count_hot(uow, active_id) == 1
+        # reads leave archived streams in place
+        assert await eventstore.get(session_id) == idle
+        assert [e async for e in eventstore.stream(session_id)] == idle
+        assert await count_hot(uow, session_id) == 0
+
+    async with uow.trans():
+        assert await eventstore.restore(session_id) == len(idle)
+        assert await count_hot(uow, session_id) == len(idle)
+        assert await eventstore.get(session_id) == idle
+        stub = (
+            await uow.execute(
+                sa.select(EventArchivesTable).where(
+                    EventArchivesTable.entity_id == session_id
+                )
+            )
+        ).one()
+        assert stub.events is None and stub.restored_at is not None
+
+    # faulted in streams stay hot until they are idle again
+    assert await eventstore.archive.archive_idle(30) == 0
@@ -1,6 +1,10 @@
 import pytest
 
-from askgpt.app.auth._errors import InvalidPasswordError, UserAlreadyExistError
+from askgpt.app.auth._errors import (
+    InvalidCredentialError,
+    InvalidPasswordError,
+    UserAlreadyExistError,
+)
 from askgpt.app.auth.service import AuthService
 from askgpt.app.user.service import UserService
 from tests.conftest import UserDefaults
@@ -55,3 +59,15 @@ async def test_get_user_and_login(
     assert user
     assert user.name == test_defaults.USER_NAME
     assert user.email == test_defaults.USER_EMAIL
+
+
+async def test_logout_revokes_tokens(
+    test_defaults: UserDefaults, auth_service: AuthService
+):
+    token = await auth_service.login(
+        test_defaults.USER_EMAIL, test_defaults.USER_PASSWORD
+    )
+    access_token = await auth_service.verify_access_token(token)
+    await auth_service.logout(access_token.sub)
+    with pytest.raises(InvalidCredentialError):
+        await auth_service.verify_access_token(token)
@@ -1,11 +1,39 @@
 import pytest
+import sqlalchemy as sa
 
-from askgpt.app.gpt._model import UserCreated
+from askgpt.app.auth._model import UserSignedUp
+from askgpt.app.gpt._model import ChatMessage, ChatMessageSent, UserCreated
 from askgpt.domain.config import Settings
-from askgpt.infra.eventstore import EventStore, dump_event, load_event
+from askgpt.domain.model.base import utc_now
+from askgpt.helpers.sql import UnitOfWork
+from askgpt.infra.blobstore import BlobBatch, BlobStore, content_hash, resolve_refs
+from askgpt.infra.bodycodec import BodyCodecs, rotate
+from askgpt.infra.eventstore import EventCodec, EventStore, dump_event, load_event
+from askgpt.infra.schema import (
+    ContentBlobsTable,
+    DomainEventsTable,
+    EventBodyCodecsTable,
+)
+from askgpt.infra.segmentstore import SegmentEventStore
+from tests._fakes import FakeClock
 from tests.conftest import dft
 
 
+@pytest.fixture(scope="module", params=["sql", "segment"])
+async def eventstore(
+    request: pytest.FixtureRequest,
+    uow: UnitOfWork,
+    tmp_path_factory: pytest.TempPathFactory,
+):
+    "tests taking `eventstore` run against both backends"
+    if request.param == "sql":
+        yield EventStore(uow)
+        return
+    store = SegmentEventStore(tmp_path_factory.mktemp("segments"))
+    yield store
+    await store.close()
+
+
 def test_settins(settings: Settings):
     assert isinstance(settings, Settings)
 
@@ -22,6 +50,27 @@ def test_dump_event_does_not_lose_timestamp(user_created: UserCreated):
     assert load_event(data).timestamp == user_created.timestamp
 
 
+@pytest.mark.parametrize("validate", [False, True])
+def test_codec_decodes_same_as_load_event(validate: bool):
+    codec = EventCodec(validate=validate)
+    events = [
+        ChatMessageSent(
+            session_id=dft.SESSION_ID,
+            chat_message=ChatMessage(role="user", content="ping", gpt_type="openai"),
+        ),
+        UserSignedUp(
+            user_id=dft.USER_ID, credential=dft.USER_INFO, last_login=utc_now()
+        ),
+    ]
+    rows = [dump_event(e) for e in events]
+    for row in rows:  # datetime columns come back naive from db
+        row["gmt_created"] = row["gmt_created"].replace(tzinfo=None)
+
+    decoded = codec.decode_rows(rows)
+    assert decoded == [load_event(row) for row in rows] == events
+    assert [hash(e) for e in decoded] == [hash(e) for e in events]
+
+
 async def test_insert_event(eventstore: EventStore, user_created: UserCreated):
     async with eventstore.uow.trans():
         await eventstore.add(user_created)
@@ -42,3 +91,161 @@ async def test_list_event(eventstore: EventStore, user_created: UserCreated):
         assert e.timestamp == user_created.timestamp
 
         assert hash(e) == hash(user_created)
+
+
+async def test_stream_events_in_batches(eventstore: EventStore):
+    entity_id = "stream_user"
+    created = [UserCreated(user_id=entity_id) for _ in range(5)]
+
+    async with eventstore.uow.trans():
+        await eventstore.add_all(created)
+        streamed = [e async for e in eventstore.stream(entity_id, batch_size=2)]
+        by_type = [
+            e
+            async for e in eventstore.stream_by_type(
+                entity_id, "user_created", batch_size=2
+            )
+        ]
+        all_events = [e async for e in eventstore.stream_all(batch_size=3)]
+
+    assert [e.event_id for e in streamed] == [e.event_id for e in created]
+    assert [e.event_id for e in by_type] == [e.event_id for e in created]
+    assert {e.event_id for e in created} <= {e.event_id for e in all_events}
+
+
+async def test_stream_stops_early(eventstore: EventStore):
+    async with eventstore.uow.trans():
+        async for e in eventstore.stream_all(batch_size=1):
+            break
+        events = await eventstore.list_all()
+    assert e.event_id in {e.event_id for e in events}
+
+
+async def test_compressed_bodies_read_with_plain_rows(uow: UnitOfWork):
+    session_id = "compressed_session"
+    messages = [
+        ChatMessageSent(
+            session_id=session_id,
+            chat_message=ChatMessage(
+                role="user", content=f"question number {i} about python", gpt_type="openai"
+            ),
+        )
+        for i in range(300)
+    ]
+    async with uow.trans():
+        await EventStore(uow).add_all(messages[:200])
+
+    codec_id = await rotate(uow, sample_size=200, dict_size=4096)
+    eventstore = EventStore(uow, codec=EventCodec(bodies=BodyCodecs()))
+    async with uow.trans():
+        await eventstore.add_all(messages[200:])
+        rows = (
+            await uow.execute(
+                sa.select(DomainEventsTable.body_codec).where(
+                    DomainEventsTable.entity_id == session_id
+                )
+            )
+        ).scalars()
+        assert sorted(rows, key=bool) == [None] * 200 + [codec_id] * 100
+        assert await eventstore.get(session_id) == messages
+
+
+async def test_dictionaries_activated_after_startup_are_picked_up(uow: UnitOfWork):
+    session_id = "rotated_session"
+    messages = [
+        ChatMessageSent(
+            session_id=session_id,
+            chat_message=ChatMessage(
+                role="user", content=f"question number {i} about sql", gpt_type="openai"
+            ),
+        )
+        for i in range(300)
+    ]
+    clock = FakeClock()
+    bodies = BodyCodecs(refresh_interval=60, clock=clock)
+    eventstore = EventStore(uow, codec=EventCodec(bodies=bodies))
+    async with uow.trans():
+        # no dictionary is active when the process starts
+        await uow.execute(sa.update(EventBodyCodecsTable).values(is_active=False))
+        await eventstore.add_all(messages[:200])
+
+    codec_id = await rotate(uow, sample_size=200, dict_size=4096)
+    async with uow.trans():
+        await eventstore.add_all(messages[200:250])
+    clock.now += 60
+    async with uow.trans():
+        await eventstore.add_all(messages[250:])
+        rows = (
+            await uow.execute(
+                sa.select(DomainEventsTable.body_codec).where(
+                    DomainEventsTable.entity_id == session_id
+                )
+            )
+        ).scalars()
+        assert sorted(rows, key=bool) == [None] * 250 + [codec_id] * 50
+        assert await eventstore.get(session_id) == messages
+
+
+async def test_large_strings_stored_once(uow: UnitOfWork):
+    prompt = "you are a helpful assistant. " * 50
+    messages = [
+        ChatMessageSent(
+            session_id=f"blob_session_{i}",
+            chat_message=ChatMessage(role="system", content=prompt, gpt_type="openai"),
+        )
+        for i in range(2)
+    ]
+    eventstore = EventStore(uow, blobs=BlobStore(threshold=100))
+    async with uow.trans():
+        await eventstore.add_all(messages)
+        blob = (
+            await uow.execute(
+                sa.select(ContentBlobsTable).where(
+                    ContentBlobsTable.hash == content_hash(prompt)
+                )
+            )
+        ).one()
+        assert blob.content == prompt
+
+        row = (
+            await uow.execute(
+                sa.select(DomainEventsTable).where(
+                    DomainEventsTable.entity_id == "blob_session_0"
+                )
+            )
+        ).one()
+        assert prompt not in row.event_body
+        assert await EventStore(uow).get("blob_session_0") == messages[:1]
+
+
+def test_user_dicts_shaped_like_refs_are_escaped():
+    prompt = "x" * 100
+    data = {
+        "options": {"$blob": "not a hash"},
+        "nested": [{"$escape": {"$blob": prompt}}],
+    }
+    stored = dict(data)
+    refs = BlobBatch(threshold=100).externalize(stored)
+    assert refs == [content_hash(prompt)]
+    assert stored["options"] == {"$escape": {"$blob": "not a hash"}}
+    assert resolve_refs(stored, {content_hash(prompt): prompt}) == data
+
+    only_escaped = {"options": {"$blob": "not a hash"}}
+    assert BlobBatch(threshold=100).externalize(only_escaped) == []
+
+
+async def test_blobs_of_rolled_back_writes_are_not_cached(uow: UnitOfWork):
+    prompt = "a document pasted and then discarded. " * 10
+    blobs = BlobStore(threshold=100)
+    eventstore = EventStore(uow, blobs=blobs)
+    event = ChatMessageSent(
+        session_id="rolled_back_blob",
+        chat_message=ChatMessage(role="user", content=prompt, gpt_type="openai"),
+    )
+    with pytest.raises(RuntimeError):
+        async with uow.trans():
+            await eventstore.add(event)
+            raise RuntimeError("rollback")
+
+    async with uow.trans(readonly=True):
+        assert await blobs.resolve(uow, [content_hash(prompt)]) == {}
@@ -53,13 +53,13 @@ async def test_list_created_session(
     assert session.user_id == user_session.user_id == user_id
     assert len(session.messages) == len(user_session.messages)
 
-    sessions = await session_service.list_sessions(user_id)
+    page = await session_service.list_sessions(user_id)
 
-    assert len(sessions) == 1
+    assert len(page.sessions) == 1
 
     _ = await session_service.create_session(user_id)
-    sessions = await session_service.list_sessions(user_id)
-    assert len(sessions) == 2
+    page = await session_service.list_sessions(user_id)
+    assert len(page.sessions) == 2
 
 
 async def test_gpt_send_message_without_api_key():
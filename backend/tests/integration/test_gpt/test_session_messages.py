@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+import sqlalchemy as sa
+
+from askgpt.app.gpt._errors import OrphanSessionError
+from askgpt.app.gpt._model import ChatMessage, ChatMessageSent, ChatResponseReceived
+from askgpt.app.gpt.service import SessionService
+from askgpt.infra.eventstore import EventStore
+from askgpt.infra.schema import SessionsTable
+
+
+def turn(session_id: str, i: int) -> list[ChatMessageSent]:
+    return [
+        ChatMessageSent(
+            session_id=session_id,
+            chat_message=ChatMessage.as_user(f"question {i}", "openai"),
+        ),
+        ChatResponseReceived(
+            session_id=session_id,
+            chat_message=ChatMessage.as_assistant(f"answer {i}", "openai"),
+        ),
+    ]
+
+
+async def unproject(event_store: EventStore, session_id: str) -> None:
+    "as a session created before the read table"
+    await event_store.uow.execute(
+        sa.update(SessionsTable)
+        .where(SessionsTable.id == session_id)
+        .values(message_seq=None)
+    )
+
+
+async def test_history_pages_and_deltas(
+    session_service: SessionService, event_store: EventStore
+):
+    user_id = "messages_user"
+    session = await session_service.create_session(user_id)
+    session_id = session.entity_id
+
+    # a session with history from before the read table
+    async with event_store.uow.trans():
+        await unproject(event_store, session_id)
+        await event_store.add_all(turn(session_id, 0) + turn(session_id, 1))
+
+    page, version = await session_service.list_messages(
+        user_id, session_id, before=None, limit=3
+    )
+    assert version == 4
+    assert [m.seq for m in page] == [2, 3, 4]
+    assert page[-1].chat_message.content == "answer 1"
+
+    older, _ = await session_service.list_messages(
+        user_id, session_id, before=page[0].seq, limit=3
+    )
+    assert [m.chat_message.content for m in older] == ["question 0"]
+
+    async with event_store.uow.trans():
+        events = turn(session_id, 2)
+        await session_service.record_messages(session_id, events)
+        await event_store.add_all(events)
+
+    delta, version = await session_service.messages_since(
+        user_id, session_id, after_version=4, limit=10
+    )
+    assert version == 6
+    assert [m.chat_message.content for m in delta] == ["question 2", "answer 2"]
+
+    delta, _ = await session_service.messages_since(
+        user_id, session_id, after_version=6, limit=10
+    )
+    assert delta == []
+
+    with pytest.raises(OrphanSessionError):
+        await session_service.messages_since(
+            "other_user", session_id, after_version=0, limit=10
+        )
+
+
+async def test_empty_session_is_projected_once(
+    session_service: SessionService, event_store: EventStore
+):
+    user_id = "projected_user"
+    session = await session_service.create_session(user_id)
+    session_id = session.entity_id
+    async with event_store.uow.trans():
+        await unproject(event_store, session_id)
+
+    page, version = await session_service.list_messages(
+        user_id, session_id, before=None, limit=10
+    )
+    assert (page, version) == ([], 0)
+
+    async with event_store.uow.trans(readonly=True):
+        stmt = sa.select(SessionsTable.message_seq).where(SessionsTable.id == session_id)
+        assert (await event_store.uow.execute(stmt)).scalar() == 0
+
+
+async def test_concurrent_writers_get_distinct_seqs(
+    session_service: SessionService, event_store: EventStore
+):
+    user_id = "seq_user"
+    session = await session_service.create_session(user_id)
+    session_id = session.entity_id
+
+    async def record(i: int):
+        async with event_store.uow.trans():
+            await session_service.record_messages(session_id, turn(session_id, i))
+
+    await asyncio.gather(*(record(i) for i in range(5)))
+    page, version = await session_service.list_messages(
+        user_id, session_id, before=None, limit=20
+    )
+    assert version == 10
+    assert [m.seq for m in page] == list(range(1, 11))
@@ -1,5 +1,9 @@
+import pytest
+
+from askgpt.app.gpt._errors import InvalidCursorError
 from askgpt.app.gpt._model import ChatSession
 from askgpt.app.gpt._repository import SessionRepository
+from askgpt.app.gpt.service import SessionService
 from askgpt.helpers.sql import UnitOfWork
 from tests.conftest import UserDefaults
 
@@ -20,4 +24,32 @@ async def test_create_and_list_sessions(
 
     assert sessions
     assert sessions[0].session_name == test_defaults.SESSION_NAME
-    assert sessions[0].entity_id == test_defaults.SESSION_ID
+    assert sessions[0].session_id == test_defaults.SESSION_ID
+
+
+async def test_list_sessions_by_last_activity(
+    session_service: SessionService, session_repo: SessionRepository
+):
+    user_id = "keyset_user"
+    created = [await session_service.create_session(user_id) for _ in range(5)]
+    async with session_repo.uow.trans():
+        await session_repo.touch(created[1].entity_id)
+
+    page = await session_service.list_sessions(user_id, limit=2, with_count=True)
+    assert page.total == 5
+    assert [s.session_id for s in page.sessions] == [
+        created[1].entity_id,
+        created[4].entity_id,
+    ]
+
+    seen = [s.session_id for s in page.sessions]
+    while page.next_cursor:
+        page = await session_service.list_sessions(
+            user_id, cursor=page.next_cursor, limit=2
+        )
+        assert page.total is None
+        seen.extend(s.session_id for s in page.sessions)
+    assert seen == [created[i].entity_id for i in (1, 4, 3, 2, 0)]
+
+    with pytest.raises(InvalidCursorError):
+        await session_service.list_sessions(user_id, cursor="not a cursor")
@@ -0,0 +1,133 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from askgpt.app.gpt._model import UserCreated
+from askgpt.infra.segmentstore import CorruptRecordError, SegmentEventStore
+
+
+async def test_roll_compact_and_reopen(tmp_path: Path):
+    store = SegmentEventStore(tmp_path, segment_size=512, fsync="always")
+    kept = [UserCreated(user_id="kept") for _ in range(20)]
+    removed = [UserCreated(user_id="removed") for _ in range(20)]
+    for pair in zip(kept, removed):
+        await store.add_all(list(pair))
+    await store.remove("removed")
+    assert len(list(tmp_path.glob("*.seg"))) > 2
+
+    assert await store.compact() > 0
+    assert await store.get("kept") == kept
+    assert await store.get("removed") == []
+    await store.close()
+
+    # a torn write at the tail is dropped on open
+    active = max(tmp_path.glob("*.seg"))
+    with active.open("ab") as f:
+        f.write(b"\x10\x00\x00\x00garbage")
+
+    reopened = SegmentEventStore(tmp_path)
+    assert await reopened.get("kept") == kept
+    assert await reopened.get("removed") == []
+    await reopened.add(extra := UserCreated(user_id="kept"))
+    assert await reopened.get("kept") == [*kept, extra]
+    await reopened.close()
+
+
+async def test_writes_during_compaction_are_kept(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    store = SegmentEventStore(tmp_path, segment_size=512, fsync="never")
+    kept = [UserCreated(user_id="kept") for _ in range(20)]
+    removed = [UserCreated(user_id="removed") for _ in range(5)]
+    await store.add_all(removed)
+    for event in kept:
+        await store.add(event)
+
+    # hold the fsync of the compacted segment until the writes below are done
+    to_thread, fsynced = asyncio.to_thread, asyncio.Event()
+
+    async def held_fsync(func, *args):
+        monkeypatch.setattr(asyncio, "to_thread", to_thread)
+        await fsynced.wait()
+        return await to_thread(func, *args)
+
+    monkeypatch.setattr(asyncio, "to_thread", held_fsync)
+    compaction = asyncio.create_task(store.compact())
+    await asyncio.sleep(0)
+    # rolls seal new segments while the compacted one is written
+    later = [UserCreated(user_id="kept") for _ in range(20)]
+    for event in later:
+        await store.add(event)
+    await store.remove("removed")
+    fsynced.set()
+    await compaction
+
+    assert await store.get("kept") == [*kept, *later]
+    assert await store.get("removed") == []
+    # segments sealed meanwhile are compacted by the next run
+    await store.compact()
+    assert len(list(tmp_path.glob("*.seg"))) == 2
+    assert await store.get("kept") == [*kept, *later]
+    await store.close()
+
+    reopened = SegmentEventStore(tmp_path)
+    assert await reopened.get("kept") == [*kept, *later]
+    assert await reopened.get("removed") == []
+    await reopened.close()
+
+
+async def test_compaction_waits_for_open_streams(tmp_path: Path):
+    store = SegmentEventStore(tmp_path, segment_size=512, fsync="never")
+    kept = [UserCreated(user_id="kept") for _ in range(20)]
+    removed = [UserCreated(user_id="removed") for _ in range(20)]
+    for pair in zip(kept, removed):
+        await store.add_all(list(pair))
+    await store.remove("removed")
+
+    stream = store.stream("kept", batch_size=5)
+    streamed = [await anext(stream)]
+    compaction = asyncio.create_task(store.compact())
+    await asyncio.sleep(0.05)
+    # the segments the stream reads from are not replaced under it
+    assert not compaction.done()
+    streamed.extend([event async for event in stream])
+    assert streamed == kept
+
+    assert await compaction > 0
+    assert await store.get("kept") == kept
+    await store.close()
+
+
+async def test_failed_transaction_leaves_no_events(tmp_path: Path):
+    store = SegmentEventStore(tmp_path, fsync="always")
+    committed = UserCreated(user_id="user")
+    async with store.uow.trans():
+        await store.add(committed)
+
+    with pytest.raises(ValueError):
+        async with store.uow.trans():
+            await store.add(failed := UserCreated(user_id="user"))
+            # read back within the transaction
+            assert await store.get("user") == [committed, failed]
+            raise ValueError
+    assert await store.get("user") == [committed]
+    await store.close()
+
+    reopened = SegmentEventStore(tmp_path)
+    assert await reopened.get("user") == [committed]
+    await reopened.close()
+
+
+async def test_reads_check_the_crc(tmp_path: Path):
+    store = SegmentEventStore(tmp_path, fsync="always")
+    await store.add(UserCreated(user_id="user"))
+    segment = next(tmp_path.glob("*.seg"))
+    data = bytearray(segment.read_bytes())
+    # flip a byte of the payload, e.g. a record overwritten in place
+    data[-2] ^= 0xFF
+    segment.write_bytes(data)
+
+    with pytest.raises(CorruptRecordError):
+        await store.get("user")
+    await store.close()
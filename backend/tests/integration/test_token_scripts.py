@@ -0,0 +1,281 @@
+"""
+token bucket scripts against a real redis, time is passed to the scripts by a fake clock.
+runs when TEST_REDIS_URL points to a disposable redis, e.g. TEST_REDIS_URL=redis://localhost:6379/15
+"""
+
+import os
+import time
+
+import pytest
+import pytest_asyncio
+
+from askgpt.adapters.admission import AdmissionController, Limit, Violation
+from askgpt.adapters.cache import RedisCache
+from askgpt.adapters.semaphore import DistributedSemaphore
+from askgpt.adapters.tokenbucket import GCRALimiter, TokenBucketFactory, TokenLeaser
+from askgpt.domain.config import Settings
+from askgpt.helpers.string import KeySpace
+from tests._fakes import FakeClock
+
+pytestmark = [
+    pytest.mark.skipif(
+        not os.environ.get("TEST_REDIS_URL"), reason="TEST_REDIS_URL not set"
+    ),
+    # the connections of the redis fixture belong to the loop they were opened in
+    pytest.mark.asyncio(loop_scope="module"),
+]
+
+NOW = 1_760_000_000.0
+
+
+@pytest_asyncio.fixture(loop_scope="module")
+async def redis():
+    cache = RedisCache[str].build(
+        url=os.environ["TEST_REDIS_URL"],
+        keyspace="test_token_scripts",
+        decode_responses=True,
+        max_connections=2,
+        socket_timeout=2,
+        socket_connect_timeout=2,
+    )
+    async with cache.lifespan():
+        yield cache
+        await cache.client.flushdb()
+
+
+async def test_refill_is_sub_second(redis: RedisCache[str], settings: Settings):
+    clock = FakeClock(NOW)
+    factory = TokenBucketFactory(
+        redis, redis.load_script(settings.redis.TOKEN_BUCKET_SCRIPT), clock=clock
+    )
+    bucket = factory.create_bucket("user", max_tokens=2, refill_rate_s=10)
+
+    assert await bucket.acquire() == 0
+    assert await bucket.acquire() == 0
+    assert await bucket.acquire() == pytest.approx(0.1)
+
+    clock.now += 0.05
+    assert await bucket.acquire() == pytest.approx(0.05, abs=1e-5)
+    clock.now += 0.06
+    assert await bucket.acquire() == 0
+
+
+async def test_reserve_token_leaves_the_bucket_in_debt(
+    redis: RedisCache[str], settings: Settings
+):
+    clock = FakeClock(NOW)
+    factory = TokenBucketFactory(
+        redis, redis.load_script(settings.redis.TOKEN_BUCKET_SCRIPT), clock=clock
+    )
+    bucket = factory.create_bucket("user", max_tokens=1, refill_rate_s=10)
+
+    assert await bucket.reserve_token(max_wait=0.15) == 0
+    assert await bucket.reserve_token(max_wait=0.15) == pytest.approx(0.1)
+    # 0.2 seconds behind the reserved one, nothing is taken
+    assert await bucket.reserve_token(max_wait=0.15) == pytest.approx(0.2)
+    assert await bucket.acquire() == pytest.approx(0.2)
+
+
+async def test_bucket_expires_once_full(redis: RedisCache[str], settings: Settings):
+    clock = FakeClock(NOW)
+    factory = TokenBucketFactory(
+        redis, redis.load_script(settings.redis.TOKEN_BUCKET_SCRIPT), clock=clock
+    )
+    bucket = factory.create_bucket("user", max_tokens=10, refill_rate_s=4)
+
+    assert await bucket.acquire(3) == 0
+    # 3 tokens at 4 per second
+    assert 0 < await redis.client.pttl("user") <= 750
+
+
+async def test_lease_survives_script_flush(redis: RedisCache[str], settings: Settings):
+    clock = FakeClock(NOW)
+    config = settings.redis
+    leaser = TokenLeaser(
+        redis,
+        redis.load_script(config.TOKEN_LEASE_SCRIPT),
+        redis.load_script(config.TOKEN_GIVE_BACK_SCRIPT),
+        clock=clock,
+    )
+    await leaser.preload()
+    lease = dict(max_tokens=10, refill_rate_s=1)
+
+    assert await leaser.lease("user", **lease, want=8, least=1) == (8, 0)
+    await redis.client.script_flush()
+    assert await leaser.lease("user", **lease, want=8, least=4) == (0, 2)
+
+    await leaser.give_back("user", max_tokens=10, tokens=3)
+    assert await leaser.lease("user", **lease, want=8, least=4) == (5, 0)
+
+
+async def test_gcra_matches_the_token_bucket(redis: RedisCache[str], settings: Settings):
+    clock = FakeClock(NOW)
+    config = settings.redis
+    factory = TokenBucketFactory(
+        redis, redis.load_script(config.TOKEN_BUCKET_SCRIPT), clock=clock
+    )
+    bucket = factory.create_bucket("bucket", max_tokens=3, refill_rate_s=10)
+    gcra = GCRALimiter(
+        redis,
+        redis.load_script(config.GCRA_SCRIPT),
+        max_tokens=3,
+        refill_rate_s=10,
+        clock=clock,
+    )
+
+    for step in [0, 0, 0, 0, 0.03, 0.05, 0, 0.2, 0, 0, 0]:
+        clock.now += step
+        assert await gcra.acquire("gcra") == pytest.approx(
+            await bucket.acquire(), abs=1e-5
+        )
+
+    assert await redis.client.type("gcra") == "string"
+    # 2.2 tokens at 10 per second to refill
+    assert 0 < await redis.client.pttl("gcra") <= 220
+
+
+async def test_admission_charges_all_limits_or_none(
+    redis: RedisCache[str], settings: Settings
+):
+    clock = FakeClock(NOW)
+    limits = [
+        Limit("user_rpm", KeySpace("user_rpm"), 5, 1),
+        Limit("model_rpm", KeySpace("model_rpm"), 2, 1),
+    ]
+    controller = AdmissionController(
+        redis.load_script(settings.redis.ADMISSION_SCRIPT),
+        redis.load_script(settings.redis.ADMISSION_ADJUST_SCRIPT),
+        limits,
+        clock=clock,
+    )
+
+    assert await controller.admit(["a", "gpt"], [1, 1]) == (None, 0)
+    assert await controller.admit(["b", "gpt"], [1, 1]) == (None, 0)
+    violation, _ = await controller.admit(["a", "gpt"], [1, 1])
+    assert violation == Violation("model_rpm", pytest.approx(1))
+    # the user was not charged for the rejected request
+    assert await redis.client.get("user_rpm:a") == f"{NOW + 1:.6f}"
+
+    # a cost above the limit passes a full bucket
+    assert await controller.admit(["c", "other"], [10, 1]) == (None, 0)
+    violation, _ = await controller.admit(["c", "other"], [1, 1])
+    assert violation == Violation("user_rpm", pytest.approx(6))
+
+
+async def test_admission_reserves_short_waits(
+    redis: RedisCache[str], settings: Settings
+):
+    clock = FakeClock(NOW)
+    controller = AdmissionController(
+        redis.load_script(settings.redis.ADMISSION_SCRIPT),
+        redis.load_script(settings.redis.ADMISSION_ADJUST_SCRIPT),
+        [Limit("user_rpm", KeySpace("user_rpm"), 1, 10)],
+        clock=clock,
+    )
+
+    assert await controller.admit(["a"], [1], max_wait=0.25) == (None, 0)
+    violation, wait_time = await controller.admit(["a"], [1], max_wait=0.25)
+    assert violation is None and wait_time == pytest.approx(0.1)
+    violation, wait_time = await controller.admit(["a"], [1], max_wait=0.25)
+    assert violation is None and wait_time == pytest.approx(0.2)
+    # 0.3 seconds behind the reservations
+    violation, _ = await controller.admit(["a"], [1], max_wait=0.25)
+    assert violation == Violation("user_rpm", pytest.approx(0.3))
+
+
+async def test_admission_rejects_revoked_tokens(
+    redis: RedisCache[str], settings: Settings
+):
+    controller = AdmissionController(
+        redis.load_script(settings.redis.ADMISSION_SCRIPT),
+        redis.load_script(settings.redis.ADMISSION_ADJUST_SCRIPT),
+        [Limit("user_rpm", KeySpace("user_rpm"), 5, 1)],
+    )
+    await redis.zadd("tokens:a", {"jwt": time.time() + 60, "expired": time.time() - 1})
+
+    violation, _ = await controller.admit(
+        ["a"], [1], token_key="tokens:a", token="jwt"
+    )
+    assert violation is None
+    violation, _ = await controller.admit(
+        ["a"], [1], token_key="tokens:a", token="old"
+    )
+    assert violation and violation.limit == "token_revoked"
+    violation, _ = await controller.admit(
+        ["a"], [1], token_key="tokens:a", token="expired"
+    )
+    assert violation and violation.limit == "token_revoked"
+
+
+async def test_unused_tokens_are_given_back(redis: RedisCache[str], settings: Settings):
+    clock = FakeClock(NOW)
+    controller = AdmissionController(
+        redis.load_script(settings.redis.ADMISSION_SCRIPT),
+        redis.load_script(settings.redis.ADMISSION_ADJUST_SCRIPT),
+        [Limit("user_tpm", KeySpace("user_tpm"), 1000, 10)],
+        clock=clock,
+    )
+
+    assert await controller.admit(["a"], [800]) == (None, 0)
+    violation, _ = await controller.admit(["a"], [800])
+    assert violation == Violation("user_tpm", pytest.approx(60))
+
+    # the completion used 200 of the 800 reserved
+    await controller.adjust(["a"], [-600])
+    assert await controller.admit(["a"], [800]) == (None, 0)
+
+    # never more than full
+    await controller.adjust(["a"], [-5000])
+    assert await redis.client.get("user_tpm:a") is None
+
+
+async def test_semaphore_reclaims_expired_leases(
+    redis: RedisCache[str], settings: Settings
+):
+    clock = FakeClock(NOW)
+
+    def semaphore() -> DistributedSemaphore:
+        return DistributedSemaphore(
+            redis,
+            redis.load_script(settings.redis.SEMAPHORE_SCRIPT),
+            redis.load_script(settings.redis.SEMAPHORE_RENEW_SCRIPT),
+            keyspace=KeySpace("streams"),
+            lease_ttl=30,
+            clock=clock,
+        )
+
+    crashed, alive = semaphore(), semaphore()
+    assert await crashed.acquire("user", 2)
+    lease_id = await alive.acquire("user", 2)
+    assert lease_id and await alive.acquire("user", 2) is None
+
+    clock.now += 20
+    assert await alive.renew() == 1
+    clock.now += 20
+    # the lease of the crashed worker expired, the renewed one did not
+    assert await alive.acquire("user", 2)
+    assert await alive.acquire("user", 2) is None
+
+    await alive.release("user", lease_id)
+    assert await alive.acquire("user", 2)
+
+
+async def test_lockouts_are_set_from_now(redis: RedisCache[str], settings: Settings):
+    clock = FakeClock(NOW)
+    controller = AdmissionController(
+        redis.load_script(settings.redis.ADMISSION_SCRIPT),
+        redis.load_script(settings.redis.ADMISSION_ADJUST_SCRIPT),
+        [Limit("auth_email", KeySpace("auth_email"), 10, 1)],
+        clock=clock,
+    )
+
+    # a full bucket plus 30 seconds, twice, owes 30 seconds rather than 70
+    await controller.adjust(["a"], [40], from_now=True)
+    await controller.adjust(["a"], [40], from_now=True)
+    violation, _ = await controller.admit(["a"], [1])
+    assert violation == Violation("auth_email", pytest.approx(31))
+
+    # a longer lockout replaces the shorter one
+    await controller.adjust(["a"], [70], from_now=True)
+    violation, _ = await controller.admit(["a"], [1])
+    assert violation == Violation("auth_email", pytest.approx(61))
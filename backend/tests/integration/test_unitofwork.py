@@ -0,0 +1,233 @@
+import asyncio
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext import asyncio as sa_aio
+
+from askgpt.adapters.database import (
+    AsyncDatabase,
+    ReplicaSet,
+    SqliteReadPool,
+    SqliteWriter,
+)
+from askgpt.domain.config import Settings
+from askgpt.helpers.metrics import metrics
+from askgpt.helpers.sql import ReadOnlyTransactionError, UnitOfWork
+from askgpt.infra.factory import apply_sqlite_profile, sqlite_pool_options
+from askgpt.infra.schema import SessionsTable, create_tables
+
+
+class LocalFence:
+    def __init__(self):
+        self.writes: dict[str, float] = {}
+
+    async def last_write(self, key: str) -> float | None:
+        return self.writes.get(key)
+
+    async def record(self, key: str, at: float) -> None:
+        self.writes[key] = at
+
+
+async def count_sessions(uow: UnitOfWork, session_id: str) -> int:
+    stmt = sa.select(sa.func.count()).where(SessionsTable.id == session_id)
+    return (await uow.execute(stmt)).scalar_one()
+
+
+async def test_scope_shares_connection_and_nests_savepoints(uow: UnitOfWork):
+    session_id = "uow_scope_session"
+    insert = sa.insert(SessionsTable).values(
+        id=session_id, user_id="uow_user", session_name="scope"
+    )
+    async with uow.scope() as stats:
+        async with uow.trans(readonly=True):
+            connection = uow.conn
+            assert await count_sessions(uow, session_id) == 0
+
+        async with uow.trans():
+            assert uow.conn is connection
+            with pytest.raises(ValueError):
+                async with uow.trans():
+                    await uow.execute(insert)
+                    raise ValueError
+            assert await count_sessions(uow, session_id) == 0
+
+    assert (stats.checkouts, stats.transactions, stats.savepoints) == (1, 2, 1)
+    assert uow.stats is stats
+
+
+async def test_readonly_trans_rejects_writes(uow: UnitOfWork):
+    insert = sa.insert(SessionsTable).values(
+        id="uow_readonly_session", user_id="uow_user", session_name="readonly"
+    )
+    async with uow.scope():
+        with pytest.raises(sa.exc.OperationalError):
+            async with uow.trans(readonly=True):
+                await uow.execute(insert)
+
+        async with uow.trans():
+            await uow.execute(insert)
+            assert await count_sessions(uow, "uow_readonly_session") == 1
+
+        with pytest.raises(ReadOnlyTransactionError):
+            async with uow.trans(readonly=True):
+                async with uow.trans():
+                    pass
+
+
+async def test_readonly_trans_reads_replica_until_own_write(aiodb: AsyncDatabase):
+    replica_db = AsyncDatabase(sa_aio.create_async_engine("sqlite+aiosqlite:///:memory:"))
+    await create_tables(replica_db)
+    replicas = ReplicaSet([replica_db])
+    await replicas.probe()
+    fence = LocalFence()
+    uow = UnitOfWork(aiodb, replicas=replicas, fence=fence)
+    session_id = "uow_replica_session"
+    insert = sa.insert(SessionsTable).values(
+        id=session_id, user_id="uow_user", session_name="replica"
+    )
+
+    async with uow.scope() as stats:
+        uow.track("writer")
+        async with uow.trans(readonly=True):
+            assert await count_sessions(uow, session_id) == 0
+        async with uow.trans():
+            await uow.execute(insert)
+        # the replica hasn't replayed the write yet
+        async with uow.trans(readonly=True):
+            assert await count_sessions(uow, session_id) == 1
+    assert stats.replica_reads == 1
+
+    async with uow.scope():
+        uow.track("writer")
+        async with uow.trans(readonly=True):
+            assert await count_sessions(uow, session_id) == 1
+
+    async with uow.scope():
+        uow.track("reader")
+        async with uow.trans(readonly=True):
+            assert await count_sessions(uow, session_id) == 0
+
+    # a transaction that only read doesn't pin the user to the primary
+    async with uow.scope() as stats:
+        uow.track("lookup")
+        async with uow.trans():
+            assert await count_sessions(uow, session_id) == 1
+        async with uow.trans(readonly=True):
+            assert await count_sessions(uow, session_id) == 0
+    assert stats.replica_reads == 1
+    assert "lookup" not in fence.writes
+
+    await replicas.close()
+
+
+async def test_pool_metrics_report_saturation(tmp_path):
+    engine = sa_aio.create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path}/pool.db",
+        poolclass=sa.AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.05,
+    )
+    db = AsyncDatabase(engine, name="test_saturated")
+    connection = await db.acquire()
+    with pytest.raises(sa.exc.TimeoutError):
+        await db.acquire()
+    snapshot = metrics.snapshot()
+    await connection.close()
+    await db.close()
+
+    prefix = "db.test_saturated.pool"
+    assert snapshot[f"{prefix}.checked_out"] == 1
+    assert snapshot[f"{prefix}.checkouts"] == 1
+    assert snapshot[f"{prefix}.timeouts"] == 1
+    assert snapshot[f"{prefix}.checkout_wait_seconds"]["count"] == 2
+    assert metrics.snapshot()[f"{prefix}.connection_lifetime_seconds"]["count"] == 1
+
+
+async def test_sqlite_single_writer_group_commit(tmp_path):
+    profile = Settings.DB.SqliteProfile(GROUP_COMMIT=True)
+    url = f"sqlite+aiosqlite:///{tmp_path}/wal.db"
+
+    def make_db(readers: bool) -> AsyncDatabase:
+        engine = sa_aio.create_async_engine(
+            url, **sqlite_pool_options(profile, readers=readers)
+        )
+        apply_sqlite_profile(engine.sync_engine, profile)
+        return AsyncDatabase(engine)
+
+    writer_db = make_db(readers=False)
+    await create_tables(writer_db)
+    writer = SqliteWriter(writer_db, group_commit=True)
+    uow = UnitOfWork(writer_db, replicas=SqliteReadPool(make_db(readers=True)), writer=writer)
+
+    async def write(i: int):
+        async with uow.trans():
+            await uow.execute(
+                sa.insert(SessionsTable).values(
+                    id=f"wal_{i}", user_id="uow_user", session_name="wal"
+                )
+            )
+            if i == 3:
+                raise ValueError
+
+    results = await asyncio.gather(*(write(i) for i in range(10)), return_exceptions=True)
+    assert [i for i, r in enumerate(results) if isinstance(r, ValueError)] == [3]
+
+    async with uow.trans(readonly=True):
+        mode = (await uow.execute("PRAGMA journal_mode")).scalar_one()
+        written = await uow.execute(
+            sa.select(SessionsTable.id).where(SessionsTable.id.like("wal_%"))
+        )
+        assert mode == "wal"
+        assert sorted(written.scalars()) == sorted(f"wal_{i}" for i in range(10) if i != 3)
+
+
+async def test_sqlite_writer_cancelled_waiter_commits_the_batch(tmp_path):
+    profile = Settings.DB.SqliteProfile(GROUP_COMMIT=True)
+    engine = sa_aio.create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path}/wal.db",
+        **sqlite_pool_options(profile, readers=False),
+    )
+    apply_sqlite_profile(engine.sync_engine, profile)
+    db = AsyncDatabase(engine)
+    await create_tables(db)
+    writer = SqliteWriter(db, group_commit=True)
+    entered, proceed = asyncio.Event(), asyncio.Event()
+
+    async def first():
+        async with writer.transaction() as connection:
+            await connection.execute(
+                sa.insert(SessionsTable).values(
+                    id="batched", user_id="uow_user", session_name="wal"
+                )
+            )
+            entered.set()
+            await proceed.wait()
+
+    async def waiter():
+        async with writer.transaction():
+            pass
+
+    writing = asyncio.create_task(first())
+    await entered.wait()
+    waiting = asyncio.create_task(waiter())
+    await asyncio.sleep(0)
+    assert writer.waiting == 1
+
+    # first leaves its commit to the waiter, which is cancelled before taking the lock
+    release = writer._lock.release
+
+    def handoff():
+        release()
+        waiting.cancel()
+
+    writer._lock.release = handoff  # type: ignore
+    proceed.set()
+
+    await asyncio.wait_for(writing, timeout=1)
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    async with db.begin() as connection:
+        stmt = sa.select(sa.func.count()).where(SessionsTable.id == "batched")
+        assert (await connection.execute(stmt)).scalar_one() == 1
+    await db.close()
@@ -1,12 +1,20 @@
 import datetime
+import time
+import types
 
 import pytest
 
-from askgpt.app.auth._model import AccessToken
+from askgpt.adapters.cache import MemoryCache
+from askgpt.app.auth._errors import PermissionDeniedError
+from askgpt.app.auth._model import AccessToken, UserRoles
+from askgpt.app.auth.api import require_admin
+from askgpt.app.auth.service import TokenRegistry, VerifiedTokenCache
 from askgpt.domain.config import Settings
 from askgpt.domain.model.base import utc_now
 from askgpt.infra import security
+from askgpt.helpers.string import KeySpace
 from tests.conftest import UserDefaults
+from tests._fakes import FakeClock
 
 
 @pytest.fixture(scope="module")
@@ -35,3 +43,99 @@ def test_encryp_access_token(
     decoded = AccessToken.model_validate(data)
     assert decoded.sub == test_defaults.USER_ID
     assert decoded.role == test_defaults.USER_ROLE
+
+
+def access_token(user_id: str, minutes: float = 30) -> AccessToken:
+    now_ = utc_now()
+    return AccessToken(
+        sub=user_id,
+        role=UserRoles.user,
+        exp=now_ + datetime.timedelta(minutes=minutes),
+        nbf=now_,
+        iat=now_,
+    )
+
+
+async def test_verified_tokens_are_kept_until_revoked():
+    clock = FakeClock(time.time())
+    verified = VerifiedTokenCache(max_size=2, max_age=60, clock=clock)
+    registry = TokenRegistry(MemoryCache(), KeySpace("tokens"), verified=verified)
+    alice, bob = access_token("alice"), access_token("bob")
+    verified.set("jwt-a", alice)
+    verified.set("jwt-b", bob)
+    assert verified.get("jwt-a") is alice
+
+    # the least recently used token is evicted
+    verified.set("jwt-c", access_token("carol"))
+    assert verified.get("jwt-b") is None
+
+    await registry.revoke_tokens("alice")
+    assert verified.get("jwt-a") is None
+    assert len(verified) == 1
+
+    clock.now += 60
+    assert verified.get("jwt-c") is None
+
+
+def test_verified_tokens_expire_with_the_token():
+    clock = FakeClock(time.time())
+    verified = VerifiedTokenCache(max_age=3600, clock=clock)
+    verified.set("jwt", access_token("alice", minutes=1))
+    clock.now += 61
+    assert verified.get("jwt") is None
+
+
+async def test_revocations_reach_every_process():
+    clock = FakeClock(time.time())
+    cache = MemoryCache()
+    registries = [
+        TokenRegistry(cache, KeySpace("tokens"), verified=VerifiedTokenCache(), clock=clock)
+        for _ in range(2)
+    ]
+    before = access_token("alice")
+    clock.now = before.iat.timestamp() + 1
+    await registries[0].revoke_tokens("alice")
+
+    assert await registries[1].is_revoked(before)
+    clock.now += 1
+    after = AccessToken(
+        sub="alice",
+        role=UserRoles.user,
+        exp=before.exp,
+        nbf=before.nbf,
+        iat=datetime.datetime.fromtimestamp(clock.now, datetime.UTC),
+    )
+    assert not await registries[1].is_revoked(after)
+    assert not await registries[1].is_revoked(access_token("bob"))
+
+
+async def test_registered_tokens_expire_and_are_pruned():
+    clock = FakeClock(time.time())
+    cache = MemoryCache()
+    registry = TokenRegistry(cache, KeySpace("tokens"), token_ttl=60, clock=clock)
+    await registry.register_token("alice", "jwt-a")
+    assert await registry.is_token_valid("alice", "jwt-a")
+
+    clock.now += 61
+    assert not await registry.is_token_valid("alice", "jwt-a")
+    await registry.register_token("alice", "jwt-b")
+    key = registry.token_key_by("alice")
+    assert await cache.zscore(key, "jwt-a") is None
+    assert await registry.is_token_valid("alice", "jwt-b")
+
+
+async def test_tokens_are_not_registered_unless_checked():
+    cache = MemoryCache()
+    registry = TokenRegistry(cache, KeySpace("tokens"), checked=False)
+    await registry.register_token("alice", "jwt-a")
+    assert await cache.zscore(registry.token_key_by("alice"), "jwt-a") is None
+
+
+def test_require_admin_rejects_user_tokens():
+    request = types.SimpleNamespace(url=types.SimpleNamespace(path="/health/metrics"))
+    token = access_token("user")
+    with pytest.raises(PermissionDeniedError):
+        require_admin(request, token)  # type: ignore
+
+    admin = token.model_copy(update={"role": UserRoles.admin})
+    assert require_admin(request, admin) is admin  # type: ignore
@@ -0,0 +1,120 @@
+from contextlib import asynccontextmanager
+
+from askgpt.adapters.admission import AdmissionController, Limit
+from askgpt.api.middleware import PreAuthMiddleware
+from askgpt.api.throttler import AuthAttemptLimiter
+from askgpt.api.xheaders import XHeaders
+from askgpt.helpers.string import KeySpace
+from tests._fakes import RecordingScript
+
+
+class Counters:
+    "incr and pexpire of a redis pipeline"
+
+    def __init__(self):
+        self.counts: dict[str, int] = {}
+        self.results: list[int] = []
+
+    def incr(self, key: str):
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.results.append(self.counts[key])
+
+    def pexpire(self, key: str, ms: int):
+        self.results.append(1)
+
+    async def execute(self) -> list[int]:
+        results, self.results = self.results, []
+        return results
+
+
+class CounterRedis:
+    def __init__(self):
+        self.counters = Counters()
+
+    @asynccontextmanager
+    async def pipeline(self):
+        yield self.counters
+
+
+def make_limiter(
+    admit: RecordingScript, adjust: RecordingScript, **kwargs
+) -> AuthAttemptLimiter:
+    limits = [
+        Limit("auth_ip", KeySpace("ip"), 30, 0.5),
+        Limit("auth_email", KeySpace("email"), 10, 0.5),
+    ]
+    controller = AdmissionController(admit, adjust, limits)  # type: ignore
+    return AuthAttemptLimiter(CounterRedis(), controller, KeySpace("failures"), **kwargs)  # type: ignore
+
+
+def test_lockout_doubles_past_the_threshold():
+    limiter = make_limiter(
+        RecordingScript([0, "0"]),
+        RecordingScript([0, "0"]),
+        lockout_threshold=3,
+        lockout_base=30,
+        lockout_max=100,
+    )
+    assert [limiter.lockout(n) for n in range(1, 7)] == [0, 0, 30, 60, 100, 100]
+    assert limiter.lockout(10_000) == 100
+
+
+async def test_failed_logins_lock_out_ip_and_email():
+    adjust = RecordingScript([1])
+    limiter = make_limiter(
+        RecordingScript([0, "0"]),
+        adjust,
+        lockout_threshold=2,
+        lockout_base=30,
+        allow_networks=["10.0.0.0/8"],
+    )
+    await limiter.failed("1.2.3.4", "a@b.c")
+    assert adjust.calls == []
+
+    await limiter.failed("1.2.3.4", "a@b.c")
+    await limiter.failed("10.1.2.3", "a@b.c")
+    (keys, args), (allowed_keys, allowed_args) = adjust.calls
+    assert keys == ["ip:1.2.3.4", "email:a@b.c"]
+    # a full bucket plus 30 seconds of tokens, then 60 for the third failure of the email
+    # set from now, not added to the lockout already charged
+    assert args == ["", 1, 2.0, 45, 2.0, 25]
+    assert allowed_keys == ["email:a@b.c"]
+    assert allowed_args == ["", 1, 2.0, 40]
+
+
+async def test_pre_auth_rejects_before_reading_the_body():
+    admit = RecordingScript([1, "12.5"])
+    limiter = make_limiter(admit, RecordingScript([1]))
+
+    async def app(scope, receive, send):
+        raise AssertionError("rejected requests do not reach the app")
+
+    async def receive():
+        raise AssertionError("the body of a rejected ip is not read")
+
+    sent: list[dict] = []
+
+    async def send(message):
+        sent.append(message)
+
+    middleware = PreAuthMiddleware(
+        app,
+        login_path="/v1/auth/login",
+        signup_path="/v1/auth/signup",
+        max_body_size=1024,
+        limiter=limiter,
+    )
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/v1/auth/login",
+        "client": ("1.2.3.4", 5000),
+        "headers": [(XHeaders.REQUEST_ID.encoded, b"request")],
+        "query_string": b"",
+    }
+    await middleware(scope, receive, send)
+
+    assert admit.calls[0][0][1:] == ["ip:1.2.3.4", "email:"]
+    start = sent[0]
+    assert start["status"] == 429
+    assert (b"retry-after", b"13") in start["headers"]
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+import pytest
+
+from askgpt.adapters.executor import CPUExecutor
+from askgpt.domain.errors import ServerBusyError
+from askgpt.helpers.metrics import MetricsRegistry
+
+
+async def test_calls_run_off_the_event_loop():
+    registry = MetricsRegistry()
+    executor = CPUExecutor(max_workers=2, max_queue=0, registry=registry)
+    async with executor.lifespan():
+        thread = await executor.run(threading.current_thread)
+    assert thread is not threading.current_thread()
+
+    snapshot = registry.snapshot()
+    assert snapshot["executor.cpu.calls"] == 1
+    assert snapshot["executor.cpu.run_seconds"]["count"] == 1
+    assert snapshot["executor.cpu.running"] == snapshot["executor.cpu.queued"] == 0
+
+
+async def test_calls_beyond_the_queue_are_rejected():
+    registry = MetricsRegistry()
+    executor = CPUExecutor(max_workers=1, max_queue=1, registry=registry)
+    release = threading.Event()
+    async with executor.lifespan():
+        busy = [asyncio.ensure_future(executor.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert registry.snapshot()["executor.cpu.queued"] == 1
+        with pytest.raises(ServerBusyError):
+            await executor.run(release.wait)
+        release.set()
+        assert await asyncio.gather(*busy) == [True, True]
+    assert registry.snapshot()["executor.cpu.rejected"] == 1
+
+
+async def test_cancelled_calls_stay_pending_until_their_thread_is_done():
+    registry = MetricsRegistry()
+    executor = CPUExecutor(max_workers=1, max_queue=0, registry=registry)
+    release = threading.Event()
+    async with executor.lifespan():
+        try:
+            running = asyncio.ensure_future(executor.run(release.wait))
+            await asyncio.sleep(0)
+            running.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await running
+            # the thread is still busy, so the pool is still full
+            assert registry.snapshot()["executor.cpu.running"] == 1
+            with pytest.raises(ServerBusyError):
+                await executor.run(release.wait)
+        finally:
+            release.set()
+        while registry.snapshot()["executor.cpu.running"]:
+            await asyncio.sleep(0.01)
+        assert await executor.run(threading.current_thread) is not None
@@ -0,0 +1,18 @@
+import datetime
+import uuid
+
+from askgpt.helpers.ids import uuid7, uuid7_time
+
+
+def test_uuid7_is_monotonic_within_millisecond():
+    ids = [uuid7() for _ in range(10_000)]
+    assert all(value.version == 7 and value.variant == uuid.RFC_4122 for value in ids)
+    assert ids == sorted(ids)
+    assert [str(value) for value in ids] == sorted(str(value) for value in ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_uuid7_time():
+    before = datetime.datetime.now(datetime.UTC) - datetime.timedelta(milliseconds=1)
+    created = uuid7_time(str(uuid7()))
+    assert before <= created <= datetime.datetime.now(datetime.UTC)
@@ -0,0 +1,312 @@
+import asyncio
+import hashlib
+import math
+
+import pytest
+from redis.exceptions import NoScriptError
+
+from askgpt.adapters.admission import AdmissionController, Limit, Violation
+from askgpt.adapters.cache import LuaScript
+from askgpt.adapters.semaphore import DistributedSemaphore
+from askgpt.adapters.tokenbucket import HybridTokenBucket
+from askgpt.api.errors import ConcurrentStreamsExceededError
+from askgpt.api.throttler import (
+    USER_REQUESTS,
+    ChatAdmission,
+    StreamLimiter,
+    UserRequestThrottler,
+)
+from askgpt.app.gpt.api import resume_stream
+from askgpt.helpers.string import KeySpace
+from tests._fakes import FakeClock, RecordingScript
+
+
+class MemoryLeaser:
+    "the semantics of tokenlease.lua, on a shared fake clock"
+
+    def __init__(self, clock: FakeClock):
+        self.clock = clock
+        self.buckets: dict[str, tuple[float, float]] = {}
+        self.calls = 0
+
+    def _refill(self, key: str, max_tokens: int, refill_rate_s: float) -> float:
+        last, tokens = self.buckets.get(key, (self.clock.now, max_tokens))
+        return min(max_tokens, tokens + (self.clock.now - last) * refill_rate_s)
+
+    async def lease(
+        self,
+        key: str,
+        *,
+        max_tokens: int,
+        refill_rate_s: float,
+        want: int,
+        least: int,
+        max_wait: float = 0,
+    ) -> tuple[int, float]:
+        self.calls += 1
+        tokens = self._refill(key, max_tokens, refill_rate_s)
+        if tokens < least:
+            wait_time = (least - tokens) / refill_rate_s
+            granted = least if wait_time <= max_wait else 0
+            self.buckets[key] = (self.clock.now, tokens - granted)
+            return granted, wait_time
+        granted = min(want, math.floor(tokens))
+        self.buckets[key] = (self.clock.now, tokens - granted)
+        return granted, 0
+
+    async def preload(self) -> None: ...
+
+    async def give_back(self, key: str, *, max_tokens: int, tokens: int) -> None:
+        last, current = self.buckets[key]
+        self.buckets[key] = (last, min(max_tokens, current + tokens))
+
+
+def workers(
+    leaser: MemoryLeaser, clock: FakeClock, n: int, **kwargs
+) -> list[HybridTokenBucket]:
+    return [
+        HybridTokenBucket(
+            leaser,
+            max_tokens=100,
+            refill_rate_s=1,
+            lease_size=10,
+            lease_ttl=1,
+            strict_below=10,
+            clock=clock,
+            **kwargs,
+        )
+        for _ in range(n)
+    ]
+
+
+async def test_admissions_within_a_lease_stay_local():
+    clock = FakeClock()
+    leaser = MemoryLeaser(clock)
+    (bucket,) = workers(leaser, clock, 1)
+
+    for _ in range(30):
+        assert await bucket.acquire("user") == 0
+    assert leaser.calls == 3
+
+
+async def test_workers_never_exceed_the_limit():
+    clock = FakeClock()
+    leaser = MemoryLeaser(clock)
+    buckets = workers(leaser, clock, 4)
+
+    admitted = 0
+    for i in range(400):
+        admitted += await buckets[i % 4].acquire("user") == 0
+    assert admitted == 100
+
+    wait_time = await buckets[0].acquire("user")
+    assert 0 < wait_time <= 1
+
+
+async def test_expired_leases_are_given_back():
+    clock = FakeClock()
+    leaser = MemoryLeaser(clock)
+    first, second = workers(leaser, clock, 2)
+
+    assert await first.acquire("user") == 0
+    # 9 tokens sit in the lease of the first worker
+    for _ in range(90):
+        assert await second.acquire("user") == 0
+    assert await second.acquire("user") > 0
+
+    clock.now += 1
+    assert await first.sync() == 9
+    admitted = 0
+    for _ in range(10):
+        admitted += await second.acquire("user") == 0
+    # 9 given back and 1 refilled in the second
+    assert admitted == 10
+
+
+async def test_short_waits_are_reserved():
+    clock = FakeClock()
+    leaser = MemoryLeaser(clock)
+    (bucket,) = workers(leaser, clock, 1)
+
+    for _ in range(100):
+        assert await bucket.acquire("user") == 0
+    # the next token is refilled in a second, it is reserved
+    assert await bucket.acquire("user", max_wait=1.5) == pytest.approx(1)
+    # the one after is 2 seconds away, too long, nothing is taken
+    assert await bucket.acquire("user", max_wait=1.5) == pytest.approx(2)
+    assert leaser.buckets["user"] == (0, -1)
+    clock.now += 1
+    assert await bucket.acquire("user", max_wait=1.5) == pytest.approx(1)
+
+
+async def test_tight_limits_are_strict():
+    clock = FakeClock()
+    leaser = MemoryLeaser(clock)
+    (bucket,) = workers(leaser, clock, 1, strict=True)
+    assert bucket.strict
+
+    for _ in range(5):
+        assert await bucket.acquire("user") == 0
+    assert leaser.calls == 5
+    assert await bucket.sync() == 0
+
+
+class ScriptCache:
+    "the script cache of a redis server, forgets scripts on flush"
+
+    def __init__(self):
+        self.scripts: dict[str, str] = {}
+        self.loads = 0
+
+    async def script_load(self, source: str) -> str:
+        self.loads += 1
+        sha = hashlib.sha1(source.encode()).hexdigest()
+        self.scripts[sha] = source
+        return sha
+
+    async def evalsha(self, sha: str, numkeys: int, *keys_and_args: str) -> str:
+        if sha not in self.scripts:
+            raise NoScriptError("NOSCRIPT No matching script")
+        return keys_and_args[0]
+
+
+async def test_script_is_reloaded_after_flush():
+    redis = ScriptCache()
+    script = LuaScript(redis, "return KEYS[1]")  # type: ignore
+
+    await script.load()
+    assert await script(keys=["key"]) == "key"
+    assert redis.loads == 1
+
+    redis.scripts.clear()
+    assert await script(keys=["key"]) == "key"
+    assert redis.loads == 2
+
+
+def admission(script: RecordingScript, **kwargs) -> ChatAdmission:
+    clock = FakeClock()
+    leaser = MemoryLeaser(clock)
+    (bucket,) = workers(leaser, clock, 1)
+    limits = [
+        Limit(USER_REQUESTS, KeySpace("rpm"), 100, 1),
+        Limit("user_tpm", KeySpace("tpm"), 1000, 10),
+        Limit("model_rpm", KeySpace("model"), 600, 10),
+    ]
+    controller = AdmissionController(script, script, limits)  # type: ignore
+    scopes = [("user", "request"), ("user", "token"), ("model", "request")]
+    return ChatAdmission(UserRequestThrottler(bucket), controller, scopes, **kwargs)  # type: ignore
+
+
+async def test_limits_are_checked_in_one_call():
+    script = RecordingScript([3, "1.5"])
+    chat = admission(script, token_key=lambda user_id: f"tokens:{user_id}")
+
+    violation = await chat.validate("user", model="gpt", access_token="jwt")
+    assert violation == Violation("model_rpm", 1.5)
+    assert chat.quota(violation.limit) == 600
+
+    (keys, args), = script.calls
+    assert keys == ["tokens:user", "rpm:user", "tpm:user", "model:gpt"]
+    # token limits are charged once the prompt is known
+    assert args == ["jwt", "", 0, 1, 100, 1, 0.1, 1000, 0, 0.1, 600, 1]
+
+
+async def test_tokens_are_reserved_then_settled():
+    script = RecordingScript([0, "0"])
+    chat = admission(script)
+
+    await chat.reserve("user", "gpt", 300)
+    await chat.settle("user", "gpt", reserved=300, used=120)
+    await chat.settle("user", "gpt", reserved=300, used=300)
+
+    (_, reserve), (keys, settle) = script.calls
+    assert reserve[3:] == [1, 100, 0, 0.1, 1000, 300, 0.1, 600, 0]
+    assert keys == ["tpm:user"]
+    assert settle == ["", 0, 0.1, -180]
+
+
+async def test_revoked_token_is_a_violation():
+    chat = admission(RecordingScript([-1, "0"]), token_key=lambda user_id: user_id)
+    violation = await chat.validate("user", model="gpt", access_token="jwt")
+    assert violation and violation.limit == "token_revoked"
+
+
+async def test_waiting_requests_are_capped_per_user():
+    script = RecordingScript([0, "0.05"])
+    chat = admission(script, max_wait=0.5, max_waiting=1)
+
+    results = await asyncio.gather(
+        chat.validate("user", model="gpt", access_token=""),
+        chat.validate("user", model="gpt", access_token=""),
+        chat.validate("other", model="gpt", access_token=""),
+    )
+    assert results == [None, None, None]
+    # the second request of the user came while the first was waiting
+    assert [args[2] for _, args in script.calls] == [0.5, 0, 0.5]
+
+
+class SortedSets:
+    "the zrem of a redis client"
+
+    def __init__(self):
+        self.removed: list[tuple[str, str]] = []
+
+    async def zrem(self, key: str, member: str) -> int:
+        self.removed.append((key, member))
+        return 1
+
+
+class SemaphoreRedis:
+    def __init__(self):
+        self.client = SortedSets()
+
+
+async def test_streams_are_capped_by_role():
+    redis = SemaphoreRedis()
+    acquire, renew = RecordingScript(1), RecordingScript(1)  # type: ignore
+    semaphore = DistributedSemaphore(
+        redis, acquire, renew, keyspace=KeySpace("streams"), lease_ttl=30  # type: ignore
+    )
+    streams = StreamLimiter(semaphore, {"user": 1})
+
+    # admins are not capped
+    await (await streams.acquire("admin", "admin"))()
+    assert acquire.calls == []
+
+    release = await streams.acquire("user", "user")
+    (keys, [lease_id, limit, ttl, _]), = acquire.calls
+    assert (keys, limit, ttl) == (["streams:user"], 1, 30)
+
+    assert await semaphore.renew() == 1
+    assert renew.calls[0] == (["streams:user"], [30, "", 1, lease_id])
+
+    acquire.result = 0  # type: ignore
+    with pytest.raises(ConcurrentStreamsExceededError):
+        await streams.acquire("user", "user")
+
+    await release()
+    await release()
+    assert redis.client.removed == [("streams:user", lease_id)]
+    assert semaphore.held == 0
+
+
+async def test_stream_failing_midway_releases_its_slot():
+    redis = SemaphoreRedis()
+    acquire, renew = RecordingScript(1), RecordingScript(1)  # type: ignore
+    semaphore = DistributedSemaphore(
+        redis, acquire, renew, keyspace=KeySpace("streams"), lease_ttl=30  # type: ignore
+    )
+    release = await StreamLimiter(semaphore, {"user": 1}).acquire("user", "user")
+
+    async def provider():
+        yield "second"
+        raise ConnectionError("provider went away")
+
+    chunks: list[str] = []
+    with pytest.raises(ConnectionError):
+        async for chunk in resume_stream("first", provider(), release):
+            chunks.append(chunk)
+
+    assert chunks == ["first", "second"]
+    assert semaphore.held == 0
+    assert await semaphore.renew() == 0